@@ -0,0 +1,159 @@
+import asyncio, signal, sys
+
+from ServerWorker import ServerWorker
+from FrameStore import FrameStore
+from FrameScheduler import FrameScheduler
+from RtpEgress import RtpEgress
+from RtspCodec import RtspParser, RtspError
+from Metrics import MetricsRegistry, MetricsServer
+from Server import popOption
+from Rtcp import RtcpReceiver, RtcpProtocol, bindPair
+from Channel import ChannelRegistry
+from SessionManager import SessionManager
+from Log import getLogger, setupLogging
+
+log = getLogger('server')
+
+class LoopScheduler(FrameScheduler):
+    """FrameScheduler driven by a timer on an asyncio event loop."""
+
+    def __init__(self, loop, egress=None):
+        super().__init__(egress)
+        self.loop = loop
+        self.timer = None
+
+    def wake(self):
+        self.arm(self.nextDeadline())
+
+    def arm(self, deadline):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if deadline is not None:
+            # loop.time() and the scheduler share the monotonic clock
+            self.timer = self.loop.call_at(deadline, self.fire)
+
+    def fire(self):
+        self.timer = None
+        self.arm(self.runDue())
+
+class AsyncServerWorker(ServerWorker):
+    """ServerWorker whose RTSP, RTP and pacing all run on one asyncio event loop."""
+
+    def __init__(self, clientInfo, writer):
+        super().__init__(clientInfo)
+        self.writer = writer
+
+    def sendReply(self, data):
+        self.writer.write(data)
+
+    def expire(self):
+        # handleClient sees end of stream and releases the session
+        self.writer.close()
+
+class AsyncServer:
+    """Single-threaded RTSP/RTP server engine built on asyncio."""
+
+    # Memory budget for media kept by the shared frame store
+    FRAME_STORE_BUDGET = 256 * 1024 * 1024
+    # UDP sockets shared by all sessions for RTP egress
+    EGRESS_SOCKETS = 4
+
+    def __init__(self):
+        self.frameStore = FrameStore(self.FRAME_STORE_BUDGET)
+        self.frameRate = None
+        self.metricsPort = None
+        self.shareUnicast = False
+        self.limits = {}
+
+    def main(self):
+        args = sys.argv[1:]
+        try:
+            # Optional local port serving Prometheus metrics
+            self.metricsPort = popOption(args, '-m')
+            # Log level: off, error, warning, info or debug
+            setupLogging(popOption(args, '-l', 'info', str))
+            # Session timeout (s), and admission limits on sessions and egress Mbit/s
+            self.limits = {'timeout': popOption(args, '-t', SessionManager.TIMEOUT),
+                           'maxSessions': popOption(args, '-n'),
+                           'maxBitrate': popOption(args, '-b', None, lambda mbps: float(mbps) * 1e6)}
+            # Unicast sessions on the same file share one live channel
+            self.shareUnicast = '-c' in args
+            if self.shareUnicast:
+                args.remove('-c')
+            SERVER_PORT = int(args[0])
+        except:
+            print("[Usage: AsyncServer.py Server_port [-m Metrics_port] [-l Log_level] [-t Timeout] [-n Max_sessions] [-b Max_Mbps] [-c] [Frame_rate]]\n")
+            return
+        # Optional frame rate for every session, overriding the media index
+        self.frameRate = float(args[1]) if len(args) > 1 else None
+        asyncio.run(self.serve(SERVER_PORT))
+
+    async def serve(self, port):
+        self.loop = asyncio.get_running_loop()
+        # Media files changed on disk are picked up after SIGHUP
+        self.loop.add_signal_handler(signal.SIGHUP, self.frameStore.reload)
+        # The egress sockets are registered as datagram endpoints with the
+        # loop, while packets go out in batches straight from the scheduler
+        # Each egress socket sends RTP from an even port; RTCP comes back on the odd one after it
+        pairs = [bindPair() for _ in range(self.EGRESS_SOCKETS)]
+        for sock, _ in pairs:
+            await self.loop.create_datagram_endpoint(asyncio.DatagramProtocol, sock=sock)
+        self.egress = RtpEgress(sockets=[rtp for rtp, _ in pairs])
+        self.scheduler = LoopScheduler(self.loop, self.egress)
+        self.rtcp = RtcpReceiver([rtcp for _, rtcp in pairs])
+        for _, sock in pairs:
+            await self.loop.create_datagram_endpoint(lambda: RtcpProtocol(self.rtcp), sock=sock)
+        self.channels = ChannelRegistry(self.frameStore, self.scheduler, self.egress,
+                                        self.frameRate, self.shareUnicast)
+        self.sessions = SessionManager(frameStore=self.frameStore, **self.limits)
+        self.loop.call_later(self.sessions.reapInterval, self.reapSessions)
+        self.metrics = MetricsRegistry(self.frameStore, self.egress, self.channels, self.sessions)
+        if self.metricsPort:
+            # Scrapes are answered on their own thread, reading counters racily
+            MetricsServer(self.metrics, self.metricsPort).start()
+        server = await asyncio.start_server(self.handleClient, '', port)
+        async with server:
+            await server.serve_forever()
+
+    def reapSessions(self):
+        """Expire idle sessions on the event loop, every reapInterval."""
+        self.sessions.reap()
+        self.loop.call_later(self.sessions.reapInterval, self.reapSessions)
+
+    async def handleClient(self, reader, writer):
+        """Receive client info (address,port) through RTSP/TCP session."""
+        clientInfo = {}
+        clientInfo['rtspSocket'] = (None, writer.get_extra_info('peername'))
+        clientInfo['frameStore'] = self.frameStore
+        clientInfo['scheduler'] = self.scheduler
+        clientInfo['egress'] = self.egress
+        clientInfo['frameRate'] = self.frameRate
+        clientInfo['metrics'] = self.metrics
+        clientInfo['rtcp'] = self.rtcp
+        clientInfo['channels'] = self.channels
+        clientInfo['sessions'] = self.sessions
+        worker = AsyncServerWorker(clientInfo, writer)
+        parser = RtspParser()
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                log.debug("Data received from %s:\n%s", clientInfo['rtspSocket'][1],
+                          data.decode("utf-8", "replace"))
+                for request in parser.feed(data):
+                    worker.processRtspRequest(request)
+        except RtspError as e:
+            log.warning("Bad request from %s: %s", clientInfo['rtspSocket'][1], e)
+            worker.replyRtsp(worker.BAD_REQUEST_400, '0')
+        except ConnectionError:
+            pass
+        except Exception:
+            log.exception("Error serving %s", clientInfo['rtspSocket'][1])
+        finally:
+            worker.disconnect()
+            writer.close()
+
+if __name__ == "__main__":
+    (AsyncServer()).main()
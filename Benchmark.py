@@ -0,0 +1,751 @@
+"""Benchmarks for the streaming server.
+
+Usage: Benchmark.py <benchmark> [options]
+
+Each benchmark generates the media it needs in a temporary directory, so
+no movie files are required.
+"""
+import argparse, os, selectors, socket, subprocess, sys, tempfile, time
+
+from RtspCodec import RtspParser, encodeRequest
+from Harness import (makeMovie, freePort, startServer, stopServer, cpuSeconds, processTree,
+                     threadCount)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def rssKb():
+    """Anonymous (private, non file-backed) resident memory of this process in KiB.
+
+    Mapped media pages live in the shared page cache, so plain RSS would
+    charge every mapping for them; RssAnon counts only real copies.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def childVideoStream(args):
+    """Open --sessions streams in one mode, report SETUP time and RSS growth."""
+    from VideoStream import VideoStream
+    base = rssKb()
+    streams = []
+    start = time.perf_counter()
+    for _ in range(args.sessions):
+        streams.append(VideoStream(args.movie, lazy=args.mode == 'lazy'))
+    setup = (time.perf_counter() - start) / args.sessions
+    afterSetup = rssKb()
+    for vs in streams:
+        while vs.nextFrame() is not None:
+            pass
+    print('%s %.6f %d %d' % (args.mode, setup, afterSetup - base, rssKb() - base))
+
+def benchVideoStream(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), args.frames, args.frame_size)
+        print('movie: %d frames, %.1f MB, %d sessions'
+              % (args.frames, os.path.getsize(movie) / 1e6, args.sessions))
+        print('%-6s %14s %16s %16s' % ('mode', 'SETUP ms', 'RSS setup MB', 'RSS played MB'))
+        for mode in ('eager', 'lazy'):
+            out = subprocess.check_output(
+                [sys.executable, __file__, 'videostream', '--child', mode,
+                 '--movie', movie, '--sessions', str(args.sessions)],
+                cwd=HERE)
+            name, setup, rssSetup, rssPlayed = out.split()
+            print('%-6s %14.2f %16.1f %16.1f' % (name.decode(), float(setup) * 1000,
+                                                 int(rssSetup) / 1024, int(rssPlayed) / 1024))
+
+def rtspRequest(conn, request):
+    conn.sendall(request)
+    return conn.recv(1024)
+
+def openSession(port, movie):
+    """SETUP and PLAY one session; return its (RTSP connection, RTP socket)."""
+    rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rtp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    rtp.bind(('127.0.0.1', 0))
+    rtp.setblocking(False)
+    conn = socket.create_connection(('127.0.0.1', port))
+    port = rtp.getsockname()[1]
+    reply = rtspRequest(conn, encodeRequest('SETUP', movie, 1,
+                        [('Transport', 'RTP/AVP;unicast;client_port=%d-%d' % (port, port + 1))]))
+    session = RtspParser().feed(reply)[0].session()
+    rtspRequest(conn, encodeRequest('PLAY', movie, 2, [('Session', session)]))
+    return conn, rtp
+
+def receive(rtpSockets, duration):
+    """Drain all RTP sockets for duration seconds, return whole frames per socket."""
+    sel = selectors.DefaultSelector()
+    counts = {}
+    for i, s in enumerate(rtpSockets):
+        sel.register(s, selectors.EVENT_READ, i)
+        counts[i] = 0
+    end = time.monotonic() + duration
+    while True:
+        left = end - time.monotonic()
+        if left <= 0:
+            break
+        for key, _ in sel.select(left):
+            try:
+                while True:
+                    # The marker bit closes a frame
+                    if key.fileobj.recv(65536)[1] & 0x80:
+                        counts[key.data] += 1
+            except BlockingIOError:
+                pass
+    sel.close()
+    return [counts[i] for i in range(len(rtpSockets))]
+
+def loadStep(script, movie, sessions, duration, cpu, *args, stderr=None):
+    """Run one engine with a number of concurrent sessions, return its figures.
+
+    CPU and threads are summed over the server and any worker processes."""
+    port = freePort()
+    proc = startServer(script, port, *args, cpu=cpu, stderr=stderr)
+    try:
+        conns = [openSession(port, movie) for _ in range(sessions)]
+        rtps = [rtp for _, rtp in conns]
+        receive(rtps, 1.0)
+        pids = processTree(proc.pid)
+        cpu0 = sum(cpuSeconds(pid) for pid in pids)
+        counts = receive(rtps, duration)
+        cpuUsed = sum(cpuSeconds(pid) for pid in pids) - cpu0
+        threads = sum(threadCount(pid) for pid in pids)
+        for conn, rtp in conns:
+            conn.close()
+            rtp.close()
+    finally:
+        stopServer(proc)
+    fps = sorted(c / duration for c in counts)
+    return fps[len(fps) // 2], fps[len(fps) // 20], 100 * cpuUsed / duration, threads
+
+def benchEngines(args):
+    engines = {'thread': 'Server.py', 'asyncio': 'AsyncServer.py'}
+    target = 20.0 * 0.95
+    with tempfile.TemporaryDirectory() as tmp:
+        movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), args.frames, args.frame_size)
+        print('server pinned to CPU %d, %d byte frames, target >= %.0f fps per session'
+              % (args.cpu, args.frame_size, target))
+        print('%-8s %9s %9s %9s %8s %8s' % ('engine', 'sessions', 'p50 fps', 'p5 fps', 'CPU %', 'threads'))
+        for name in args.engines.split(','):
+            sustained = 0
+            for n in [int(n) for n in args.sessions.split(',')]:
+                p50, p5, cpu, threads = loadStep(engines[name], movie, n, args.duration, args.cpu)
+                print('%-8s %9d %9.1f %9.1f %8.0f %8d' % (name, n, p50, p5, cpu, threads))
+                if p5 < target:
+                    break
+                sustained = n
+            print('%-8s sustains %d sessions on one core' % (name, sustained))
+
+def benchWorkers(args):
+    """Sessions sustained by the threaded server as worker processes are added."""
+    target = 20.0 * 0.95
+    available = sorted(os.sched_getaffinity(0))
+    with tempfile.TemporaryDirectory() as tmp:
+        movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), args.frames, args.frame_size)
+        print('%d CPUs available, %d byte frames, target >= %.0f fps per session'
+              % (len(available), args.frame_size, target))
+        print('%-8s %9s %9s %9s %8s' % ('workers', 'sessions', 'p50 fps', 'p5 fps', 'CPU %'))
+        for workers in [int(n) for n in args.workers.split(',')]:
+            # One CPU per worker, so the single-process GIL limit shows
+            cpus = set(available[:workers])
+            sustained = 0
+            for n in [int(n) for n in args.sessions.split(',')]:
+                p50, p5, cpu, _ = loadStep('Server.py', movie, n, args.duration, cpus, '-w', workers)
+                print('%-8d %9d %9.1f %9.1f %8.0f' % (workers, n, p50, p5, cpu))
+                if p5 < target:
+                    break
+                sustained = n
+            print('%d worker(s) on %d CPU(s) sustain %d sessions' % (workers, len(cpus), sustained))
+
+def benchLogging(args):
+    """Cost of a per-packet log call, and server CPU with logging off, at info and at debug."""
+    import timeit
+    import Log
+
+    with open(os.devnull, 'w') as devnull:
+        log = Log.getLogger('bench')
+        packetLog = Log.PacketLog(log)
+
+        def printed():
+            print("Current Seq Num: " + str(1234), file=devnull)
+
+        def guarded():
+            if packetLog.enabled:
+                packetLog.debug("Current Seq Num: %d", 1234)
+
+        def direct():
+            log.debug("Current Seq Num: %d", 1234)
+
+        print('%-36s %10s' % ('per-packet log call', 'ns/call'))
+        cases = (('print() to /dev/null', printed, 'off'),
+                 ('PacketLog, debug off', guarded, 'info'),
+                 ('PacketLog, debug on (rate limited)', guarded, 'debug'),
+                 ('logger.debug, debug off', direct, 'info'),
+                 ('logger.debug, debug on (queued)', direct, 'debug'))
+        for name, fn, level in cases:
+            Log.setupLogging(level, devnull)
+            best = min(timeit.repeat(fn, number=args.number, repeat=5))
+            print('%-36s %10.0f' % (name, best / args.number * 1e9))
+            if level == 'debug':
+                # Let the queue drain before the next case
+                Log.stopLogging()
+        Log.stopLogging()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), args.frames, args.frame_size)
+            print('\nthreaded server pinned to CPU %d, %d sessions, %d byte frames'
+                  % (args.cpu, args.sessions, args.frame_size))
+            print('%-8s %9s %9s %8s' % ('logging', 'p50 fps', 'p5 fps', 'CPU %'))
+            for level in ('off', 'info', 'debug'):
+                p50, p5, cpu, _ = loadStep('Server.py', movie, args.sessions, args.duration, args.cpu,
+                                           '-l', level, stderr=devnull)
+                print('%-8s %9.1f %9.1f %8.0f' % (level, p50, p5, cpu))
+
+def benchSeek(args):
+    """Latency from PLAY with a Range header to the first RTP packet of the new position.
+
+    Fails if the p95 time to the first frame at the new position exceeds args.budget ms."""
+    import random
+    from RtpPacket import RtpPacket
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), args.frames, args.frame_size)
+        duration = args.frames / 20.0
+        port = freePort()
+        proc = startServer(args.engine, port, '-l', 'warning', stderr=subprocess.DEVNULL)
+        try:
+            rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            rtp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            rtp.bind(('127.0.0.1', 0))
+            rtp.settimeout(2.0)
+            rtpPort = rtp.getsockname()[1]
+            conn = socket.create_connection(('127.0.0.1', port))
+            parser = RtspParser()
+            reply = parser.feed(rtspRequest(conn, encodeRequest('SETUP', movie, 1,
+                [('Transport', 'RTP/AVP;unicast;client_port=%d-%d' % (rtpPort, rtpPort + 1))])))[0]
+            session = reply.session()
+            rtspRequest(conn, encodeRequest('PLAY', movie, 2, [('Session', session)]))
+            replies = []
+            firstFrames = []
+            for cseq in range(3, args.seeks + 3):
+                target = rng.random() * duration
+                start = time.perf_counter()
+                conn.sendall(encodeRequest('PLAY', movie, cseq,
+                                           [('Session', session), ('Range', 'npt=%.3f-' % target)]))
+                messages = []
+                while not messages:
+                    messages = parser.feed(conn.recv(4096))
+                replies.append(time.perf_counter() - start)
+                info = dict(field.split('=', 1) for field in messages[0].header('RTP-Info').split(';'))
+                rtptime = int(info['rtptime'])
+                while True:
+                    packet = RtpPacket()
+                    packet.decode(rtp.recv(65536))
+                    if packet.timestamp() == rtptime:
+                        firstFrames.append(time.perf_counter() - start)
+                        break
+            conn.close()
+            rtp.close()
+        finally:
+            stopServer(proc)
+
+    print('%s, %d frames (%.0f min at 20 fps), %d random seeks'
+          % (args.engine, args.frames, duration / 60, args.seeks))
+    print('%-24s %9s %9s %9s' % ('', 'p50 ms', 'p95 ms', 'max ms'))
+    for name, samples in (('PLAY reply', replies), ('first frame at position', firstFrames)):
+        samples.sort()
+        print('%-24s %9.2f %9.2f %9.2f' % (name, samples[len(samples) // 2] * 1e3,
+                                            samples[int(len(samples) * 0.95)] * 1e3, samples[-1] * 1e3))
+    p95 = firstFrames[int(len(firstFrames) * 0.95)] * 1e3
+    if p95 > args.budget:
+        raise AssertionError('seek to first frame p95 %.2f ms is over the %g ms budget' % (p95, args.budget))
+    print('first frame p95 within the %g ms budget' % args.budget)
+
+def benchEgress(args):
+    """Send one packet per session per round through each egress path."""
+    from VideoStream import VideoStream
+    from RtpPacket import RtpPacket, RtpEncoder
+    from RtpEgress import RtpEgress, SENDMMSG
+
+    with tempfile.TemporaryDirectory() as tmp:
+        movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), 256, args.payload)
+        frames = VideoStream(movie, lazy=True).cache
+        receivers = []
+        for _ in range(args.sessions):
+            r = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            r.bind(('127.0.0.1', 0))
+            r.setblocking(False)
+            receivers.append(r)
+        addresses = [r.getsockname() for r in receivers]
+
+        def drain():
+            for r in receivers:
+                try:
+                    while True:
+                        r.recv(65536)
+                except BlockingIOError:
+                    pass
+
+        modes = ['legacy', 'sendto', 'sendmsg'] + (['sendmmsg'] if SENDMMSG else [])
+        print('%d sessions, %d byte payloads, %d rounds' % (args.sessions, args.payload, args.rounds))
+        print('%-9s %12s %16s' % ('path', 'packets/s', 'CPU s per Gbit'))
+        for mode in modes:
+            if mode == 'legacy':
+                # One socket per session and one concatenated sendto per packet
+                sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in addresses]
+            else:
+                egress = RtpEgress(mode=mode)
+                slots = [egress.assign() for _ in addresses]
+                encoders = [RtpEncoder() for _ in addresses]
+            cpu = 0.0
+            sent = 0
+            for n in range(args.rounds):
+                start = time.process_time()
+                for i, address in enumerate(addresses):
+                    payload = frames[(n + i) % len(frames)]
+                    if mode == 'legacy':
+                        rtpPacket = RtpPacket()
+                        rtpPacket.encode(2, 0, 0, 0, n, 0, 26, 0, payload)
+                        sockets[i].sendto(rtpPacket.getPacket(), address)
+                    else:
+                        rtpHeader, payload = encoders[i].encode(n, n * 4500, payload)
+                        egress.queue(slots[i], rtpHeader, payload, address)
+                if mode != 'legacy':
+                    egress.flush()
+                cpu += time.process_time() - start
+                sent += len(addresses)
+                drain()
+            bits = sent * (12 + args.payload) * 8
+            print('%-9s %12.0f %16.2f' % (mode, sent / cpu, cpu / (bits / 1e9)))
+            if mode == 'legacy':
+                for sock in sockets:
+                    sock.close()
+            else:
+                egress.close()
+
+def benchRtp(args):
+    """Nanoseconds per packet to encode and decode RTP headers."""
+    import timeit
+    from RtpPacket import RtpPacket, RtpEncoder
+
+    payload = memoryview(bytes(args.payload))
+    encoder = RtpEncoder()
+    legacy = RtpPacket()
+    legacy.encode(2, 0, 0, 0, 1, 0, 26, 0, payload)
+    packet = bytes(legacy.getPacket())
+
+    def legacyEncode():
+        rtpPacket = RtpPacket()
+        rtpPacket.encode(2, 0, 0, 0, 1234, 0, 26, 0, payload)
+        return rtpPacket.getPacket()
+
+    def fastEncode():
+        return encoder.encode(1234, 567890, payload)
+
+    def decode():
+        rtpPacket = RtpPacket()
+        rtpPacket.decode(packet)
+        return rtpPacket.seqNum(), rtpPacket.timestamp(), rtpPacket.getPayload()
+
+    print('%d byte payloads' % args.payload)
+    print('%-32s %10s' % ('operation', 'ns/packet'))
+    for name, fn in (('RtpPacket.encode + getPacket', legacyEncode),
+                     ('RtpEncoder.encode', fastEncode),
+                     ('RtpPacket.decode + fields', decode)):
+        best = min(timeit.repeat(fn, number=args.number, repeat=5))
+        print('%-32s %10.0f' % (name, best / args.number * 1e9))
+
+def jpegReceiver(sock, conn):
+    """Reassemble frames from sock until it goes quiet, send the counts back over conn."""
+    from RtpPacket import RtpPacket
+    from RtpJpeg import FrameAssembler
+    assembler = FrameAssembler()
+    sock.settimeout(1.0)
+    conn.send('ready')
+    received = 0
+    start = None
+    while True:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            break
+        if start is None:
+            start = time.perf_counter()
+        last = time.perf_counter()
+        received += 1
+        rtpPacket = RtpPacket()
+        rtpPacket.decode(data)
+        assembler.feed(rtpPacket)
+    conn.send((received, assembler.framesComplete, assembler.framesLost + len(assembler.pending),
+               (last - start) if start else 0.0))
+
+def benchJpeg(args):
+    """Fragment large frames over loopback and reassemble them in another process."""
+    import multiprocessing, random
+    from RtpJpeg import JpegEncoder, makeHeaders, makeTables
+    from RtpEgress import RtpEgress
+
+    head = makeHeaders(1, 1920 // 8, 1080 // 8, makeTables(50))
+    frames = [head + bytes([i]) * (args.frame_size - len(head) - 2) + b'\xff\xd9' for i in range(16)]
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    receiver.bind(('127.0.0.1', 0))
+    address = receiver.getsockname()
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=jpegReceiver, args=(receiver, child))
+    proc.start()
+    parent.recv()
+
+    encoder = JpegEncoder(mtu=args.mtu)
+    egress = RtpEgress(poolSize=1)
+    rng = random.Random(1)
+    seq = 0
+    packets = 0
+    interval = 1.0 / args.rate if args.rate else 0.0
+    start = time.perf_counter()
+    for n in range(args.frames):
+        fragments, seq = encoder.encodeFrame(frames[n % len(frames)], seq, n * 4500)
+        if args.reorder:
+            rng.shuffle(fragments)
+        for header, payload in fragments:
+            if rng.random() >= args.drop:
+                egress.queue(0, header, payload, address)
+        packets += len(fragments)
+        egress.flush()
+        if interval:
+            time.sleep(max(0.0, start + (n + 1) * interval - time.perf_counter()))
+    elapsed = time.perf_counter() - start
+    received, complete, lost, recvTime = parent.recv()
+    proc.join()
+
+    print('%d frames of %d bytes, MTU %d, %d packets/frame, drop %.1f%%%s'
+          % (args.frames, args.frame_size, args.mtu, packets // args.frames,
+             args.drop * 100, ', fragments shuffled' if args.reorder else ''))
+    print('sent      %8.0f frames/s %8.0f packets/s %8.1f Mbit/s'
+          % (args.frames / elapsed, packets / elapsed, args.frames * args.frame_size * 8 / elapsed / 1e6))
+    print('received  %8d packets  %8d frames complete  %d incomplete  (%.1f%% packet loss)'
+          % (received, complete, lost, 100.0 * (packets - received) / packets))
+
+def benchPacketize(args):
+    """Per-packet send CPU: packetizing each frame per session vs once per file."""
+    from VideoStream import VideoStream
+    from RtpJpeg import JpegEncoder, FragmentCache
+    from RtpEgress import RtpEgress
+
+    with tempfile.TemporaryDirectory() as tmp:
+        movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), 256, args.frame_size)
+        frames = VideoStream(movie, lazy=True).cache
+        receivers = []
+        for _ in range(args.sessions):
+            r = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            r.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+            r.bind(('127.0.0.1', 0))
+            r.setblocking(False)
+            receivers.append(r)
+        addresses = [r.getsockname() for r in receivers]
+
+        def drain():
+            for r in receivers:
+                try:
+                    while True:
+                        r.recv(65536)
+                except BlockingIOError:
+                    pass
+
+        encoders = [JpegEncoder(ssrc=i) for i in range(args.sessions)]
+        cache = FragmentCache(frames, encoders[0].maxPayload, encoders[0].pt)
+        for n in range(len(frames)):
+            cache.get(n)
+        # The raw path re-sends one frame's packets as they are: only the syscalls are left
+        rawPackets, _ = JpegEncoder().encodeFrame(frames[0], 0, 0)
+        rawPackets = [(bytes(h), p) for h, p in rawPackets]
+        egress = RtpEgress()
+        slots = [egress.assign() for _ in addresses]
+
+        def run(mode):
+            """CPU seconds to encode and queue, and to also send, args.rounds frames per session,
+            and the packets sent."""
+            seqs = [0] * len(addresses)
+            encodeCpu = sendCpu = 0.0
+            packets = 0
+            for n in range(args.rounds):
+                index = n % len(frames)
+                start = time.process_time()
+                for i, address in enumerate(addresses):
+                    if mode == 'encodeFrame':
+                        fragments, seqs[i] = encoders[i].encodeFrame(frames[index], seqs[i], n * 4500)
+                    elif mode == 'prepacketized':
+                        fragments, seqs[i] = encoders[i].encodeFragments(cache.get(index), seqs[i], n * 4500)
+                    else:
+                        fragments = rawPackets
+                    for header, payload in fragments:
+                        egress.queue(slots[i], header, payload, address)
+                    packets += len(fragments)
+                queued = time.process_time()
+                egress.flush()
+                end = time.process_time()
+                encodeCpu += queued - start
+                sendCpu += end - start
+                drain()
+            return encodeCpu, sendCpu, packets
+
+        modes = ('encodeFrame', 'prepacketized', 'raw')
+        results = dict((mode, []) for mode in modes)
+        # Interleaved repeats, so drift in the machine's load hits every path alike
+        for _ in range(args.repeat):
+            for mode in modes:
+                results[mode].append(run(mode))
+        egress.close()
+
+        print('%d sessions, %d byte frames, %d packets/frame, %s egress, median of %d x %d rounds'
+              % (args.sessions, args.frame_size, len(rawPackets), egress.mode, args.repeat, args.rounds))
+        print('%-14s %14s %18s' % ('path', 'encode ns/pkt', 'encode+send ns/pkt'))
+        for mode in modes:
+            encode = sorted(e / p * 1e9 for e, _, p in results[mode])
+            send = sorted(s / p * 1e9 for _, s, p in results[mode])
+            print('%-14s %14.0f %18.0f' % (mode, encode[len(encode) // 2], send[len(send) // 2]))
+        print('pre-packetized state: %.0f bytes/frame, %.1f%% of the media'
+              % (cache.nbytes / len(frames), 100.0 * cache.nbytes / sum(len(f) for f in frames)))
+        for r in receivers:
+            r.close()
+
+def randomRequests(rng, count):
+    """Return (encoded stream, expected (method, uri, cseq, session, body) tuples)."""
+    methods = ('SETUP', 'PLAY', 'PAUSE', 'TEARDOWN', 'FORWARD', 'BACKWARD')
+    chunks = []
+    expected = []
+    for cseq in range(1, count + 1):
+        method = rng.choice(methods)
+        uri = 'movie%d.Mjpeg' % rng.randrange(100)
+        session = str(rng.randrange(100000, 999999))
+        headers = [('Session', session)]
+        if method == 'SETUP':
+            port = rng.randrange(1024, 65000)
+            headers.append(('Transport', 'RTP/AVP;unicast;client_port=%d-%d' % (port, port + 1)))
+        if rng.random() < 0.2:
+            headers.append(('Range', 'npt=%.3f-' % (rng.random() * 100)))
+        body = bytes(rng.randrange(256) for _ in range(rng.randrange(64))) if rng.random() < 0.1 else b''
+        chunks.append(encodeRequest(method, uri, cseq, headers, body))
+        expected.append((method, uri, cseq, session, body))
+    return b''.join(chunks), expected
+
+def benchRtsp(args):
+    """Fuzz the RTSP parser with random read boundaries and corrupt input, then time it."""
+    import random
+    from RtspCodec import RtspError
+
+    rng = random.Random(args.seed)
+    stream, expected = randomRequests(rng, args.requests)
+
+    # Same messages whatever the read boundaries
+    for _ in range(args.rounds):
+        parser = RtspParser()
+        parsed = []
+        pos = 0
+        while pos < len(stream):
+            step = rng.choice((1, 2, 7, 64, 1500, len(stream)))
+            parsed += parser.feed(stream[pos:pos + step])
+            pos += step
+        got = [(m.method, m.uri, m.cseq(), m.session(), m.body) for m in parsed]
+        if got != expected:
+            raise AssertionError('split reads changed the parse')
+    print('split reads:   %d rounds of %d pipelined requests parsed identically' % (args.rounds, args.requests))
+
+    # Corrupt input either parses or raises RtspError, nothing else
+    rejected = 0
+    for _ in range(args.rounds * 10):
+        data = bytearray(stream[:4096])
+        for _ in range(rng.randrange(1, 8)):
+            data[rng.randrange(len(data))] = rng.randrange(256)
+        try:
+            RtspParser().feed(bytes(data))
+        except RtspError:
+            rejected += 1
+    print('corrupt input: %d mutated streams, %d rejected with RtspError, no crashes' % (args.rounds * 10, rejected))
+
+    print('%-12s %14s' % ('read size', 'requests/s'))
+    for size in (64, 1500, len(stream)):
+        best = None
+        for _ in range(3):
+            parser = RtspParser()
+            start = time.perf_counter()
+            for pos in range(0, len(stream), size):
+                parser.feed(stream[pos:pos + size])
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('%-12s %14.0f' % (size if size < len(stream) else 'all', args.requests / best))
+
+def benchLoad(args):
+    """End-to-end: LoadClient sessions running a scenario against each engine."""
+    from LoadClient import LoadGenerator, SCENARIOS
+    engines = {'thread': 'Server.py', 'asyncio': 'AsyncServer.py'}
+    with tempfile.TemporaryDirectory() as tmp:
+        movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), args.frames, args.frame_size)
+        print('scenario %s over %.0f s, %d byte frames, server pinned to CPU %d'
+              % (args.scenario, args.duration, args.frame_size, args.cpu))
+        print('%-8s %8s %8s %8s %10s %7s %10s %10s %6s' % ('engine', 'sessions', 'p50 fps', 'p5 fps',
+              'jitter p95', 'loss %', 'seek p50', 'seek p95', 'CPU %'))
+        for name in args.engines.split(','):
+            for n in [int(n) for n in args.sessions.split(',')]:
+                port = freePort()
+                proc = startServer(engines[name], port, '-l', 'warning', cpu=args.cpu)
+                try:
+                    # Media time of the synthetic movie at the default 20 fps
+                    report = LoadGenerator('127.0.0.1', port, movie, n, SCENARIOS[args.scenario](args.duration),
+                                           seekMax=args.frames / 20.0, ramp=1.0, serverPid=proc.pid).run()
+                finally:
+                    stopServer(proc)
+                ms = lambda v: '%.1f ms' % v if v is not None else '-'
+                print('%-8s %8d %8.1f %8.1f %10s %7.2f %10s %10s %6.0f' % (name, n, report['fpsP50'] or 0,
+                      report['fpsP5'] or 0, ms(report['jitterMsP95']), 100 * report['lossRatio'],
+                      ms(report['seekLatencyMsP50']), ms(report['seekLatencyMsP95']), report['serverCpuPercent']))
+
+def benchFanout(args):
+    """Server CPU as viewers grow: a stream per session, vs one live channel per file
+    fanned out by unicast, vs one channel sent to a multicast group."""
+    from LoadClient import LoadGenerator, SCENARIOS
+    modes = {'session': ((), False), 'unicast': (('-c',), False), 'multicast': ((), True)}
+    with tempfile.TemporaryDirectory() as tmp:
+        movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), args.frames, args.frame_size)
+        print('%s, %.0f s of play, %d byte frames, server pinned to CPU %d'
+              % (args.engine, args.duration, args.frame_size, args.cpu))
+        print('%-10s %8s %8s %8s %7s %6s %12s' % ('mode', 'viewers', 'p50 fps', 'p5 fps', 'loss %',
+                                                'CPU %', 'CPU %/viewer'))
+        for name in args.modes.split(','):
+            serverArgs, multicast = modes[name]
+            for n in [int(n) for n in args.sessions.split(',')]:
+                port = freePort()
+                proc = startServer(args.engine, port, '-l', 'warning', *serverArgs, cpu=args.cpu)
+                try:
+                    report = LoadGenerator('127.0.0.1', port, movie, n, SCENARIOS['play'](args.duration),
+                                           ramp=1.0, serverPid=proc.pid, multicast=multicast).run()
+                finally:
+                    stopServer(proc)
+                cpu = report['serverCpuPercent']
+                print('%-10s %8d %8.1f %8.1f %7.2f %6.0f %12.2f' % (name, n, report['fpsP50'] or 0,
+                      report['fpsP5'] or 0, 100 * report['lossRatio'], cpu, cpu / n))
+
+def check(args):
+    """The asserting checks, sized to run in seconds: RTSP parser fuzzing, then the seek
+    latency budget on each engine. Raises AssertionError on the first failure."""
+    benchRtsp(argparse.Namespace(requests=2000, rounds=5, seed=args.seed))
+    for engine in ('Server.py', 'AsyncServer.py'):
+        benchSeek(argparse.Namespace(engine=engine, frames=6000, frame_size=500, seeks=50,
+                                     budget=args.seek_budget))
+    print('all checks passed')
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming server benchmarks')
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = sub.add_parser('videostream', help='SETUP latency and RSS, eager cache vs mmap index')
+    p.add_argument('--frames', type=int, default=6000)
+    p.add_argument('--frame-size', type=int, default=15000)
+    p.add_argument('--sessions', type=int, default=8)
+    p.add_argument('--child', dest='mode', help=argparse.SUPPRESS)
+    p.add_argument('--movie', help=argparse.SUPPRESS)
+    p.set_defaults(func=lambda a: childVideoStream(a) if a.mode else benchVideoStream(a))
+
+    p = sub.add_parser('engines', help='sessions one core sustains, thread vs asyncio engine')
+    p.add_argument('--engines', default='thread,asyncio')
+    p.add_argument('--sessions', default='25,50,100,200,400')
+    p.add_argument('--duration', type=float, default=3.0)
+    p.add_argument('--frames', type=int, default=2000)
+    p.add_argument('--frame-size', type=int, default=5000)
+    p.add_argument('--cpu', type=int, default=0)
+    p.set_defaults(func=benchEngines)
+
+    p = sub.add_parser('workers', help='sessions sustained as SO_REUSEPORT worker processes are added')
+    p.add_argument('--workers', default='1,2,4')
+    p.add_argument('--sessions', default='50,100,200,400,800')
+    p.add_argument('--duration', type=float, default=3.0)
+    p.add_argument('--frames', type=int, default=2000)
+    p.add_argument('--frame-size', type=int, default=5000)
+    p.set_defaults(func=benchWorkers)
+
+    p = sub.add_parser('logging', help='per-packet log cost and server CPU with logging off/info/debug')
+    p.add_argument('--number', type=int, default=200000)
+    p.add_argument('--sessions', type=int, default=100)
+    p.add_argument('--duration', type=float, default=3.0)
+    p.add_argument('--frames', type=int, default=2000)
+    p.add_argument('--frame-size', type=int, default=5000)
+    p.add_argument('--cpu', type=int, default=0)
+    p.set_defaults(func=benchLogging)
+
+    p = sub.add_parser('seek', help='PLAY Range seek latency to the first frame at the new position')
+    p.add_argument('--engine', default='Server.py')
+    p.add_argument('--frames', type=int, default=72000)
+    p.add_argument('--frame-size', type=int, default=500)
+    p.add_argument('--seeks', type=int, default=200)
+    p.add_argument('--budget', type=float, default=100.0, help='p95 ms to the first frame allowed')
+    p.set_defaults(func=benchSeek)
+
+    p = sub.add_parser('egress', help='RTP packets/s and CPU per Gbit for each egress path')
+    p.add_argument('--sessions', type=int, default=64)
+    p.add_argument('--payload', type=int, default=1400)
+    p.add_argument('--rounds', type=int, default=2000)
+    p.set_defaults(func=benchEgress)
+
+    p = sub.add_parser('rtp', help='ns per packet for RTP header encode and decode')
+    p.add_argument('--payload', type=int, default=15000)
+    p.add_argument('--number', type=int, default=100000)
+    p.set_defaults(func=benchRtp)
+
+    p = sub.add_parser('jpeg', help='RFC 2435 fragmentation throughput and loss over loopback')
+    p.add_argument('--frames', type=int, default=2000)
+    p.add_argument('--frame-size', type=int, default=200000)
+    p.add_argument('--mtu', type=int, default=1500)
+    p.add_argument('--rate', type=float, default=0, help='frames per second, 0 for as fast as possible')
+    p.add_argument('--drop', type=float, default=0.0, help='fraction of packets dropped by the sender')
+    p.add_argument('--reorder', action='store_true', help='shuffle the fragments of each frame')
+    p.set_defaults(func=benchJpeg)
+
+    p = sub.add_parser('packetize', help='send-path CPU per packet, per-session vs pre-packetized frames')
+    p.add_argument('--sessions', type=int, default=64)
+    p.add_argument('--frame-size', type=int, default=15000)
+    p.add_argument('--rounds', type=int, default=200)
+    p.add_argument('--repeat', type=int, default=9)
+    p.set_defaults(func=benchPacketize)
+
+    p = sub.add_parser('rtsp', help='RTSP parser fuzzing and requests parsed per second')
+    p.add_argument('--requests', type=int, default=20000)
+    p.add_argument('--rounds', type=int, default=20)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=benchRtsp)
+
+    p = sub.add_parser('load', help='end-to-end fps, jitter, loss, seek latency and CPU with the load client')
+    p.add_argument('--engines', default='thread,asyncio')
+    p.add_argument('--sessions', default='10,50,100')
+    p.add_argument('--scenario', default='mixed', help='a scenario name from LoadClient.SCENARIOS')
+    p.add_argument('--duration', type=float, default=8.0)
+    p.add_argument('--frames', type=int, default=2400)
+    p.add_argument('--frame-size', type=int, default=5000)
+    p.add_argument('--cpu', type=int, default=0)
+    p.set_defaults(func=benchLoad)
+
+    p = sub.add_parser('fanout', help='server CPU per viewer: per-session streams vs live channels')
+    p.add_argument('--engine', default='AsyncServer.py')
+    p.add_argument('--modes', default='session,unicast,multicast')
+    p.add_argument('--sessions', default='10,50,100,200')
+    p.add_argument('--duration', type=float, default=6.0)
+    p.add_argument('--frames', type=int, default=2400)
+    p.add_argument('--frame-size', type=int, default=5000)
+    p.add_argument('--cpu', type=int, default=0)
+    p.set_defaults(func=benchFanout)
+
+    p = sub.add_parser('check', help='asserting checks, exit status 1 on failure: RTSP fuzzing, seek latency')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--seek-budget', type=float, default=100.0, help='p95 ms to the first frame after a seek')
+    p.set_defaults(func=check)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
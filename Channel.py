@@ -0,0 +1,214 @@
+"""Live channels: one sender whose packets fan out to every session watching.
+
+A session on a channel does not read or packetize media itself. The
+channel reads each frame once, RTP-packetizes it once on its own clock,
+and hands the same packets either to a multicast group or to the RTP
+address of every member, queued on the egress so that one flush
+carries them all. Read and encode cost per frame stay the same however
+many sessions watch.
+"""
+import socket, threading, time
+
+from RtpJpeg import JpegEncoder
+from RtpPacket import RtpClock
+from Log import getLogger
+
+log = getLogger('server')
+
+# Administratively scoped groups (RFC 2365) handed out one per multicast channel
+MULTICAST_PREFIX = '239.255.42.'
+MULTICAST_PORT = 50000
+# Hops multicast RTP may travel; 1 keeps it on the local network
+MULTICAST_TTL = 1
+# Multicast channels open at once; each takes an RTP/RTCP port pair from MULTICAST_PORT up
+MAX_GROUPS = (65535 - MULTICAST_PORT) // 2
+
+class Channel:
+    """One live stream of a media file, shared by every member session.
+
+    The channel plays on a wall clock from when it was opened and loops at
+    the end of the file. It is paced by the frame scheduler like a session
+    while it has members and taken off when the last one leaves; on the
+    next join it resumes where live time has got to, not where it stopped.
+    """
+
+    def __init__(self, name, videoStream, frameRate, egress, group=None):
+        self.name = name
+        self.videoStream = videoStream
+        self.frameRate = frameRate
+        self.egress = egress
+        # (address, port) of the multicast group, or None to unicast to each member
+        self.group = group
+        self.rtpClock = RtpClock()
+        self.rtpEncoder = JpegEncoder(pt=26, ssrc=self.rtpClock.ssrc, name=name)
+        self.rtpSeq = self.rtpClock.seq
+        self.slot = egress.assign()
+        self.lock = threading.Lock()
+        # Member session -> its RTP address; sessions is every session set up on the channel
+        self.members = {}
+        self.sessions = 0
+        # Copied on change, so the sender reads it without the lock
+        self.destinations = ()
+        self.started = time.monotonic()
+        # Frames of live time since the channel opened; npt is tick / frameRate
+        self.tick = 0
+        self.frames = 0
+        self.packets = 0
+
+    def mode(self):
+        return 'multicast' if self.group is not None else 'unicast'
+
+    def join(self, session, address):
+        """Start delivering to session at address. Return True if the channel was idle."""
+        with self.lock:
+            idle = not self.members
+            self.members[session] = address
+            self.destinations = tuple(self.members.items())
+            if idle:
+                self.catchUp()
+        return idle
+
+    def leave(self, session):
+        """Stop delivering to session. Return True if no member is left."""
+        with self.lock:
+            if self.members.pop(session, None) is None:
+                return False
+            self.destinations = tuple(self.members.items())
+            return not self.members
+
+    def catchUp(self):
+        """Move the cursor to the frame live time has reached."""
+        frames = len(self.videoStream.cache)
+        self.tick = int((time.monotonic() - self.started) * self.frameRate)
+        if frames:
+            self.videoStream.setFrame(self.tick % frames)
+
+    def playInfo(self, uri):
+        """Range and RTP-Info reply headers for the next frame the channel sends."""
+        npt = self.tick / self.frameRate
+        rtpInfo = 'url=%s;seq=%d;rtptime=%d' % (uri, self.rtpSeq, self.rtpClock.timestamp(npt))
+        return [('Range', 'npt=%.3f-' % npt), ('RTP-Info', rtpInfo)]
+
+    def sendFrame(self):
+        """Send the next frame to every member. Return False once none is left."""
+        destinations = self.destinations
+        if not destinations:
+            return False
+        vs = self.videoStream
+        data = vs.nextFrame()
+        if data is None:
+            # Live: loop to the start, with time still running forward
+            vs.setFrame(0)
+            data = vs.nextFrame()
+            if data is None:
+                return False
+        timestamp = self.rtpClock.timestamp(self.tick / self.frameRate)
+        self.tick += 1
+        try:
+            packets, self.rtpSeq = self.rtpEncoder.encodeFrame(data, self.rtpSeq, timestamp)
+            self.rtpSeq &= 0xFFFF
+            queue = self.egress.queue
+            slot = self.slot
+            size = 0
+            if self.group is not None:
+                for header, payload in packets:
+                    queue(slot, header, payload, self.group)
+                    size += len(header) + len(payload)
+                self.packets += len(packets)
+            else:
+                for header, payload in packets:
+                    for _, address in destinations:
+                        queue(slot, header, payload, address)
+                    size += len(header) + len(payload)
+                self.packets += len(packets) * len(destinations)
+        except Exception:
+            log.warning("Channel %s: send error", self.name, exc_info=True)
+            return False
+        self.frames += 1
+        for session, _ in destinations:
+            counters = session.counters
+            counters.frames += 1
+            counters.bytes += size
+        return True
+
+class ChannelRegistry:
+    """Server-wide live channels, one per media file and delivery mode.
+
+    A channel opens with the first session set up on it and closes, giving
+    its frames back to the frame store, when the last one tears down.
+    """
+
+    def __init__(self, frameStore, scheduler, egress, frameRate=None, shareUnicast=False,
+                 ttl=MULTICAST_TTL):
+        self.frameStore = frameStore
+        self.scheduler = scheduler
+        self.egress = egress
+        # Server-wide frame rate override, as for sessions
+        self.frameRate = frameRate
+        # Whether unicast sessions on a file share its channel too; multicast always does
+        self.shareUnicast = shareUnicast
+        self.lock = threading.Lock()
+        self.channels = {}
+        # Group slots handed out so far, and those given back by closed channels
+        self.groups = 0
+        self.freeGroups = []
+        self.ttl = ttl
+        for sock in egress.sockets:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+
+    def open(self, filename, multicast, defaultRate):
+        """Return the channel of filename, opening it if needed, or None if no
+        multicast group is free. Raises IOError."""
+        key = (filename, multicast)
+        with self.lock:
+            channel = self.channels.get(key)
+            if channel is None:
+                group = None
+                if multicast:
+                    if self.freeGroups:
+                        n = self.freeGroups.pop()
+                    elif self.groups < MAX_GROUPS:
+                        n = self.groups
+                        self.groups += 1
+                    else:
+                        return None
+                    group = (MULTICAST_PREFIX + str(n % 254 + 1), MULTICAST_PORT + 2 * n)
+                try:
+                    vs = self.frameStore.open(filename)
+                except IOError:
+                    if group is not None:
+                        self.freeGroups.append(n)
+                    raise
+                frameRate = self.frameRate or vs.frameRate() or defaultRate
+                channel = Channel(filename, vs, frameRate, self.egress, group)
+                self.channels[key] = channel
+                log.info("Channel %s opened, %s%s", filename, channel.mode(),
+                         ' to %s:%d' % group if group else '')
+            channel.sessions += 1
+        return channel
+
+    def close(self, channel):
+        """Drop one session's hold on channel; the last one closes it."""
+        with self.lock:
+            channel.sessions -= 1
+            if channel.sessions > 0:
+                return
+            self.channels.pop((channel.name, channel.group is not None), None)
+            if channel.group is not None:
+                self.freeGroups.append((channel.group[1] - MULTICAST_PORT) // 2)
+        self.frameStore.close(channel.videoStream)
+        log.info("Channel %s closed after %d frames", channel.name, channel.frames)
+
+    def join(self, channel, session, address):
+        """Deliver channel to session; the first member starts it."""
+        if channel.join(session, address):
+            self.scheduler.add(channel, channel.frameRate)
+
+    def leave(self, channel, session):
+        """Stop delivering channel to session; the last member stops it."""
+        if channel.leave(session):
+            self.scheduler.remove(channel)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.channels.values()))
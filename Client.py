@@ -1,12 +1,44 @@
 from tkinter import *
 import tkinter.messagebox as tkMessageBox
 from PIL import Image, ImageTk
-import socket, threading, os
+import io, socket, struct, threading, os, random, time
 
 from RtpPacket import RtpPacket
+from RtpJpeg import FrameAssembler
+from JitterBuffer import JitterBuffer
+from FrameSlot import FrameSlot
+from FrameCache import FrameCache
+from Telemetry import PlaybackTelemetry
+from RtspCodec import RtspParser, RtspError, encodeRequest
+from Log import getLogger, PacketLog
+from Rtcp import ReportBlock, encodeReceiverReport
 
 CACHE_FILE_NAME = "cache-"
 CACHE_FILE_EXT = ".jpg"
+# Largest datagram we accept; fragments are MTU-sized but this never truncates
+RTP_RECV_SIZE = 65536
+
+log = getLogger('client')
+# Per-packet receive events, rate limited and free when debug is off
+packetLog = PacketLog(log)
+# Seconds between RTCP receiver reports; well under RFC 3550's 5 s minimum
+# so the server's rate control reacts quickly, at one small packet a second
+RTCP_INTERVAL = 1.0
+# Assumed frame interval (s) until RTP timestamps tell us the stream rate
+DEFAULT_FRAME_INTERVAL = 0.05
+# Playback speeds offered in the GUI, sent as the PLAY Scale header
+SPEEDS = ('-1.0', '0.5', '1.0', '2.0', '4.0')
+# Frames one FORWARD or BACKWARD click moves, as on the server
+SEEK_FRAMES = 30
+# Memory for received frames kept for local replays and short seeks
+CACHE_BYTES = 64 * 1024 * 1024
+# Readahead, in seconds of playout buffered past the playhead: below LOW the
+# client asks the server to deliver at READAHEAD_SPEED, at TARGET back at 1x
+READAHEAD_LOW = 2.0
+READAHEAD_TARGET = 5.0
+READAHEAD_SPEED = 2.0
+# Seconds between QoE samples, each one row of the exported time series
+QOE_INTERVAL = 1.0
 
 class Client:
     INIT = 0
@@ -20,10 +52,17 @@ class Client:
     TEARDOWN = 3
     FORWARD = 4
     BACKWARD = 5
+    SEEK = 6
+    SCALE = 7
+    SPEED = 8
+    KEEPALIVE = 9
     
     # Initiation..
-    def __init__(self, master, serveraddr, serverport, rtpport, filename):
+    def __init__(self, master, serveraddr, serverport, rtpport, filename, cacheFrames=False,
+                 cacheBytes=CACHE_BYTES, multicast=False, qoeFile=None):
         self.master = master
+        # Debug aid: also write every frame to a cache-<session>.jpg file
+        self.cacheFrames = cacheFrames
         self.master.protocol("WM_DELETE_WINDOW", self.handler)
         self.createWidgets()
         self.serverAddr = serveraddr
@@ -33,10 +72,69 @@ class Client:
         self.rtspSeq = 0
         self.sessionId = 0
         self.requestSent = -1
+        # CSeq of the last reply that matched a request
+        self.ackedSeq = 0
+        # Session timeout (s) from the SETUP reply, and when a request last went out
+        self.sessionTimeout = None
+        self.lastRequest = time.monotonic()
         self.teardownAcked = 0
         self.connectToServer()
         self.frameNbr = 0
         self.rtpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Room for bursts of fragments from large frames
+        self.rtpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.assembler = FrameAssembler()
+        self.jitterBuffer = JitterBuffer()
+        # RTCP on the RTP port plus one
+        self.rtcpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Whether it got that port; the server only knows reports from there as this session's
+        self.rtcpBound = False
+        self.ssrc = random.getrandbits(32)
+        self.sourceSsrc = 0
+        self.serverRtcpPort = None
+        # Ask for multicast delivery; the group and port come in the SETUP reply
+        self.multicast = multicast
+        self.multicastGroup = None
+        # Position (s) the next PLAY asks for with a Range header
+        self.seekTarget = None
+        # Speed asked for, and the speed the server last confirmed
+        self.scaleTarget = 1.0
+        self.scale = 1.0
+        # Delivery speed for readahead, likewise
+        self.deliverySpeedTarget = 1.0
+        self.deliverySpeed = 1.0
+        # Set once the server declines a faster delivery, e.g. on a live channel
+        self.speedRefused = False
+        # Media seconds shown per second, measured at playout
+        self.effectiveRate = 0.0
+        self.lastPlayout = None
+        # Received frames by media position: timestamp ticks from the first
+        # frame's, unwrapped; nptOrigin is the RTP timestamp of npt 0
+        self.frameCache = FrameCache(cacheBytes)
+        self.tsBase = None
+        self.nptOrigin = None
+        # The playhead is at media position playheadPos at monotonic time
+        # playheadWall (None until it starts moving) and moves at self.scale.
+        # fillPosition is the newest position the server delivered.
+        self.presentCond = threading.Condition()
+        self.playheadPos = None
+        self.playheadWall = None
+        self.fillPosition = None
+        self.lastShown = None
+        self.stalled = False
+        self.stalls = 0
+        self.localSeeks = 0
+        # Decoded frames cross to the Tk thread only through this slot
+        self.frameSlot = FrameSlot()
+        self.frameInterval = DEFAULT_FRAME_INTERVAL
+        self.lastPosition = None
+        self.rendered = 0
+        # Quality of experience, sampled every QOE_INTERVAL and written to qoeFile on exit
+        self.telemetry = PlaybackTelemetry()
+        self.qoeFile = qoeFile
+        self.nextSample = None
+        self.lastArrivalTs = None
+        self.renderJob = self.master.after(int(self.frameInterval * 1000), self.renderTick)
         
     def createWidgets(self):
         """Build GUI."""
@@ -79,6 +177,30 @@ class Client:
         # Create a label to display the movie
         self.label = Label(self.master, height=19)
         self.label.grid(row=0, column=0, columnspan=6, sticky=W+E+N+S, padx=5, pady=5) 
+        
+        # Create a position entry and a Seek button
+        self.seekEntry = Entry(self.master, width=20)
+        self.seekEntry.grid(row=2, column=1, padx=2, pady=2)
+        self.seek = Button(self.master, width=20, padx=3, pady=3)
+        self.seek["text"] = "Seek (s)"
+        self.seek["command"] = self.seekFromEntry
+        self.seek.grid(row=2, column=2, padx=2, pady=2)
+        
+        # Create a playback speed menu and the effective rate display
+        self.speed = StringVar(self.master, '1.0')
+        self.speedMenu = OptionMenu(self.master, self.speed, *SPEEDS, command=self.changeSpeed)
+        self.speedMenu.grid(row=2, column=3, padx=2, pady=2)
+        self.rateLabel = Label(self.master, width=20)
+        self.rateLabel.grid(row=2, column=4, padx=2, pady=2)
+        self.rateText = None
+        
+        # Create the QoE overlay, drawn over the movie, and its toggle
+        self.showQoe = BooleanVar(self.master, False)
+        self.qoeToggle = Checkbutton(self.master, text="Stats", variable=self.showQoe,
+                                     command=self.toggleOverlay)
+        self.qoeToggle.grid(row=2, column=5, padx=2, pady=2)
+        self.overlay = Label(self.master, justify=LEFT, anchor=NW, font=('TkFixedFont', 9),
+                             bg='black', fg='white')
     
     def setupMovie(self):
         """Setup button handler."""
@@ -88,47 +210,163 @@ class Client:
     def exitClient(self):
         """Teardown button handler."""
         self.sendRtspRequest(self.TEARDOWN)		
+        self.master.after_cancel(self.renderJob)
+        log.info("Frames rendered: %(rendered)d, dropped by the GUI: %(dropped)d, "
+                 "seeks served from the frame cache: %(localSeeks)d, stalls: %(stalls)d", self.renderStats())
+        self.sampleQoe()
+        log.info("QoE: %s", self.telemetry.summary())
+        if self.qoeFile:
+            try:
+                self.telemetry.export(self.qoeFile)
+            except OSError:
+                log.warning("Could not write QoE samples to %s", self.qoeFile, exc_info=True)
         self.master.destroy() # Close the gui window
-        os.remove(CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT) # Delete the cache image from video
+        if self.cacheFrames:
+            cachename = CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT
+            if os.path.exists(cachename):
+                os.remove(cachename) # Delete the cache image from video
 
     def pauseMovie(self):
         """Pause button handler."""
         if self.state == self.PLAYING:
             self.sendRtspRequest(self.PAUSE)
+            with self.presentCond:
+                # Hold the playhead where it is; it restarts with the next PLAY
+                self.advancePlayhead()
+                self.playheadWall = None
+                # Paused is not stalled
+                if self.stalled:
+                    self.stalled = False
+                    self.telemetry.stallEnded()
     
     def playMovie(self):
         """Play button handler."""
         if self.state == self.READY:
             # Create a new thread to listen for RTP packets
             threading.Thread(target=self.listenRtp).start()
+            # and one to cache frames as their playout time comes
+            threading.Thread(target=self.playoutFrames).start()
             self.playEvent = threading.Event()
             self.playEvent.clear()
+            # and one to show them as the playhead reaches them
+            threading.Thread(target=self.presentFrames).start()
+            # and one to report reception back to the server
+            threading.Thread(target=self.sendReports).start()
             self.sendRtspRequest(self.PLAY)
    
     def backwardMovie(self):
         """Backward button handler."""
-        if self.state in [self.READY, self.PLAYING]:
+        if self.state in [self.READY, self.PLAYING] and not self.localSeek(-SEEK_FRAMES):
             self.sendRtspRequest(self.BACKWARD)
+            self.flushPlayout()
             
     def forwardMovie(self):
         """Forward button handler."""
-        if self.state in [self.READY, self.PLAYING]:
+        if self.state in [self.READY, self.PLAYING] and not self.localSeek(SEEK_FRAMES):
             self.sendRtspRequest(self.FORWARD)
+            self.flushPlayout()
+    
+    def seekFromEntry(self):
+        """Seek button handler."""
+        try:
+            seconds = float(self.seekEntry.get())
+        except ValueError:
+            tkMessageBox.showwarning('Invalid position', 'Enter a position in seconds')
+            return
+        self.seekMovie(max(0.0, seconds))
+    
+    def seekMovie(self, seconds):
+        """Jump to a position in seconds: from the frame cache when it holds that
+        position, else with one PLAY carrying a Range header."""
+        if self.nptOrigin is not None and self.state in [self.READY, self.PLAYING] \
+                and self.localSeekTo(self.nptPosition(seconds)):
+            return
+        self.seekTarget = seconds
+        if self.state == self.READY:
+            self.playMovie()
+        elif self.state == self.PLAYING:
+            self.sendRtspRequest(self.SEEK)
+            self.flushPlayout()
+    
+    def changeSpeed(self, value):
+        """Speed menu handler: play at value times normal speed, backwards if negative."""
+        self.scaleTarget = float(value)
+        if self.state == self.PLAYING:
+            # Have the server carry on from what is on screen, not from its readahead
+            if self.nptOrigin is not None and self.playheadPos is not None:
+                self.seekTarget = self.positionNpt(self.playheadPos)
+            self.sendRtspRequest(self.SCALE)
+    
+    def localSeek(self, frames):
+        """Move the playhead by frames from the frame cache. Return False when the
+        cache cannot serve the move and the server has to."""
+        with self.presentCond:
+            if self.playheadPos is None:
+                return False
+            self.advancePlayhead()
+            current = self.playheadPos
+        # Media ticks per frame, from the playout interval
+        ticks = self.frameInterval * abs(self.scale) * self.jitterBuffer.clockRate
+        return self.localSeekTo(current + frames * ticks)
+    
+    def localSeekTo(self, position):
+        """Put the playhead on the cached frame nearest position, if there is one close
+        by that the server has already delivered. Return whether it did."""
+        ticks = self.frameInterval * abs(self.scale) * self.jitterBuffer.clockRate
+        found = self.frameCache.nearest(position, 2 * ticks)
+        with self.presentCond:
+            if found is None or self.fillPosition is None \
+                    or (found - self.fillPosition) * self.scale > 0:
+                return False
+            self.playheadPos = found
+            self.playheadWall = None if self.state != self.PLAYING else time.monotonic()
+            self.lastShown = None
+            self.presentCond.notify()
+        self.localSeeks += 1
+        log.info("Seek served from the frame cache")
+        if self.state != self.PLAYING:
+            # Paused: show the frame straight away
+            data = self.frameCache.get(found)
+            if data is not None:
+                self.lastShown = found
+                self.presentFrame(found, data)
+        return True
+    
+    def flushPlayout(self):
+        """Forget queued and undisplayed frames, and find the playhead again from the
+        next frame received, after a seek the server serves."""
+        self.jitterBuffer.reset()
+        self.frameSlot.clear()
+        self.lastPosition = None
+        with self.presentCond:
+            self.playheadPos = None
+            self.lastShown = None
     
     def listenRtp(self):		
         """Listen for RTP packets."""
         while True:
             try:
-                data = self.rtpSocket.recv(20480)
+                data = self.rtpSocket.recv(RTP_RECV_SIZE)
                 if data:
                     rtpPacket = RtpPacket()
                     rtpPacket.decode(data)
                     
+                    self.sourceSsrc = rtpPacket.ssrc()
                     currFrameNbr = rtpPacket.seqNum()
-                    print("Current Seq Num: " + str(currFrameNbr))
-                                  
-                    self.frameNbr = currFrameNbr      
-                    self.updateMovie(self.writeFrame(rtpPacket.getPayload()))
+                    if packetLog.enabled:
+                        packetLog.debug("Current Seq Num: %d", currFrameNbr)
+                    timestamp = rtpPacket.timestamp()
+                    self.jitterBuffer.notePacket(currFrameNbr, timestamp)
+                    if timestamp != self.lastArrivalTs:
+                        # First packet of a frame: its end-to-end latency starts here
+                        self.lastArrivalTs = timestamp
+                        self.telemetry.frameArrived(self.position(timestamp), time.monotonic())
+                    
+                    # Queue a frame for playout once all of its fragments are in
+                    frame = self.assembler.feed(rtpPacket)
+                    if frame is not None:
+                        timestamp, firstSeq, data = frame
+                        self.jitterBuffer.put(firstSeq, timestamp, data)
             except:
                 # Stop listening upon requesting PAUSE or TEARDOWN
                 if self.playEvent.isSet(): 
@@ -141,6 +379,102 @@ class Client:
                     self.rtpSocket.close()
                     break
                     
+    def sendReports(self):
+        """Send an RTCP receiver report every RTCP_INTERVAL while playing."""
+        while not self.playEvent.wait(RTCP_INTERVAL) and self.teardownAcked == 0:
+            if self.serverRtcpPort is None:
+                continue
+            fraction, lost, highest, jitter = self.jitterBuffer.receptionReport()
+            report = encodeReceiverReport(self.ssrc,
+                [ReportBlock(self.sourceSsrc, fraction, lost, highest, jitter)])
+            try:
+                self.rtcpSocket.sendto(report, (self.serverAddr, self.serverRtcpPort))
+            except OSError:
+                log.warning("Could not send RTCP receiver report", exc_info=True)
+                
+    def playoutFrames(self):
+        """Move frames from the jitter buffer into the frame cache at their playout time."""
+        while True:
+            frame = self.jitterBuffer.get(timeout=0.5)
+            if frame is not None:
+                position = self.position(frame[1])
+                self.frameCache.put(position, frame[2])
+                with self.presentCond:
+                    self.fillPosition = position
+                    if self.playheadPos is None:
+                        # First frame since a seek: the playhead starts here
+                        self.playheadPos, self.playheadWall = position, None
+                    self.presentCond.notify()
+            # Stop upon requesting PAUSE or TEARDOWN
+            elif self.playEvent.isSet() or self.teardownAcked == 1:
+                break
+    
+    def presentFrames(self):
+        """Decode the cached frame under the playhead as it moves and hand it to the GUI."""
+        while not (self.playEvent.isSet() or self.teardownAcked == 1):
+            with self.presentCond:
+                self.presentCond.wait(self.frameInterval / 2)
+                target = self.advancePlayhead()
+                last = self.lastShown
+            if target is None:
+                continue
+            position = self.frameCache.step(last, target, self.scale > 0)
+            if position is None:
+                continue
+            data = self.frameCache.get(position)
+            # Evicted in the meantime
+            if data is None:
+                continue
+            self.lastShown = position
+            self.frameNbr += 1
+            self.trackFrameRate(position)
+            self.presentFrame(position, data)
+    
+    def advancePlayhead(self):
+        """Move the playhead to now and return its position, or None before the first
+        frame. It never passes the newest frame delivered; there it stalls.
+        Call with presentCond held."""
+        if self.playheadPos is None:
+            return None
+        now = time.monotonic()
+        if self.playheadWall is None:
+            # Starting or resuming: the clock runs from here
+            self.playheadWall = now
+        position = self.playheadPos + (now - self.playheadWall) * self.jitterBuffer.clockRate * self.scale
+        if self.fillPosition is not None and (position - self.fillPosition) * self.scale > 0:
+            if not self.stalled:
+                self.stalls += 1
+                self.stalled = True
+                self.telemetry.stallStarted()
+            position = self.fillPosition
+        elif self.stalled:
+            self.stalled = False
+            self.telemetry.stallEnded()
+        self.playheadPos, self.playheadWall = position, now
+        return position
+    
+    def position(self, timestamp):
+        """Media position of an RTP timestamp: ticks from the first frame's, unwrapped."""
+        if self.tsBase is None:
+            self.tsBase = timestamp
+        return ((timestamp - self.tsBase + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+    
+    def nptPosition(self, seconds):
+        """Media position of npt seconds; needs nptOrigin."""
+        return self.position((self.nptOrigin + int(seconds * self.jitterBuffer.clockRate)) & 0xFFFFFFFF)
+    
+    def positionNpt(self, position):
+        """npt seconds of a media position; needs nptOrigin."""
+        return max(0.0, (position - self.position(self.nptOrigin)) / self.jitterBuffer.clockRate)
+    
+    def readahead(self):
+        """Seconds of playout delivered past the playhead, or None before playback."""
+        with self.presentCond:
+            if self.playheadPos is None or self.fillPosition is None:
+                return None
+            ahead = (self.fillPosition - self.playheadPos) / (self.jitterBuffer.clockRate * self.scale)
+        return max(0.0, ahead)
+                    
     def writeFrame(self, data):
         """Write the received frame to a temp image file. Return the image file."""
         cachename = CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT
@@ -150,9 +484,130 @@ class Client:
         
         return cachename
     
-    def updateMovie(self, imageFile):
-        """Update the image file as video frame in the GUI."""
-        photo = ImageTk.PhotoImage(Image.open(imageFile))
+    def trackFrameRate(self, position):
+        """Follow the stream's frame interval and the effective playback rate from
+        the media positions of consecutive frames shown."""
+        now = time.monotonic()
+        if self.lastPosition is not None:
+            # Positions fall when playing backwards
+            media = (position - self.lastPosition) / self.jitterBuffer.clockRate
+            interval = media / self.scale
+            # Ignore seeks and skipped frames; smooth over the rest
+            if 0 < interval < 1:
+                self.frameInterval += (interval - self.frameInterval) / 8
+                wall = now - self.lastPlayout
+                if wall > 0:
+                    self.effectiveRate += (media / wall - self.effectiveRate) / 16
+        self.lastPosition = position
+        self.lastPlayout = now
+    
+    def presentFrame(self, position, data):
+        """Decode the frame at position and hand it to the GUI with its decode time."""
+        start = time.perf_counter()
+        image = self.decodeFrame(data)
+        self.frameSlot.publish((image, position, time.perf_counter() - start))
+    
+    def decodeFrame(self, data):
+        """Decode a received JPEG straight from memory. Return the loaded PIL image."""
+        if self.cacheFrames:
+            image = Image.open(self.writeFrame(data))
+        else:
+            image = Image.open(io.BytesIO(data))
+        # Decode here, on the playout thread, rather than lazily in Tk
+        image.load()
+        return image
+    
+    def renderTick(self):
+        """Show the newest decoded frame, if any. Runs on the Tk thread via after()."""
+        frame = self.frameSlot.take()
+        if frame is not None:
+            image, position, decodeTime = frame
+            start = time.perf_counter()
+            # Tk objects are only ever created and touched on this thread
+            self.updateMovie(ImageTk.PhotoImage(image))
+            self.rendered += 1
+            self.telemetry.frameShown(position, decodeTime, time.perf_counter() - start)
+        self.showRate()
+        self.manageReadahead()
+        self.keepAlive()
+        if self.nextSample is not None and time.monotonic() >= self.nextSample:
+            self.sampleQoe()
+        # Poll at twice the stream rate so a frame waits at most half an interval
+        self.renderJob = self.master.after(max(1, int(self.frameInterval * 500)), self.renderTick)
+    
+    def showRate(self):
+        """Show the confirmed speed and the measured playback rate. Tk thread only."""
+        if self.state == self.PLAYING:
+            text = '%gx, playing at %.2fx, %.1f s ahead' % (self.scale, self.effectiveRate,
+                                                             self.readahead() or 0.0)
+        else:
+            text = '%gx' % self.scaleTarget
+        if text != self.rateText:
+            self.rateLabel.configure(text=text)
+            self.rateText = text
+    
+    def manageReadahead(self):
+        """Have the server deliver faster than real time while the readahead is short,
+        and at 1x again once it is long or the frame cache is nearly full. Tk thread only."""
+        # One request in flight at a time: replies only match the latest CSeq
+        if self.state != self.PLAYING or self.ackedSeq != self.rtspSeq or self.speedRefused:
+            return
+        ahead = self.readahead()
+        if ahead is None:
+            return
+        full = ahead >= READAHEAD_TARGET or self.frameCache.size >= self.frameCache.budget * 0.9
+        if self.deliverySpeed == 1.0 and ahead < READAHEAD_LOW and not full:
+            self.deliverySpeedTarget = READAHEAD_SPEED
+        elif self.deliverySpeed > 1.0 and full:
+            self.deliverySpeedTarget = 1.0
+        else:
+            return
+        self.sendRtspRequest(self.SPEED)
+    
+    def keepAlive(self):
+        """While paused, send GET_PARAMETER often enough that the server does not
+        expire the session; while playing, RTCP reports keep it alive, unless they
+        cannot come from the RTP port plus one. Tk thread only."""
+        if self.sessionTimeout is None or self.ackedSeq != self.rtspSeq:
+            return
+        if self.state != self.READY and not (self.state == self.PLAYING and not self.rtcpBound):
+            return
+        if time.monotonic() - self.lastRequest >= self.sessionTimeout / 2:
+            self.sendRtspRequest(self.KEEPALIVE)
+    
+    def sampleQoe(self):
+        """Add a row to the QoE time series and refresh the overlay. Tk thread only."""
+        if self.nextSample is None:
+            return
+        self.nextSample = time.monotonic() + QOE_INTERVAL
+        row = self.telemetry.sample(self.jitterBuffer.received, self.jitterBuffer.lost())
+        if self.showQoe.get():
+            startup = self.telemetry.startup
+            self.overlay.configure(text='\n'.join([
+                'startup  %s' % ('%.2f s' % startup if startup is not None else '-'),
+                'fps      %.1f' % row['fps'],
+                'latency  %.0f ms, p95 %.0f ms' % (row['latencyMs'], row['latencyMsP95']),
+                'decode   %.1f ms, render %.1f ms' % (row['decodeMs'], row['renderMs']),
+                'loss     %.1f%% (%d lost)' % (100 * row['lossRatio'], row['lost']),
+                'stalls   %d, %.1f s' % (row['stalls'], row['stallSeconds'])]))
+    
+    def toggleOverlay(self):
+        """Stats checkbox handler: show or hide the QoE overlay."""
+        if self.showQoe.get():
+            self.overlay.place(in_=self.label, x=4, y=4)
+            self.overlay.lift()
+            self.overlay.configure(text='collecting...')
+        else:
+            self.overlay.place_forget()
+    
+    def renderStats(self):
+        """Frames shown, frames decoded but replaced before the GUI got to them,
+        seeks served from the frame cache and playout stalls."""
+        return {'rendered': self.rendered, 'dropped': self.frameSlot.dropped,
+                'localSeeks': self.localSeeks, 'stalls': self.stalls}
+    
+    def updateMovie(self, photo):
+        """Show a decoded frame in the GUI. Must be called on the Tk thread."""
         self.label.configure(image = photo, height=288) 
         self.label.image = photo
         
@@ -171,61 +626,128 @@ class Client:
         if requestCode == self.SETUP and self.state == self.INIT:
             threading.Thread(target=self.recvRtspReply).start()
             self.rtspSeq = 1
+            self.telemetry.setupStarted()
+            self.nextSample = time.monotonic() + QOE_INTERVAL
 
-            request = "SETUP " + str(self.fileName) + "\n " + str(self.rtspSeq) + " \n RTSP/1.0 RTP/UDP " + str(self.rtpPort)
+            request = encodeRequest("SETUP", self.fileName, self.rtspSeq,
+                [("Transport", "RTP/AVP;%s;client_port=%d-%d" % ('multicast' if self.multicast else 'unicast',
+                                                                  self.rtpPort, self.rtpPort + 1))])
 
-            self.rtspSocket.send(request.encode())
+            self.rtspSocket.sendall(request)
             self.requestSent = self.SETUP
         
         # Play request
         elif requestCode == self.PLAY and self.state == self.READY:
             self.rtspSeq = self.rtspSeq + 1
-            request = "PLAY " + "\n " + str(self.rtspSeq)
-            self.rtspSocket.send(request.encode("utf-8"))
-            print ('-'*60 + "\nPLAY request sent to Server...\n" + '-'*60)
+            request = self.makeRequest("PLAY", self.rangeHeader() + self.scaleHeader() + self.speedHeader())
+            self.rtspSocket.sendall(request)
+            self.telemetry.playStarted()
+            log.info("PLAY request sent to Server")
             self.requestSent = self.PLAY
         
+        # Seek while playing: PLAY with a Range header
+        elif requestCode == self.SEEK and self.state == self.PLAYING:
+            self.rtspSeq = self.rtspSeq + 1
+            request = self.makeRequest("PLAY", self.rangeHeader() + self.scaleHeader() + self.speedHeader())
+            self.rtspSocket.sendall(request)
+            log.info("PLAY (seek) request sent to Server")
+            self.requestSent = self.SEEK
+        
+        # Speed change while playing: PLAY with a Scale header, from the playhead
+        elif requestCode == self.SCALE and self.state == self.PLAYING:
+            self.rtspSeq = self.rtspSeq + 1
+            request = self.makeRequest("PLAY", self.rangeHeader() + self.scaleHeader() + self.speedHeader())
+            self.rtspSocket.sendall(request)
+            log.info("PLAY (scale %g) request sent to Server", self.scaleTarget)
+            self.requestSent = self.SCALE
+        
+        # Readahead: PLAY with a Speed header changes the delivery rate only
+        elif requestCode == self.SPEED and self.state == self.PLAYING:
+            self.rtspSeq = self.rtspSeq + 1
+            request = self.makeRequest("PLAY", self.scaleHeader() + self.speedHeader())
+            self.rtspSocket.sendall(request)
+            log.debug("PLAY (speed %g) request sent to Server", self.deliverySpeedTarget)
+            self.requestSent = self.SPEED
+        
         # Pause request
         elif requestCode == self.PAUSE and self.state == self.PLAYING:
             self.rtspSeq = self.rtspSeq + 1
-            request = "PAUSE " + "\n " + str(self.rtspSeq)
-            self.rtspSocket.send(request.encode("utf-8"))
-            print ('-'*60 + "\nPAUSE request sent to Server...\n" + '-'*60)
+            request = self.makeRequest("PAUSE")
+            self.rtspSocket.sendall(request)
+            log.info("PAUSE request sent to Server")
             self.requestSent = self.PAUSE
             
         elif requestCode == self.BACKWARD and self.state in [self.READY, self.PLAYING]:
             self.rtspSeq = self.rtspSeq + 1
-            request = "BACKWARD " + "\n " + str(self.rtspSeq)
-            self.rtspSocket.send(request.encode("utf-8"))
-            print ('-'*60 + "\nBACKWARD request sent to Server...\n" + '-'*60)
+            request = self.makeRequest("BACKWARD")
+            self.rtspSocket.sendall(request)
+            log.info("BACKWARD request sent to Server")
             self.requestSent = self.BACKWARD
             
         elif requestCode == self.FORWARD and self.state in [self.READY, self.PLAYING]:
             self.rtspSeq = self.rtspSeq + 1
-            request = "FORWARD " + "\n " + str(self.rtspSeq)
-            self.rtspSocket.send(request.encode("utf-8"))
-            print ('-'*60 + "\nFORWARD request sent to Server...\n" + '-'*60)
+            request = self.makeRequest("FORWARD")
+            self.rtspSocket.sendall(request)
+            log.info("FORWARD request sent to Server")
             self.requestSent = self.FORWARD
             
+        # Keepalive: an empty GET_PARAMETER
+        elif requestCode == self.KEEPALIVE and self.state != self.INIT:
+            self.rtspSeq = self.rtspSeq + 1
+            request = self.makeRequest("GET_PARAMETER")
+            self.rtspSocket.sendall(request)
+            log.debug("GET_PARAMETER keepalive sent to Server")
+            self.requestSent = self.KEEPALIVE
+            
         # Teardown request
         elif requestCode == self.TEARDOWN and not self.state == self.INIT:
             self.rtspSeq = self.rtspSeq + 1
-            request = "TEARDOWN " + "\n " + str(self.rtspSeq)
-            self.rtspSocket.send(request.encode("utf-8"))
-            print ('-'*60 + "\nTEARDOWN request sent to Server...\n" + '-'*60)
+            request = self.makeRequest("TEARDOWN")
+            self.rtspSocket.sendall(request)
+            log.info("TEARDOWN request sent to Server")
             self.requestSent = self.TEARDOWN
         else:
             return
-                
-        print('\nData sent:\n' + request)
+        
+        self.lastRequest = time.monotonic()
+        log.debug("Data sent:\n%s", request.decode("utf-8"))
+    
+    def makeRequest(self, method, headers=()):
+        """Encode a request within the current session."""
+        return encodeRequest(method, self.fileName, self.rtspSeq, [("Session", self.sessionId)] + list(headers))
+    
+    def rangeHeader(self):
+        """Range header for a pending seek, consuming it."""
+        if self.seekTarget is None:
+            return []
+        seconds, self.seekTarget = self.seekTarget, None
+        return [("Range", "npt=%.3f-" % seconds)]
+    
+    def scaleHeader(self):
+        """Scale header for the requested speed; none means normal speed."""
+        if self.scaleTarget == 1.0:
+            return []
+        return [("Scale", "%g" % self.scaleTarget)]
+    
+    def speedHeader(self):
+        """Speed header for the requested delivery speed; none means real time."""
+        if self.deliverySpeedTarget == 1.0:
+            return []
+        return [("Speed", "%g" % self.deliverySpeedTarget)]
     
     def recvRtspReply(self):
         """Receive RTSP reply from the server."""
+        parser = RtspParser()
         while True:
-            reply = self.rtspSocket.recv(1024)
+            data = self.rtspSocket.recv(4096)
+            if not data:
+                # Server closed the connection
+                self.rtspSocket.close()
+                break
             
-            if reply: 
-                self.parseRtspReply(reply.decode("utf-8"))
+            # A read may hold several replies, or only part of one
+            for reply in parser.feed(data):
+                self.parseRtspReply(reply)
             
             # Close the RTSP socket upon requesting Teardown
             if self.requestSent == self.TEARDOWN:
@@ -233,30 +755,61 @@ class Client:
                 self.rtspSocket.close()
                 break
     
-    def parseRtspReply(self, data):
-        """Parse the RTSP reply from the server."""
-        lines = data.split('\n')
-        seqNum = int(lines[1].split(' ')[1])
+    def parseRtspReply(self, reply):
+        """Parse the RTSP reply (an RtspMessage) from the server."""
+        seqNum = reply.cseq()
         
         # Process only if the server reply's sequence number is the same as the request's
         if seqNum == self.rtspSeq:
-            session = int(lines[2].split(' ')[1])
+            self.ackedSeq = seqNum
+            if reply.code != 200:
+                log.warning("RTSP error: %d %s", reply.code, reply.reason)
+                return
+            session = int(reply.session())
             # New RTSP session ID
             if self.sessionId == 0:
                 self.sessionId = session
             
             # Process only if the session ID is the same
             if self.sessionId == session:
-                if int(lines[0].split(' ')[1]) == 200: 
+                if reply.code == 200: 
                     if self.requestSent == self.SETUP:
-                        print ("Updating RTSP state...")
+                        log.info("Updating RTSP state...")
+                        transport = reply.transport()
+                        if transport and 'server_port' in transport:
+                            # Where to send RTCP receiver reports
+                            self.serverRtcpPort = transport['server_port'][-1]
+                        if transport and 'destination' in transport and 'port' in transport:
+                            # RTP comes to a multicast group shared with other viewers
+                            self.multicastGroup = (transport['destination'], transport['port'][0])
+                        for param in reply.header('Session', '').split(';')[1:]:
+                            name, _, value = param.strip().partition('=')
+                            if name == 'timeout' and value.isdigit():
+                                self.sessionTimeout = int(value)
                         self.state = self.READY
-                        print ("Setting Up RtpPort for Video Stream")
+                        log.info("Setting Up RtpPort for Video Stream")
                         self.openRtpPort() 
 
                     elif self.requestSent == self.PLAY:
                         self.state = self.PLAYING
-                        print ('-'*60 + "\nClient is PLAYING...\n" + '-'*60)
+                        self.confirmPlay(reply)
+                        log.info("Client is PLAYING")
+
+                    elif self.requestSent == self.SEEK:
+                        self.confirmPlay(reply, seeked=True)
+                        log.info("Playing from %s", reply.header('Range'))
+
+                    elif self.requestSent == self.SCALE:
+                        self.confirmPlay(reply, seeked=self.nptOrigin is not None)
+                        log.info("Playing at %gx", self.scale)
+
+                    elif self.requestSent == self.SPEED:
+                        self.confirmPlay(reply)
+
+                    elif self.requestSent in [self.FORWARD, self.BACKWARD]:
+                        # Frames sent before the server moved are stale; find the
+                        # playhead again from the first one after
+                        self.flushPlayout()
 
                     elif self.requestSent == self.PAUSE:
                         self.state = self.READY
@@ -268,16 +821,74 @@ class Client:
                         # Flag the teardownAcked to close the socket.
                         self.teardownAcked = 1 
     
+    def confirmPlay(self, reply, seeked=False):
+        """Take the scale and speed the server granted in a PLAY reply, which may differ
+        from the ones asked for, and the media time of its RTP timestamps. After a seek,
+        the playhead restarts at the position the reply names."""
+        try:
+            scale = float(reply.header('Scale', 1.0))
+            speed = float(reply.header('Speed', 1.0))
+        except ValueError:
+            scale, speed = self.scale, self.deliverySpeed
+        if self.requestSent == self.SPEED and speed < self.deliverySpeedTarget:
+            # The server only delivers in real time; stop asking
+            self.speedRefused = True
+            self.deliverySpeedTarget = speed
+        rtptime = None
+        try:
+            playRange = reply.range()
+            for field in reply.header('RTP-Info', '').split(';'):
+                if field.strip().startswith('rtptime='):
+                    rtptime = int(field.split('=', 1)[1])
+        except (RtspError, ValueError):
+            playRange = None
+        if playRange is not None and rtptime is not None:
+            # RTP timestamps follow media time, so one pair fixes the mapping
+            self.nptOrigin = (rtptime - int(playRange[0] * self.jitterBuffer.clockRate)) & 0xFFFFFFFF
+        with self.presentCond:
+            # The playhead moved at the old scale until now
+            self.advancePlayhead()
+            self.scale, self.deliverySpeed = scale, speed
+            if seeked and rtptime is not None:
+                self.jitterBuffer.reset()
+                self.playheadPos = self.fillPosition = self.position(rtptime)
+                self.playheadWall = None
+                self.lastShown = None
+        # Frames arrive at scale times the delivery speed; the playhead shows them at scale
+        self.jitterBuffer.setScale(scale * speed)
+    
     def openRtpPort(self):
         """Open RTP socket binded to a specified port."""
         self.rtpSocket.settimeout(0.5)
         
+        if self.multicastGroup is not None:
+            self.joinGroup(*self.multicastGroup)
+        else:
+            try:
+                self.rtpSocket.bind((self.serverAddr,self.rtpPort))   
+                #self.rtpSocket.listen(5)
+                log.info("Bind RtpPort Success")
+            except:
+                tkMessageBox.showwarning('Unable to Bind', 'Unable to bind PORT=%d' %self.rtpPort)
+        
         try:
-            self.rtpSocket.bind((self.serverAddr,self.rtpPort))   
-            #self.rtpSocket.listen(5)
-            print ("Bind RtpPort Success")
-        except:
-            tkMessageBox.showwarning('Unable to Bind', 'Unable to bind PORT=%d' %self.rtpPort)
+            self.rtcpSocket.bind(('', self.rtpPort + 1))
+            self.rtcpBound = True
+        except OSError:
+            # Reports still go out, but the server cannot tell they are ours: keep
+            # the session alive with GET_PARAMETER while playing too
+            log.warning("Unable to bind RTCP port %d", self.rtpPort + 1)
+
+    def joinGroup(self, group, port):
+        """Receive RTP from a multicast group, next to other viewers on this host."""
+        try:
+            self.rtpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.rtpSocket.bind(('', port))
+            membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+            self.rtpSocket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            log.info("Joined multicast group %s:%d", group, port)
+        except OSError:
+            tkMessageBox.showwarning('Unable to Join', 'Unable to join %s:%d' % (group, port))
 
     def handler(self):
         """Handler on explicitly closing the GUI window."""
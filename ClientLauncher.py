@@ -1,6 +1,7 @@
 import sys
 from tkinter import Tk
-from Client import Client
+from Client import Client, CACHE_BYTES
+from Log import setupLogging, stopLogging
 
 if __name__ == "__main__":
 	try:
@@ -9,12 +10,30 @@ if __name__ == "__main__":
 		rtpPort = sys.argv[3]
 		fileName = sys.argv[4]	
 	except:
-		print("[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file]\n")	
+		print("[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file [--cache-frames] [--log-level Level] [--cache-mb MB] [--multicast] [--qoe FILE.csv|FILE.json]]\n")	
+	# Debug mode: keep writing each frame to a cache-<session>.jpg file
+	cacheFrames = '--cache-frames' in sys.argv[5:]
+	# off, error, warning, info or debug
+	logLevel = 'info'
+	if '--log-level' in sys.argv[5:]:
+		logLevel = sys.argv[sys.argv.index('--log-level') + 1]
+	setupLogging(logLevel)
+	# Memory for received frames kept for local replays and short seeks
+	cacheBytes = CACHE_BYTES
+	if '--cache-mb' in sys.argv[5:]:
+		cacheBytes = int(float(sys.argv[sys.argv.index('--cache-mb') + 1]) * 1024 * 1024)
+	# Watch the file's live channel over multicast instead of a stream of its own
+	multicast = '--multicast' in sys.argv[5:]
+	# Where to write the session's QoE time series on teardown
+	qoeFile = None
+	if '--qoe' in sys.argv[5:]:
+		qoeFile = sys.argv[sys.argv.index('--qoe') + 1]
 	
 	root = Tk()
 	
 	# Create a new client
-	app = Client(root, serverAddr, serverPort, rtpPort, fileName)
+	app = Client(root, serverAddr, serverPort, rtpPort, fileName, cacheFrames, cacheBytes, multicast, qoeFile)
 	app.master.title("RTPClient")	
 	root.mainloop()
+	stopLogging()
 	
\ No newline at end of file
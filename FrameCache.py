@@ -0,0 +1,80 @@
+"""Client-side cache of received frames for local replays and short seeks."""
+import bisect, threading
+from collections import OrderedDict
+
+class FrameCache:
+    """Memory-capped LRU cache of encoded frames keyed by media position.
+
+    Positions are RTP timestamp ticks on one unwrapped axis, so the frames
+    of a session sort in media order whatever order they arrived in. When
+    the cached bytes go over budget, the least recently stored or shown
+    frames are evicted first. Safe to share between threads.
+    """
+
+    def __init__(self, budget=64 * 1024 * 1024):
+        self.budget = budget
+        self.lock = threading.Lock()
+        # position -> frame, least recently used first
+        self.frames = OrderedDict()
+        self.positions = []
+        self.size = 0
+        self.hits = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, position, data):
+        with self.lock:
+            old = self.frames.pop(position, None)
+            if old is None:
+                bisect.insort(self.positions, position)
+            else:
+                self.size -= len(old)
+            self.frames[position] = data
+            self.size += len(data)
+            while self.size > self.budget and len(self.frames) > 1:
+                gone, frame = self.frames.popitem(last=False)
+                del self.positions[bisect.bisect_left(self.positions, gone)]
+                self.size -= len(frame)
+                self.evicted += 1
+
+    def get(self, position):
+        """Return the frame at position, or None, marking it recently used."""
+        with self.lock:
+            data = self.frames.get(position)
+            if data is not None:
+                self.frames.move_to_end(position)
+                self.hits += 1
+            return data
+
+    def nearest(self, position, tolerance):
+        """Return the cached position closest to position, if within tolerance, else None."""
+        with self.lock:
+            i = bisect.bisect_left(self.positions, position)
+            candidates = self.positions[max(0, i - 1):i + 1]
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda p: abs(p - position))
+        return best if abs(best - position) <= tolerance else None
+
+    def step(self, last, target, forward=True):
+        """Return the cached position nearest target on the way from last (exclusive,
+        None for anywhere) to target (inclusive), or None if there is none."""
+        with self.lock:
+            positions = self.positions
+            if forward:
+                i = bisect.bisect_right(positions, target) - 1
+                if i >= 0 and (last is None or positions[i] > last):
+                    return positions[i]
+            else:
+                i = bisect.bisect_left(positions, target)
+                if i < len(positions) and (last is None or positions[i] < last):
+                    return positions[i]
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.positions = []
+            self.size = 0
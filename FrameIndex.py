@@ -0,0 +1,162 @@
+"""Frame index of <5-digit length><frame> MJPEG files, with an on-disk sidecar.
+
+Usage: FrameIndex.py Media_dir_or_file [...] [--rate FPS] [--ext .Mjpeg]
+
+Writes a <media>.idx sidecar next to every media file so a server can
+start serving it without scanning.
+"""
+import argparse, bisect, mmap, os, struct, sys
+from array import array
+
+LENGTH_SIZE = 5
+SIDECAR_EXT = '.idx'
+DEFAULT_FRAME_RATE = 20.0
+
+# magic, version, byte order, media size, media mtime_ns, frame count, reserved, frame rate
+HEADER = struct.Struct('=4sHHQqIId')
+MAGIC = b'MJIX'
+VERSION = 1
+BYTE_ORDER = 1 if sys.byteorder == 'little' else 2
+
+class FrameIndex:
+    """Offsets, sizes and keyframe/time marks of the frames in a media file.
+
+    The per-frame tables are either arrays built by scan() or memoryviews
+    straight over a mapped sidecar, so loading an index costs the same for
+    any file length.
+    """
+
+    def __init__(self, offsets, sizes, times, keys, frameRate=DEFAULT_FRAME_RATE):
+        self.offsets = offsets
+        # Frame sizes in bytes
+        self.sizes = sizes
+        # Presentation time of each frame in milliseconds
+        self.times = times
+        # 1 where the frame starts with a JPEG SOI marker and can be decoded on its own
+        self.keys = keys
+        self.frameRate = frameRate
+
+    @classmethod
+    def scan(cls, data, frameRate=DEFAULT_FRAME_RATE):
+        """Walk the length prefixes of a mapped media file once."""
+        offsets = array('Q')
+        sizes = array('I')
+        times = array('I')
+        keys = array('B')
+        pos = 0
+        end = len(data)
+        while pos + LENGTH_SIZE <= end:
+            size = int(data[pos:pos + LENGTH_SIZE])
+            pos += LENGTH_SIZE
+            # A truncated last frame is kept, like the eager cache does
+            size = min(size, end - pos)
+            offsets.append(pos)
+            sizes.append(size)
+            times.append(int(len(times) * 1000 / frameRate))
+            keys.append(data[pos:pos + 2] == b'\xff\xd8')
+            pos += size
+        return cls(offsets, sizes, times, keys, frameRate)
+
+    @classmethod
+    def load(cls, path, st, frameRate=None):
+        """Map a sidecar index; return None if it is missing or stale for stat result st,
+        or timed at another rate than frameRate when one is given."""
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(data) < HEADER.size:
+            return None
+        magic, version, order, size, mtime, count, _, indexRate = HEADER.unpack_from(data)
+        if (magic, version, order) != (MAGIC, VERSION, BYTE_ORDER) \
+                or (size, mtime) != (st.st_size, st.st_mtime_ns) \
+                or len(data) != HEADER.size + count * 17 \
+                or frameRate is not None and indexRate != frameRate:
+            return None
+        view = memoryview(data)
+        pos = HEADER.size
+        offsets = view[pos:pos + count * 8].cast('Q')
+        pos += count * 8
+        sizes = view[pos:pos + count * 4].cast('I')
+        pos += count * 4
+        times = view[pos:pos + count * 4].cast('I')
+        pos += count * 4
+        keys = view[pos:pos + count]
+        return cls(offsets, sizes, times, keys, indexRate)
+
+    def save(self, path, st):
+        """Write the index as a sidecar for the media file with stat result st."""
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER, st.st_size, st.st_mtime_ns,
+                                len(self), 0, self.frameRate))
+            for table, typecode in ((self.offsets, 'Q'), (self.sizes, 'I'),
+                                    (self.times, 'I'), (self.keys, 'B')):
+                f.write(array(typecode, table).tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def forMedia(cls, filename, data, frameRate=None):
+        """Load the sidecar of a media file, rebuilding it if the media changed or, when
+        frameRate is given, if it was timed at another rate. Without frameRate the
+        sidecar's rate stands, and a new index is timed at DEFAULT_FRAME_RATE."""
+        path = filename + SIDECAR_EXT
+        st = os.stat(filename)
+        index = cls.load(path, st, frameRate)
+        if index is None:
+            index = cls.scan(data, frameRate or DEFAULT_FRAME_RATE)
+            try:
+                index.save(path, st)
+            except OSError:
+                # Read-only media directory; serve from the in-memory scan
+                pass
+        return index
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def span(self, index):
+        """Return (offset, size) of a frame."""
+        return self.offsets[index], self.sizes[index]
+
+    def frameAt(self, ms):
+        """Index of the keyframe showing at ms: a binary search over the times."""
+        index = max(0, bisect.bisect_right(self.times, ms) - 1)
+        while index > 0 and not self.keys[index]:
+            index -= 1
+        return index
+
+def indexMedia(filename, frameRate=None):
+    """Build or refresh the sidecar of one media file, re-timing it if frameRate is
+    given and differs from the one recorded; return its frame count."""
+    with open(filename, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            data = b''
+    return len(FrameIndex.forMedia(filename, data, frameRate))
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-index MJPEG media for instant SETUP')
+    parser.add_argument('paths', nargs='+', help='media files or directories')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='frames per second (default: keep the indexed rate, %g for new indexes)'
+                        % DEFAULT_FRAME_RATE)
+    parser.add_argument('--ext', default='.mjpeg', help='media file extension to index in directories')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if os.path.isdir(path):
+            files = [os.path.join(root, name) for root, _, names in os.walk(path)
+                     for name in sorted(names) if name.lower().endswith(args.ext.lower())]
+        else:
+            files = [path]
+        for filename in files:
+            try:
+                print("%s: %d frames" % (filename, indexMedia(filename, args.rate)))
+            except (OSError, ValueError) as e:
+                print("%s: %s" % (filename, e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import heapq, itertools, threading, time
+
+from Log import getLogger
+
+log = getLogger('server')
+
+class PacingStats:
+    """Send-time statistics of one session, in seconds."""
+
+    def __init__(self):
+        self.frames = 0
+        # Frames not sent because the session fell a whole interval behind
+        self.missed = 0
+        self.lateness = 0.0
+        self.maxLateness = 0.0
+        # Smoothed deviation of the actual send interval from the nominal one (RFC 3550 style)
+        self.jitter = 0.0
+        self.lastSend = None
+
+    def meanLateness(self):
+        return self.lateness / self.frames if self.frames else 0.0
+
+class Slot:
+    """Deadline-ordered send slot of one session."""
+
+    def __init__(self, session, interval, deadline):
+        self.session = session
+        self.interval = interval
+        self.deadline = deadline
+        self.active = True
+        self.stats = PacingStats()
+
+class FrameScheduler:
+    """Paces the frames of all playing sessions on absolute monotonic deadlines.
+
+    Every due session is sent in one wakeup, and each next deadline is the
+    previous one plus the session's interval, so send time never
+    accumulates into drift. A session object only needs a sendFrame()
+    method returning False once it has nothing left to send.
+
+    Packets the sessions queue on the egress during a wakeup are flushed
+    together once every due session has been served.
+
+    This class does not run by itself: ThreadedScheduler drives it from one
+    thread, and an event loop can call runDue() from a timer instead.
+    """
+
+    def __init__(self, egress=None):
+        self.egress = egress
+        self.lock = threading.Lock()
+        self.heap = []
+        self.slots = {}
+        self.order = itertools.count()
+
+    def add(self, session, frameRate, stats=None):
+        """Start pacing a session; its first frame is due now.
+
+        Statistics carry over from a previous add() of the same session, or
+        from stats if given. Return the PacingStats the session now uses."""
+        with self.lock:
+            old = self.slots.get(session)
+            if old is not None:
+                old.active = False
+            slot = Slot(session, 1.0 / frameRate, time.monotonic())
+            if stats is not None:
+                slot.stats = stats
+            elif old is not None:
+                slot.stats = old.stats
+            self.slots[session] = slot
+            heapq.heappush(self.heap, (slot.deadline, next(self.order), slot))
+        self.wake()
+        return slot.stats
+
+    def remove(self, session):
+        """Stop pacing a session."""
+        with self.lock:
+            slot = self.slots.pop(session, None)
+            if slot is not None:
+                slot.active = False
+
+    def setRate(self, session, frameRate):
+        """Change a playing session's frame rate from its next frame on."""
+        with self.lock:
+            slot = self.slots.get(session)
+            if slot is not None:
+                slot.interval = 1.0 / frameRate
+
+    def stats(self, session):
+        """Pacing statistics of a session, or None if it is not scheduled."""
+        slot = self.slots.get(session)
+        return slot.stats if slot is not None else None
+
+    def wake(self):
+        """Called when a slot may now be due earlier than before."""
+        pass
+
+    def nextDeadline(self):
+        """Monotonic time of the earliest live slot, or None if idle."""
+        with self.lock:
+            while self.heap and not self.heap[0][2].active:
+                heapq.heappop(self.heap)
+            return self.heap[0][0] if self.heap else None
+
+    def runDue(self):
+        """Send one frame for every session that is due. Return the next deadline."""
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                slot = heapq.heappop(self.heap)[2]
+                if slot.active:
+                    due.append(slot)
+
+        for slot in due:
+            sent = time.monotonic()
+            try:
+                more = slot.session.sendFrame()
+            except Exception:
+                # One broken session must not stop pacing for all the others
+                log.exception("Send failed, unscheduling %r", slot.session)
+                more = False
+            if not more:
+                slot.active = False
+                continue
+            stats = slot.stats
+            late = sent - slot.deadline
+            stats.frames += 1
+            stats.lateness += late
+            if late > stats.maxLateness:
+                stats.maxLateness = late
+            if stats.lastSend is not None:
+                d = abs(sent - stats.lastSend - slot.interval)
+                stats.jitter += (d - stats.jitter) / 16
+            stats.lastSend = sent
+            slot.deadline += slot.interval
+            if slot.deadline <= now:
+                # Skip whole intervals instead of bursting to catch up
+                skip = int((now - slot.deadline) / slot.interval) + 1
+                stats.missed += skip
+                slot.deadline += skip * slot.interval
+        if due and self.egress is not None:
+            try:
+                self.egress.flush()
+            except Exception:
+                log.exception("Egress flush failed")
+
+        with self.lock:
+            for slot in due:
+                if slot.active:
+                    heapq.heappush(self.heap, (slot.deadline, next(self.order), slot))
+                elif self.slots.get(slot.session) is slot:
+                    del self.slots[slot.session]
+        return self.nextDeadline()
+
+class ThreadedScheduler(FrameScheduler):
+    """FrameScheduler driven by a single background thread."""
+
+    def __init__(self, egress=None):
+        super().__init__(egress)
+        self.event = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def wake(self):
+        self.event.set()
+
+    def run(self):
+        while True:
+            deadline = self.runDue()
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            self.event.wait(timeout)
+            self.event.clear()
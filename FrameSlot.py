@@ -0,0 +1,38 @@
+import threading
+
+class FrameSlot:
+    """Single-entry handoff of the latest decoded frame between threads.
+
+    The producer publishes without ever blocking; a frame that is replaced
+    before the consumer took it is dropped and counted, so the slot never
+    holds more than one frame no matter how far the consumer falls behind.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame = None
+        self.published = 0
+        self.dropped = 0
+        self.taken = 0
+
+    def publish(self, frame):
+        """Offer the newest frame, replacing one the consumer has not taken yet."""
+        with self.lock:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.published += 1
+
+    def take(self):
+        """Return the newest frame and empty the slot, or None if nothing new."""
+        with self.lock:
+            frame = self.frame
+            self.frame = None
+            if frame is not None:
+                self.taken += 1
+            return frame
+
+    def clear(self):
+        """Discard a pending frame without counting it as dropped."""
+        with self.lock:
+            self.frame = None
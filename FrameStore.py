@@ -0,0 +1,182 @@
+import os, threading, time
+from collections import OrderedDict
+
+from VideoStream import VideoStream
+
+class MediaEntry:
+    """Parsed, immutable frames of one media file version.
+
+    nbytes counts the file and whatever its attachments have charged."""
+
+    def __init__(self, key, frames, nbytes):
+        self.key = key
+        self.frames = frames
+        self.nbytes = nbytes
+        self.refs = 0
+        # Objects derived from the frames once and shared with them, e.g. RTP fragments
+        self.attachments = {}
+
+class FrameStore:
+    """Server-wide, reference-counted registry of parsed media.
+
+    Entries are keyed by (path, mtime, size) so sessions on the same file
+    share one copy of its frames, and each VideoStream handed out is only a
+    cursor over them. A path is stat'ed when it is first opened and, by
+    default, not again until reload(), so SETUP on loaded media touches no
+    file system; a file changed since is picked up on the first open after
+    reload() as a new entry. Entries no session holds are kept for reuse and
+    evicted least recently used first once the store exceeds its budget.
+    Attachments derived from the frames are charged to the same budget;
+    they only grow into room left once unused entries are gone, and when
+    opening media pushes the store over budget they are trimmed too.
+    """
+
+    def __init__(self, budget=256 * 1024 * 1024, revalidate=None, lazy=True):
+        self.budget = budget
+        # Seconds a path -> key lookup is trusted before the file is stat'ed again; None for until reload()
+        self.revalidate = revalidate
+        self.lazy = lazy
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.paths = {}
+        self.nbytes = 0
+
+    def open(self, filename):
+        """Return a new VideoStream cursor over the shared frames of filename."""
+        with self.lock:
+            entry = self._lookup(filename)
+            entry.refs += 1
+            self.entries.move_to_end(entry.key)
+            self._evict()
+        self._trim()
+        vs = VideoStream(filename, frames=entry.frames)
+        vs.storeKey = entry.key
+        return vs
+
+    def close(self, videoStream):
+        """Drop a cursor's reference to its frames."""
+        key = videoStream.storeKey
+        if key is None:
+            return
+        videoStream.storeKey = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.refs -= 1
+                self._evict()
+        self._trim()
+
+    def mediaBytes(self, videoStream):
+        """Size of the media file a cursor reads, as it was when loaded, or None for a
+        cursor not from the store."""
+        key = getattr(videoStream, 'storeKey', None)
+        with self.lock:
+            entry = self.entries.get(key) if key is not None else None
+        return entry.key[2] if entry is not None else None
+
+    def attachment(self, videoStream, name, factory):
+        """Return the object called name derived from a cursor's frames.
+
+        It is made by factory(frames, charge) on first use and shared by every
+        cursor over the same media version; a cursor not from the store gets
+        its own, with charge None. The object calls charge(n) before it keeps
+        n more bytes, and keeps them only if that returns True. Its trim()
+        method frees everything it keeps and returns how many bytes; it is
+        never called with the store's lock held, so it may wait on an object
+        that is charging."""
+        key = getattr(videoStream, 'storeKey', None)
+        with self.lock:
+            entry = self.entries.get(key) if key is not None else None
+            value = entry.attachments.get(name) if entry is not None else None
+        if entry is None:
+            return factory(videoStream.cache, None)
+        if value is not None:
+            return value
+        # Made without the lock, which charge() takes
+        value = factory(entry.frames, lambda n: self._charge(entry, n))
+        with self.lock:
+            kept = entry.attachments.setdefault(name, value)
+        if kept is not value:
+            # Another cursor made it first; give back whatever this one charged
+            self._release(entry, value.trim())
+        return kept
+
+    def reload(self):
+        """Stat every path again on its next open, to pick up changed media."""
+        with self.lock:
+            self.paths.clear()
+
+    def memoryUsage(self):
+        """Total bytes of media held by the store."""
+        return self.nbytes
+
+    def _charge(self, entry, nbytes):
+        """An attachment of entry is about to keep nbytes more. Return whether they fit
+        the budget once unused entries are evicted; they are charged only if so."""
+        with self.lock:
+            if self.entries.get(entry.key) is not entry:
+                # Evicted already; nothing more is kept for it
+                return False
+            self._evict(self.budget - nbytes)
+            if self.entries.get(entry.key) is not entry or self.nbytes + nbytes > self.budget:
+                return False
+            entry.nbytes += nbytes
+            self.nbytes += nbytes
+            return True
+
+    def _release(self, entry, nbytes):
+        """An attachment of entry freed nbytes."""
+        with self.lock:
+            if self.entries.get(entry.key) is entry:
+                entry.nbytes -= nbytes
+                self.nbytes -= nbytes
+
+    def _lookup(self, filename):
+        now = time.monotonic()
+        cached = self.paths.get(filename)
+        if cached is not None and (self.revalidate is None or now - cached[1] < self.revalidate):
+            entry = self.entries.get(cached[0])
+            if entry is not None:
+                return entry
+        try:
+            st = os.stat(filename)
+        except OSError:
+            raise IOError
+        key = (os.path.realpath(filename), st.st_mtime_ns, st.st_size)
+        self.paths[filename] = (key, now)
+        entry = self.entries.get(key)
+        if entry is None:
+            frames = VideoStream(filename, lazy=self.lazy).cache
+            entry = MediaEntry(key, frames, st.st_size)
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+        return entry
+
+    def _evict(self, limit=None):
+        """Drop unused entries, least recently used first, until within limit
+        (the budget by default)."""
+        if limit is None:
+            limit = self.budget
+        if self.nbytes <= limit:
+            return
+        for key in [k for k, e in self.entries.items() if e.refs == 0]:
+            entry = self.entries.pop(key)
+            self.nbytes -= entry.nbytes
+            if self.nbytes <= limit:
+                break
+        for path in [p for p, (k, _) in self.paths.items() if k not in self.entries]:
+            del self.paths[path]
+
+    def _trim(self):
+        """Trim the attachments of media in use until within budget. Called without
+        the lock, since a trim may wait on an attachment that is charging."""
+        with self.lock:
+            if self.nbytes <= self.budget:
+                return
+            # Media in use stays; what was derived from it can be rebuilt
+            attached = [(entry, value) for entry in self.entries.values()
+                        for value in entry.attachments.values()]
+        for entry, value in attached:
+            self._release(entry, value.trim())
+            if self.nbytes <= self.budget:
+                return
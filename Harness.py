@@ -0,0 +1,85 @@
+"""Helpers shared by the benchmarks and the load client: synthetic media,
+running a server under test, and sampling its CPU time."""
+import os, signal, socket, subprocess, sys, time
+
+from RtpJpeg import makeHeaders, makeTables
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# JFIF headers, SOI to SOS, of a 320x240 4:2:0 frame, so RFC 2435 can carry the frames
+SYNTHETIC_HEADER = makeHeaders(1, 320 // 8, 240 // 8, makeTables(50))
+
+def makeMovie(path, frames=2000, frameSize=15000):
+    """Write a synthetic <5-digit length><frame> MJPEG file of frameSize-byte frames.
+
+    Frames are baseline JFIF headers, filler scan data that differs per frame,
+    then EOI: enough for the servers and the load client, which never decode them."""
+    filler = bytes(range(256)) * (frameSize // 256 + 1)
+    head = SYNTHETIC_HEADER
+    size = max(0, frameSize - len(head) - 2)
+    with open(path, 'wb') as f:
+        for i in range(frames):
+            frame = head + filler[i % 256:i % 256 + size] + b'\xff\xd9'
+            f.write(b'%05d' % len(frame))
+            f.write(frame)
+    return path
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def startServer(script, port, *args, cpu=None, stderr=None):
+    """Run a server script on port, optionally pinned to a CPU or set of CPUs, and wait for it to listen."""
+    cpus = {cpu} if isinstance(cpu, int) else cpu
+    pin = (lambda: os.sched_setaffinity(0, cpus)) if cpus is not None else None
+    # In a process group of its own, so stopServer() can reach any worker processes
+    proc = subprocess.Popen([sys.executable, script, str(port)] + [str(a) for a in args],
+                            cwd=HERE, stdout=subprocess.DEVNULL, stderr=stderr, preexec_fn=pin,
+                            start_new_session=True)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    stopServer(proc)
+    raise RuntimeError("%s did not start" % script)
+
+def stopServer(proc, timeout=10.0):
+    """SIGTERM a server started by startServer() so it drains its workers; after
+    timeout, SIGKILL its whole process group."""
+    proc.terminate()
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    proc.wait()
+
+def cpuSeconds(pid):
+    """User+system CPU time consumed by a process so far."""
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def processTree(pid):
+    """pid and all of its descendants."""
+    pids = [pid]
+    for p in pids:
+        try:
+            with open('/proc/%d/task/%d/children' % (p, p)) as f:
+                pids += [int(c) for c in f.read().split()]
+        except OSError:
+            pass
+    return pids
+
+def threadCount(pid):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                return int(line.split()[1])
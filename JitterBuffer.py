@@ -0,0 +1,220 @@
+import heapq, threading, time
+
+RTP_SEQ_MOD = 1 << 16
+
+class SequenceTracker:
+    """Extends 16-bit RTP sequence numbers across wraparound (RFC 3550 A.1)."""
+
+    MAX_DROPOUT = 3000
+    # Wider than RFC 3550's 100: a single reordered frame can span hundreds of packets
+    MAX_MISORDER = 1000
+
+    def __init__(self):
+        self.cycles = 0
+        self.maxSeq = None
+
+    def extend(self, seqnum):
+        """Return the extended sequence number of seqnum."""
+        if self.maxSeq is None:
+            self.maxSeq = seqnum
+            return seqnum
+        delta = (seqnum - self.maxSeq) % RTP_SEQ_MOD
+        if delta < self.MAX_DROPOUT:
+            # In order, possibly with a gap; wrapped if the raw number went down
+            if seqnum < self.maxSeq:
+                self.cycles += RTP_SEQ_MOD
+            self.maxSeq = seqnum
+            return self.cycles + seqnum
+        if delta >= RTP_SEQ_MOD - self.MAX_MISORDER:
+            # Late packet from before maxSeq, maybe from the previous cycle
+            if seqnum > self.maxSeq:
+                return self.cycles - RTP_SEQ_MOD + seqnum
+            return self.cycles + seqnum
+        # Big jump: the sender restarted its numbering
+        self.maxSeq = seqnum
+        return self.cycles + seqnum
+
+class JitterBuffer:
+    """Reorders complete frames by RTP sequence number and releases them on a playout clock.
+
+    Each frame's playout time is its RTP timestamp mapped onto the local
+    clock through the fastest transit seen so far, plus a target delay
+    that follows the measured interarrival jitter. Frames that arrive
+    after a later frame has been played, or that are already overdue when
+    the next one is due as well, are dropped and counted as late.
+
+    Under trick play (an RTSP Scale other than 1) timestamps still follow
+    the media clock, so they are divided by the scale before mapping:
+    at 2x, two seconds of media play out per second, and backwards play
+    (negative scale) turns falling timestamps into rising playout times.
+    """
+
+    def __init__(self, clockRate=90000, minDelay=0.02, maxDelay=0.5, maxFrames=64):
+        self.clockRate = clockRate
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.maxFrames = maxFrames
+        self.scale = 1.0
+        self.cond = threading.Condition()
+        self.reset()
+        self.seqs = SequenceTracker()
+        self.frameSeqs = SequenceTracker()
+        # Packet statistics
+        self.baseSeq = None
+        self.highestSeq = None
+        self.received = 0
+        self.reordered = 0
+        self.jitter = 0.0
+        self.lastTransit = None
+        # Counts at the previous reception report (RFC 3550 A.3)
+        self.expectedPrior = 0
+        self.receivedPrior = 0
+        # Frame statistics
+        self.played = 0
+        self.late = 0
+        self.overflow = 0
+
+    def reset(self):
+        """Forget queued frames and the clock mapping, e.g. after a seek."""
+        with self.cond:
+            self.heap = []
+            self.lastPlayed = None
+            self.offset = None
+            self.targetDelay = self.minDelay
+            self.cond.notify_all()
+
+    def setScale(self, scale):
+        """Play out at scale times the media clock from now on."""
+        with self.cond:
+            if self.heap:
+                # Re-time the queue so that the next frame stays due when it was
+                timestamp = self.heap[0][1]
+                due = self.playoutTime(timestamp)
+                self.scale = scale
+                self.offset = due - self.localTime(timestamp) - self.targetDelay
+            else:
+                self.scale = scale
+                self.offset = None
+            # Transit times at the old speed are no measure of jitter at the new one
+            self.lastTransit = None
+            self.cond.notify_all()
+
+    def localTime(self, timestamp):
+        """Seconds of playout time at which timestamp falls, before the offset."""
+        return timestamp / (self.clockRate * self.scale)
+
+    def notePacket(self, seqnum, timestamp, arrival=None):
+        """Account for one received RTP packet (loss, reordering, jitter)."""
+        if arrival is None:
+            arrival = time.monotonic()
+        ext = self.seqs.extend(seqnum)
+        if self.baseSeq is None:
+            self.baseSeq = self.highestSeq = ext
+        elif ext > self.highestSeq:
+            self.highestSeq = ext
+        elif ext < self.highestSeq:
+            self.reordered += 1
+        self.received += 1
+        # RFC 3550 interarrival jitter, kept in seconds
+        transit = arrival - self.localTime(timestamp)
+        if self.lastTransit is not None:
+            d = abs(transit - self.lastTransit)
+            # A timestamp jump (seek) is not jitter
+            if d < self.maxDelay:
+                self.jitter += (d - self.jitter) / 16
+        self.lastTransit = transit
+
+    def lost(self):
+        """Packets expected but never received."""
+        if self.baseSeq is None:
+            return 0
+        return max(0, self.highestSeq - self.baseSeq + 1 - self.received)
+
+    def receptionReport(self):
+        """Return (fraction lost 0..255, cumulative lost, extended highest seq, jitter in
+        timestamp units) for an RTCP report block, and start a new report interval."""
+        if self.baseSeq is None:
+            return 0, 0, 0, 0
+        expected = self.highestSeq - self.baseSeq + 1
+        expectedInterval = expected - self.expectedPrior
+        receivedInterval = self.received - self.receivedPrior
+        self.expectedPrior = expected
+        self.receivedPrior = self.received
+        lostInterval = expectedInterval - receivedInterval
+        fraction = (lostInterval << 8) // expectedInterval if expectedInterval > 0 and lostInterval > 0 else 0
+        return min(fraction, 255), expected - self.received, self.highestSeq, int(self.jitter * self.clockRate)
+
+    def put(self, seqnum, timestamp, frame, arrival=None):
+        """Queue a complete frame keyed by the sequence number of its first packet."""
+        if arrival is None:
+            arrival = time.monotonic()
+        ext = self.frameSeqs.extend(seqnum)
+        with self.cond:
+            if self.lastPlayed is not None and ext <= self.lastPlayed:
+                self.late += 1
+                return
+            transit = arrival - self.localTime(timestamp)
+            if self.offset is None or transit < self.offset \
+                    or transit - self.offset > self.maxDelay * 4:
+                # Faster path than before, or a discontinuity: remap the clock
+                self.offset = transit
+            self.targetDelay = min(self.maxDelay, max(self.minDelay, self.targetDelay, 3 * self.jitter))
+            heapq.heappush(self.heap, (ext, timestamp, frame))
+            if len(self.heap) > self.maxFrames:
+                # Bounded: make room by giving up on the oldest frame
+                heapq.heappop(self.heap)
+                self.overflow += 1
+            self.cond.notify_all()
+
+    def playoutTime(self, timestamp):
+        return self.localTime(timestamp) + self.offset + self.targetDelay
+
+    def get(self, timeout=None):
+        """Wait for the next frame's playout time. Return (seqnum, timestamp, frame) or None."""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.heap:
+                    ext, timestamp, frame = self.heap[0]
+                    due = self.playoutTime(timestamp)
+                    if due <= now:
+                        heapq.heappop(self.heap)
+                        if self.heap and self.playoutTime(self.heap[0][1]) <= now:
+                            # Overdue and already superseded: skip it
+                            self.late += 1
+                            self.lastPlayed = ext
+                            # Late frames mean the delay is too tight; back off
+                            self.targetDelay = min(self.maxDelay, self.targetDelay + 0.01)
+                            continue
+                        self.lastPlayed = ext
+                        self.played += 1
+                        # Decay slowly back towards what the jitter calls for
+                        self.targetDelay = max(self.minDelay, 3 * self.jitter,
+                                               self.targetDelay * 0.999)
+                        return ext & 0xFFFF, timestamp, frame
+                    wait = due - now
+                else:
+                    wait = None
+                if end is not None:
+                    left = end - now
+                    if left <= 0:
+                        return None
+                    wait = left if wait is None else min(wait, left)
+                self.cond.wait(wait)
+
+    def stats(self):
+        """Loss, lateness, reordering and depth figures for tuning."""
+        with self.cond:
+            depth = len(self.heap)
+        return {
+            'received': self.received,
+            'lost': self.lost(),
+            'reordered': self.reordered,
+            'late': self.late,
+            'overflow': self.overflow,
+            'played': self.played,
+            'depth': depth,
+            'jitter': self.jitter,
+            'targetDelay': self.targetDelay,
+        }
@@ -0,0 +1,471 @@
+"""Headless load generator: many RTSP/RTP sessions, no GUI.
+
+Usage: LoadClient.py [options]
+
+Opens --sessions concurrent sessions against a running server, or
+against one it starts itself on synthetic media (--spawn), runs a
+scripted scenario in each and reports per-session frame rate,
+interarrival jitter, loss and seek latency, plus the server's CPU when
+the server is a local process.
+
+A scenario is a ';'-separated list of steps:
+
+    play [scale]     PLAY, optionally with a Scale header
+    seek <s|random>  PLAY with Range: npt=<s>-; random is uniform in [0, --seek-max]
+    pause            PAUSE
+    wait <s>         sleep
+    teardown         TEARDOWN
+
+--scenario also takes the names in SCENARIOS.
+"""
+import argparse, json, os, random, selectors, socket, struct, tempfile, threading, time
+from collections import deque
+
+from RtpPacket import RtpPacket, VIDEO_CLOCK_RATE
+from RtspCodec import RtspParser, encodeRequest
+from Harness import makeMovie, freePort, startServer, stopServer, cpuSeconds, processTree
+from JitterBuffer import JitterBuffer
+from Rtcp import ReportBlock, encodeReceiverReport
+from Log import getLogger, setupLogging, stopLogging
+
+log = getLogger('load')
+
+# Built-in scenarios by name, as functions of the run duration in seconds
+SCENARIOS = {
+    'play': lambda d: 'play; wait %g; teardown' % d,
+    'seek': lambda d: 'play; wait 1; ' + 'seek random; wait 1; ' * max(0, int(d) - 1) + 'teardown',
+    'mixed': lambda d: ('play; wait {0}; pause; wait 1; play; wait {0}; seek random; wait {0}; '
+                        'play 2; wait {0}; teardown').format('%g' % (d / 4)),
+}
+# Seconds between RTCP receiver reports from each session, as the GUI client
+RTCP_INTERVAL = 1.0
+# Packets remembered while a seek's first sequence number is not yet known
+SEEK_EARLY_PACKETS = 256
+
+def parseScenario(text):
+    """Return the steps of a scenario as [(name, argument or None)]."""
+    steps = []
+    for part in text.split(';'):
+        words = part.split()
+        if not words:
+            continue
+        name, arg = words[0].lower(), words[1] if len(words) > 1 else None
+        if name not in ('play', 'seek', 'pause', 'wait', 'teardown'):
+            raise ValueError('unknown step: %r' % part)
+        if name in ('seek', 'wait') and arg is None:
+            raise ValueError('%s needs an argument' % name)
+        steps.append((name, arg))
+    return steps
+
+def percentile(values, fraction):
+    """The value below which fraction of values lie, or None for no values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class LoadSession:
+    """One headless RTSP session and the statistics of the RTP it receives.
+
+    RTSP requests are synchronous and run on the scenario's thread; RTP
+    and RTCP are handled for all sessions by the LoadGenerator's receiver.
+    """
+
+    def __init__(self, host, port, movie, timeout=10.0, multicast=False):
+        self.host = host
+        self.port = port
+        self.movie = movie
+        self.timeout = timeout
+        # Ask for the file's live channel over multicast
+        self.multicast = multicast
+        self.rtp, self.rtcp = self.bindPair()
+        self.rtpPort = self.rtp.getsockname()[1]
+        self.ssrc = random.getrandbits(32)
+        self.sourceSsrc = 0
+        self.serverRtcpPort = None
+        self.conn = None
+        self.parser = RtspParser()
+        self.replies = deque()
+        self.cseq = 0
+        self.session = None
+        self.lock = threading.Lock()
+        # Packet loss, reordering and interarrival jitter
+        self.jitter = JitterBuffer(VIDEO_CLOCK_RATE)
+        self.frames = 0
+        self.bytes = 0
+        self.playSeconds = 0.0
+        self.playStart = None
+        self.replyLatencies = []
+        self.seekLatencies = []
+        # (sent at, first seq or None, [(seq, arrival)] before the reply came)
+        self.pendingSeek = None
+        self.errors = 0
+
+    def bindPair(self):
+        """Bind RTP to a free port and RTCP to the one above it."""
+        for _ in range(100):
+            rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            rtp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            rtp.bind(('', 0))
+            rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                rtcp.bind(('', rtp.getsockname()[1] + 1))
+            except OSError:
+                rtp.close()
+                rtcp.close()
+                continue
+            rtp.setblocking(False)
+            return rtp, rtcp
+        raise OSError('no free RTP/RTCP port pair')
+
+    def request(self, method, headers=()):
+        """Send one request and wait for its reply. Return the reply (an RtspMessage)."""
+        self.cseq += 1
+        headers = list(headers)
+        if self.session is not None:
+            headers.append(('Session', self.session))
+        start = time.monotonic()
+        self.conn.sendall(encodeRequest(method, self.movie, self.cseq, headers))
+        while True:
+            while self.replies:
+                reply = self.replies.popleft()
+                if reply.cseq() == self.cseq:
+                    self.replyLatencies.append(time.monotonic() - start)
+                    if reply.code != 200:
+                        self.errors += 1
+                        log.warning("%s: %d %s", method, reply.code, reply.reason)
+                    return reply
+            data = self.conn.recv(4096)
+            if not data:
+                raise ConnectionError('server closed the connection')
+            self.replies.extend(self.parser.feed(data))
+
+    def setup(self):
+        self.conn = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        reply = self.request('SETUP', [('Transport', 'RTP/AVP;%s;client_port=%d-%d'
+                                        % ('multicast' if self.multicast else 'unicast',
+                                           self.rtpPort, self.rtpPort + 1))])
+        if reply.code == 200:
+            self.session = reply.session()
+            transport = reply.transport()
+            if transport and 'server_port' in transport:
+                self.serverRtcpPort = transport['server_port'][-1]
+            if transport and 'destination' in transport and 'port' in transport:
+                self.joinGroup(transport['destination'], transport['port'][0])
+        return reply
+
+    def joinGroup(self, group, port):
+        """Receive RTP from a multicast group instead; RTCP stays on the pair's port."""
+        rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        rtp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        rtp.bind(('', port))
+        rtp.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                       struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0')))
+        rtp.setblocking(False)
+        # The receiver picks the new socket up on its next pass
+        old, self.rtp = self.rtp, rtp
+        old.close()
+
+    def play(self, scale=None, npt=None):
+        headers = []
+        if npt is not None:
+            headers.append(('Range', 'npt=%.3f-' % npt))
+            with self.lock:
+                self.pendingSeek = (time.monotonic(), None, [])
+        if scale is not None:
+            headers.append(('Scale', '%g' % scale))
+        # Jitter is measured against the media clock at the speed played
+        self.jitter.setScale(scale or 1.0)
+        reply = self.request('PLAY', headers)
+        if npt is not None:
+            self.noteSeekReply(reply)
+        if self.playStart is None:
+            self.playStart = time.monotonic()
+        return reply
+
+    def noteSeekReply(self, reply):
+        """Learn the seek's first sequence number; it may already have arrived."""
+        seq = None
+        for field in (reply.header('RTP-Info') or '').split(';'):
+            if field.strip().startswith('seq='):
+                seq = int(field.split('=', 1)[1])
+        with self.lock:
+            if self.pendingSeek is None:
+                return
+            sent, _, early = self.pendingSeek
+            if seq is None:
+                self.pendingSeek = None
+                return
+            for earlySeq, arrival in early:
+                if earlySeq == seq:
+                    self.seekLatencies.append(arrival - sent)
+                    self.pendingSeek = None
+                    return
+            self.pendingSeek = (sent, seq, None)
+
+    def stopClock(self):
+        if self.playStart is not None:
+            self.playSeconds += time.monotonic() - self.playStart
+            self.playStart = None
+
+    def pause(self):
+        self.stopClock()
+        return self.request('PAUSE')
+
+    def teardown(self):
+        self.stopClock()
+        try:
+            return self.request('TEARDOWN')
+        finally:
+            self.conn.close()
+
+    def run(self, steps, seekMax, start=None):
+        """Run a parsed scenario, starting at monotonic time start."""
+        if start is not None:
+            time.sleep(max(0.0, start - time.monotonic()))
+        try:
+            if self.setup().code != 200:
+                # Refused, e.g. 453 or 503 from admission control
+                self.conn.close()
+                return
+            for name, arg in steps:
+                if name == 'play':
+                    self.play(scale=float(arg) if arg else None)
+                elif name == 'seek':
+                    npt = random.uniform(0, seekMax) if arg == 'random' else float(arg)
+                    self.play(npt=npt)
+                elif name == 'pause':
+                    self.pause()
+                elif name == 'wait':
+                    time.sleep(float(arg))
+                elif name == 'teardown':
+                    self.teardown()
+        except (OSError, ValueError) as e:
+            self.errors += 1
+            self.stopClock()
+            log.warning("Session on RTP port %d failed: %s", self.rtpPort, e)
+
+    def packetReceived(self, packet, arrival):
+        """Account for one RTP packet (a decoded RtpPacket)."""
+        if self.multicast and self.playStart is None:
+            # The group also delivers while this session is not playing
+            return
+        seq = packet.seqNum()
+        self.sourceSsrc = packet.ssrc()
+        self.jitter.notePacket(seq, packet.timestamp(), arrival)
+        self.bytes += len(packet.getPayload())
+        if packet.marker():
+            self.frames += 1
+        seek = self.pendingSeek
+        if seek is not None:
+            with self.lock:
+                seek = self.pendingSeek
+                if seek is None:
+                    return
+                sent, first, early = seek
+                if first is None:
+                    if len(early) < SEEK_EARLY_PACKETS:
+                        early.append((seq, arrival))
+                elif seq == first:
+                    self.seekLatencies.append(arrival - sent)
+                    self.pendingSeek = None
+
+    def sendReport(self):
+        """Send one RTCP receiver report, as the GUI client does."""
+        if self.serverRtcpPort is None or self.jitter.baseSeq is None:
+            return
+        fraction, lost, highest, jitter = self.jitter.receptionReport()
+        report = encodeReceiverReport(self.ssrc,
+            [ReportBlock(self.sourceSsrc, fraction, lost, highest, jitter)])
+        try:
+            self.rtcp.sendto(report, (self.host, self.serverRtcpPort))
+        except OSError:
+            pass
+
+    def close(self):
+        self.rtp.close()
+        self.rtcp.close()
+
+    def stats(self):
+        """Per-session figures; fps is over the time spent playing."""
+        self.stopClock()
+        expected = self.jitter.received + self.jitter.lost()
+        return {
+            'rtpPort': self.rtpPort,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'fps': self.frames / self.playSeconds if self.playSeconds else 0.0,
+            'jitterMs': self.jitter.jitter * 1000,
+            'lost': self.jitter.lost(),
+            'lossRatio': self.jitter.lost() / expected if expected else 0.0,
+            'reordered': self.jitter.reordered,
+            'seekLatencyMs': [s * 1000 for s in self.seekLatencies],
+            'replyLatencyMs': [s * 1000 for s in self.replyLatencies],
+            'errors': self.errors,
+        }
+
+class LoadGenerator:
+    """Runs a scenario in many LoadSessions at once and gathers their figures.
+
+    Each session's scenario runs on its own thread; one receiver thread
+    drains every session's RTP socket through a selector and sends the
+    RTCP receiver reports.
+    """
+
+    def __init__(self, host, port, movie, sessions, scenario, seekMax=30.0, ramp=0.0, serverPid=None,
+                 multicast=False):
+        self.steps = parseScenario(scenario)
+        self.seekMax = seekMax
+        self.ramp = ramp
+        self.serverPid = serverPid
+        self.sessions = [LoadSession(host, port, movie, multicast=multicast) for _ in range(sessions)]
+        self.running = False
+
+    def receive(self):
+        sel = selectors.DefaultSelector()
+        # Session -> the RTP socket registered for it; joining a group replaces it
+        registered = {}
+        packet = RtpPacket()
+        nextReport = time.monotonic() + RTCP_INTERVAL
+        while self.running:
+            for session in self.sessions:
+                sock = session.rtp
+                if registered.get(session) is not sock:
+                    if session in registered:
+                        try:
+                            sel.unregister(registered[session])
+                        except (KeyError, ValueError):
+                            pass
+                    sel.register(sock, selectors.EVENT_READ, session)
+                    registered[session] = sock
+            for key, _ in sel.select(0.1):
+                session = key.data
+                try:
+                    while True:
+                        data = key.fileobj.recv(65536)
+                        packet.decode(data)
+                        session.packetReceived(packet, time.monotonic())
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError:
+                    sel.unregister(key.fileobj)
+            now = time.monotonic()
+            if now >= nextReport:
+                nextReport = now + RTCP_INTERVAL
+                for session in self.sessions:
+                    session.sendReport()
+        sel.close()
+
+    def run(self):
+        """Run every session's scenario to the end. Return the report (see report())."""
+        self.running = True
+        receiver = threading.Thread(target=self.receive, daemon=True)
+        receiver.start()
+        pids = processTree(self.serverPid) if self.serverPid else []
+        cpu0 = sum(cpuSeconds(pid) for pid in pids)
+        start = time.monotonic()
+        step = self.ramp / len(self.sessions) if self.sessions else 0.0
+        threads = [threading.Thread(target=s.run, args=(self.steps, self.seekMax, start + i * step), daemon=True)
+                   for i, s in enumerate(self.sessions)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - start
+        cpu = sum(cpuSeconds(pid) for pid in pids) - cpu0 if pids else None
+        # Let the last packets in flight land
+        time.sleep(0.2)
+        self.running = False
+        receiver.join()
+        for session in self.sessions:
+            session.close()
+        return self.report(elapsed, cpu)
+
+    def report(self, elapsed, cpu):
+        sessions = [s.stats() for s in self.sessions]
+        fps = [s['fps'] for s in sessions]
+        seeks = [l for s in sessions for l in s['seekLatencyMs']]
+        replies = [l for s in sessions for l in s['replyLatencyMs']]
+        return {
+            'sessions': len(sessions),
+            'seconds': elapsed,
+            'fpsP50': percentile(fps, 0.5),
+            'fpsP5': percentile(fps, 0.05),
+            'jitterMsP50': percentile([s['jitterMs'] for s in sessions], 0.5),
+            'jitterMsP95': percentile([s['jitterMs'] for s in sessions], 0.95),
+            'lossRatio': sum(s['lossRatio'] for s in sessions) / len(sessions) if sessions else 0.0,
+            'seekLatencyMsP50': percentile(seeks, 0.5),
+            'seekLatencyMsP95': percentile(seeks, 0.95),
+            'replyLatencyMsP50': percentile(replies, 0.5),
+            'replyLatencyMsP95': percentile(replies, 0.95),
+            'serverCpuPercent': 100 * cpu / elapsed if cpu is not None else None,
+            'frames': sum(s['frames'] for s in sessions),
+            'errors': sum(s['errors'] for s in sessions),
+            'perSession': sessions,
+        }
+
+def formatReport(report):
+    """Human-readable summary of a LoadGenerator report."""
+    def ms(value):
+        return '%.1f ms' % value if value is not None else '-'
+    lines = [
+        '%d sessions, %.1f s, %d frames, %d errors' % (report['sessions'], report['seconds'],
+                                                     report['frames'], report['errors']),
+        'fps per session     p50 %.1f  p5 %.1f' % (report['fpsP50'] or 0, report['fpsP5'] or 0),
+        'jitter              p50 %s  p95 %s' % (ms(report['jitterMsP50']), ms(report['jitterMsP95'])),
+        'loss                %.2f%%' % (100 * report['lossRatio']),
+        'seek latency        p50 %s  p95 %s' % (ms(report['seekLatencyMsP50']), ms(report['seekLatencyMsP95'])),
+        'RTSP reply latency  p50 %s  p95 %s' % (ms(report['replyLatencyMsP50']), ms(report['replyLatencyMsP95'])),
+    ]
+    if report['serverCpuPercent'] is not None:
+        lines.append('server CPU          %.0f%%' % report['serverCpuPercent'])
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='RTSP port of a running server')
+    parser.add_argument('--spawn', metavar='SCRIPT', help='start this server script on synthetic media instead')
+    parser.add_argument('--server-args', default='-l warning', help='arguments for --spawn, e.g. "-w 2"')
+    parser.add_argument('--server-pid', type=int, help='report the CPU of this local server process tree')
+    parser.add_argument('--movie', default='movie.Mjpeg', help='media name to SETUP (ignored with --spawn)')
+    parser.add_argument('--frames', type=int, default=2400, help='synthetic movie length with --spawn')
+    parser.add_argument('--frame-size', type=int, default=15000)
+    parser.add_argument('-n', '--sessions', type=int, default=10)
+    parser.add_argument('--scenario', default='play', help='a name in SCENARIOS or a step list')
+    parser.add_argument('--duration', type=float, default=10.0, help='length of the named scenarios')
+    parser.add_argument('--seek-max', type=float, default=30.0, help='upper bound of seek random')
+    parser.add_argument('--ramp', type=float, default=1.0, help='seconds over which sessions start')
+    parser.add_argument('--multicast', action='store_true', help='watch the live channel over multicast')
+    parser.add_argument('--json', metavar='FILE', help='also write the full report, per session, here')
+    parser.add_argument('--log-level', default='warning')
+    args = parser.parse_args()
+    setupLogging(args.log_level)
+    scenario = SCENARIOS[args.scenario](args.duration) if args.scenario in SCENARIOS else args.scenario
+
+    with tempfile.TemporaryDirectory() as tmp:
+        proc = None
+        port, serverPid, movie = args.port, args.server_pid, args.movie
+        if args.spawn:
+            # The server opens media relative to its own directory
+            movie = makeMovie(os.path.join(tmp, 'movie.Mjpeg'), args.frames, args.frame_size)
+            port = freePort()
+            proc = startServer(args.spawn, port, *args.server_args.split())
+            serverPid = proc.pid
+        elif port is None:
+            parser.error('give --port of a running server, or --spawn')
+        try:
+            report = LoadGenerator(args.host, port, movie, args.sessions, scenario,
+                                   args.seek_max, args.ramp, serverPid, args.multicast).run()
+        finally:
+            if proc is not None:
+                stopServer(proc)
+    print(formatReport(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    stopLogging()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Logging for the servers and the client.
+
+Records go through a bounded queue to a background thread that does the
+formatting and the writing, so a slow or full stdout never blocks a
+session; when the queue is full, records are dropped and counted.
+
+Per-packet logging goes through PacketLog, whose enabled flag is a plain
+attribute: callers test it before building any message, which makes a
+disabled per-packet log cost one attribute lookup.
+"""
+import logging, logging.handlers, os, queue, sys, time, weakref
+
+ROOT = 'rtsp'
+FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+QUEUE_SIZE = 10000
+# Level names accepted on the command line, plus 'off'
+LEVELS = {'off': logging.CRITICAL + 10, 'error': logging.ERROR, 'warning': logging.WARNING,
+          'info': logging.INFO, 'debug': logging.DEBUG}
+
+packetLogs = weakref.WeakSet()
+listener = None
+output = None
+
+def getLogger(name):
+    return logging.getLogger(ROOT + '.' + name)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking or raising when full."""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread, not the caller's
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setupLogging(level='info', stream=None):
+    """Send everything under the 'rtsp' logger at level or above to stream (stderr)."""
+    global listener, output
+    if isinstance(level, str):
+        level = LEVELS[level.lower()]
+    root = logging.getLogger(ROOT)
+    if listener is not None:
+        listener.stop()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    q = queue.Queue(QUEUE_SIZE)
+    if stream is not None or output is None:
+        output = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    output.setFormatter(logging.Formatter(FORMAT))
+    root.addHandler(DroppingQueueHandler(q))
+    root.setLevel(level)
+    root.propagate = False
+    listener = logging.handlers.QueueListener(q, output)
+    listener.start()
+    for log in list(packetLogs):
+        log.refresh()
+    return root
+
+def restartAfterFork():
+    """The listener thread does not survive fork(); give the child its own."""
+    if listener is not None:
+        setupLogging(logging.getLogger(ROOT).level)
+
+os.register_at_fork(after_in_child=restartAfterFork)
+
+def stopLogging():
+    """Flush queued records; call before the process exits."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+class PacketLog:
+    """Rate-limited debug log for per-packet events.
+
+    At most burst messages go out per interval seconds; the rest are
+    counted and reported with the next message that gets through.
+    Guard calls with 'if log.enabled:' so nothing is formatted when off.
+    """
+
+    def __init__(self, logger, interval=1.0, burst=5):
+        self.logger = logger
+        self.interval = interval
+        self.burst = burst
+        self.windowStart = 0.0
+        self.sent = 0
+        self.suppressed = 0
+        self.refresh()
+        packetLogs.add(self)
+
+    def refresh(self):
+        """Re-read the logger's level; setupLogging() calls this."""
+        self.enabled = self.logger.isEnabledFor(logging.DEBUG)
+
+    def debug(self, msg, *args):
+        now = time.monotonic()
+        if now - self.windowStart >= self.interval:
+            self.windowStart = now
+            self.sent = 0
+        if self.sent >= self.burst:
+            self.suppressed += 1
+            return
+        self.sent += 1
+        if self.suppressed:
+            msg += ' (%d similar messages suppressed)' % self.suppressed
+            self.suppressed = 0
+        self.logger.debug(msg, *args)
@@ -0,0 +1,181 @@
+"""Live server statistics in the Prometheus text exposition format.
+
+Sessions keep their own counters as plain integer attributes, bumped
+without locks on the send path. Everything is read and formatted only
+when the endpoint is scraped.
+"""
+import socket, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STATES = ('INIT', 'READY', 'PLAYING')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class SessionCounters:
+    """Per-session counters; written by one thread, read racily by scrapes."""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.seeks = 0
+
+class MetricsRegistry:
+    """Knows every live session and the shared objects worth reporting on.
+
+    A session only needs state, counters, pacing (a PacingStats or None)
+    and clientInfo attributes; ServerWorker has them.
+    """
+
+    def __init__(self, frameStore=None, egress=None, channels=None, manager=None):
+        self.frameStore = frameStore
+        self.egress = egress
+        self.channels = channels
+        # SessionManager, for admission and timeout counters
+        self.manager = manager
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.started = time.monotonic()
+        # Egress byte count at the previous scrape, for the bit rate gauge
+        self.lastScrape = (self.started, 0)
+        # Scrapes run on threads of their own; each one moves lastScrape forward
+        self.scrapeLock = threading.Lock()
+
+    def add(self, session):
+        with self.lock:
+            self.sessions.add(session)
+
+    def remove(self, session):
+        with self.lock:
+            self.sessions.discard(session)
+
+    def egressRate(self):
+        """Egress bits per second since the previous scrape."""
+        with self.scrapeLock:
+            # Sampled under the lock, so each scrape starts where the one before ended
+            now = time.monotonic()
+            sent = self.egress.bytes
+            then, before = self.lastScrape
+            self.lastScrape = (now, sent)
+        return 8 * (sent - before) / (now - then) if now > then else 0.0
+
+    def render(self):
+        """Return all metrics as Prometheus text."""
+        with self.lock:
+            sessions = list(self.sessions)
+        out = []
+
+        def family(name, kind, help, samples):
+            out.append('# HELP %s %s' % (name, help))
+            out.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                out.append('%s%s %s' % (name, labels, formatValue(value)))
+
+        rows = []
+        for s in sessions:
+            info = s.clientInfo
+            address = info.get('rtspSocket', (None, None))[1]
+            client = '%s:%s' % address[:2] if address else ''
+            rows.append(('{session="%s",client="%s"' % (info.get('session', 0), client), s))
+        family('rtsp_session_state', 'gauge', 'Session state, 1 for the current one.',
+               [('%s,state="%s"}' % (labels, state), int(STATES[s.state] == state))
+                for labels, s in rows for state in STATES])
+        family('rtsp_session_frames_sent_total', 'counter', 'Video frames sent.',
+               [(labels + '}', s.counters.frames) for labels, s in rows])
+        family('rtsp_session_bytes_sent_total', 'counter', 'RTP bytes sent, headers included.',
+               [(labels + '}', s.counters.bytes) for labels, s in rows])
+        family('rtsp_session_send_rate_fps', 'gauge', 'Frame send rate after Scale and RTCP rate adaptation.',
+               [(labels + '}', s.rateControl.sendRate()) for labels, s in rows])
+        family('rtsp_session_scale', 'gauge', 'Playback speed from the PLAY Scale header.',
+               [(labels + '}', s.rateControl.scale) for labels, s in rows])
+        family('rtsp_session_reported_loss_ratio', 'gauge', 'Packet loss in the latest RTCP receiver report.',
+               [(labels + '}', s.rateControl.lastLoss) for labels, s in rows])
+        family('rtsp_session_seeks_total', 'counter', 'Seeks requested (FORWARD/BACKWARD or PLAY with Range).',
+               [(labels + '}', s.counters.seeks) for labels, s in rows])
+        paced = [(labels, s.pacing) for labels, s in rows if s.pacing is not None]
+        family('rtsp_session_lateness_seconds_mean', 'gauge', 'Mean frame send lateness.',
+               [(labels + '}', p.meanLateness()) for labels, p in paced])
+        family('rtsp_session_lateness_seconds_max', 'gauge', 'Worst frame send lateness.',
+               [(labels + '}', p.maxLateness) for labels, p in paced])
+        family('rtsp_session_frames_missed_total', 'counter', 'Frames skipped after falling an interval behind.',
+               [(labels + '}', p.missed) for labels, p in paced])
+
+        family('rtsp_sessions_active', 'gauge', 'Connected RTSP sessions.',
+               [('', len(sessions))])
+        family('rtsp_sessions_playing', 'gauge', 'Sessions in the PLAYING state.',
+               [('', sum(1 for s in sessions if STATES[s.state] == 'PLAYING'))])
+        if self.manager is not None:
+            manager = self.manager
+            family('rtsp_sessions_admitted_total', 'counter', 'SETUPs admitted.',
+                   [('', manager.admitted)])
+            family('rtsp_sessions_refused_total', 'counter', 'SETUPs refused for lack of room (453/503).',
+                   [('{reason="%s"}' % reason, count) for reason, count in sorted(manager.refused.items())])
+            family('rtsp_sessions_expired_total', 'counter', 'Sessions reaped after the timeout.',
+                   [('', manager.expired)])
+            family('rtsp_sessions_reserved_bits_per_second', 'gauge', 'Egress bit rate reserved by admitted sessions.',
+                   [('', manager.bitrate())])
+        if self.egress is not None:
+            family('rtsp_egress_packets_total', 'counter', 'RTP packets sent.',
+                   [('', self.egress.packets)])
+            family('rtsp_egress_packets_dropped_total', 'counter', 'RTP packets the kernel refused.',
+                   [('', self.egress.dropped)])
+            family('rtsp_egress_bytes_total', 'counter', 'RTP bytes queued for sending.',
+                   [('', self.egress.bytes)])
+            family('rtsp_egress_bits_per_second', 'gauge', 'Egress bit rate since the previous scrape.',
+                   [('', self.egressRate())])
+        if self.channels is not None:
+            channels = [('{channel="%s",mode="%s"}' % (c.name, c.mode()), c) for c in self.channels]
+            family('rtsp_channel_members', 'gauge', 'Sessions a live channel is delivering to.',
+                   [(labels, len(c.destinations)) for labels, c in channels])
+            family('rtsp_channel_frames_sent_total', 'counter', 'Frames a live channel read and packetized once.',
+                   [(labels, c.frames) for labels, c in channels])
+            family('rtsp_channel_packets_sent_total', 'counter', 'RTP packets a live channel queued, all members.',
+                   [(labels, c.packets) for labels, c in channels])
+        if self.frameStore is not None:
+            family('rtsp_frame_store_bytes', 'gauge', 'Media bytes held by the frame store.',
+                   [('', self.frameStore.memoryUsage())])
+        family('process_threads', 'gauge', 'Python threads in this process.',
+               [('', threading.active_count())])
+        family('process_uptime_seconds', 'gauge', 'Seconds since the metrics registry started.',
+               [('', time.monotonic() - self.started)])
+        return '\n'.join(out) + '\n'
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to log
+        pass
+
+class MetricsServer(ThreadingHTTPServer):
+    """HTTP endpoint serving a MetricsRegistry at /metrics on a background thread."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, registry, port, host='127.0.0.1', reusePort=False):
+        self.registry = registry
+        self.reusePort = reusePort
+        super().__init__((host, port), MetricsHandler)
+
+    def server_bind(self):
+        if self.reusePort:
+            # Lets a replacement worker bind while the old one drains
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
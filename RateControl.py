@@ -0,0 +1,71 @@
+class RateController:
+    """Per-session send rate driven by the loss in RTCP receiver reports.
+
+    Additive increase, multiplicative decrease on the frame send rate.
+    The media clock is not slowed down: below the nominal rate the
+    session skips frames, so a congested viewer sees fewer frames at the
+    right speed instead of random packet loss.
+
+    The same frame skipping carries trick play: at a Scale above 1x the
+    session keeps sending at most the nominal rate and steps over frames,
+    so fast-forward costs no more egress than normal play; below 1x it
+    sends every frame, more slowly.
+
+    Speed, unlike Scale, does not change what is shown: it multiplies the
+    send rate so a client can fill its readahead buffer faster than real
+    time, and costs egress in proportion.
+    """
+
+    # Fraction of packets lost in a report interval that counts as congestion
+    HIGH_LOSS = 0.10
+    # Loss at or below which the rate may grow again
+    LOW_LOSS = 0.02
+    DECREASE = 0.75
+    # Growth per clean report, as a fraction of the nominal rate
+    INCREASE = 0.10
+    # Never go below this fraction of the nominal rate
+    MIN_FRACTION = 0.25
+
+    def __init__(self, nominal):
+        self.nominal = nominal
+        self.rate = nominal
+        self.credit = 0.0
+        self.reports = 0
+        self.lastLoss = 0.0
+        # Playback speed from the PLAY Scale header; negative plays backwards
+        self.scale = 1.0
+        # Delivery speed from the PLAY Speed header
+        self.speed = 1.0
+
+    def onReport(self, lossRatio):
+        """Apply one report's loss ratio. Return the new send rate."""
+        self.reports += 1
+        self.lastLoss = lossRatio
+        if lossRatio > self.HIGH_LOSS:
+            self.rate = max(self.nominal * self.MIN_FRACTION, self.rate * self.DECREASE)
+        elif lossRatio <= self.LOW_LOSS:
+            self.rate = min(self.nominal, self.rate + self.nominal * self.INCREASE)
+        return self.rate
+
+    def setScale(self, scale):
+        """Change the playback speed. Return the new send rate."""
+        self.scale = scale
+        self.credit = 0.0
+        return self.sendRate()
+
+    def setSpeed(self, speed):
+        """Change the delivery speed. Return the new send rate."""
+        self.speed = speed
+        return self.sendRate()
+
+    def sendRate(self):
+        """Frames per second to send: the scaled media rate, capped by the adapted rate,
+        times the delivery speed."""
+        return min(self.rate, self.nominal * abs(self.scale)) * self.speed
+
+    def skip(self):
+        """Frames to skip before the next one sent, to keep the media clock at the scaled speed."""
+        self.credit += self.nominal * abs(self.scale) * self.speed / self.sendRate() - 1.0
+        skip = int(self.credit)
+        self.credit -= skip
+        return skip
@@ -0,0 +1,175 @@
+"""RTCP receiver reports (RFC 3550 section 6.4.2) and their routing on the server.
+
+RTCP runs next to RTP on the RTP port plus one. The client sends a
+receiver report about the session's stream every few seconds; the
+server hands each report block to the session it came from.
+"""
+import asyncio, selectors, socket, struct, threading
+
+from Log import getLogger
+
+log = getLogger('rtcp')
+
+PT_SR = 200
+PT_RR = 201
+# V/P/RC, packet type, length in 32-bit words minus one
+RTCP_HEADER = struct.Struct('!BBH')
+SSRC = struct.Struct('!I')
+# Source SSRC, fraction lost (8) + cumulative lost (24), extended highest
+# sequence number, interarrival jitter, last SR, delay since last SR
+REPORT_BLOCK = struct.Struct('!IIIIII')
+SENDER_INFO_SIZE = 20
+
+class ReportBlock:
+    """Reception statistics of one source, as carried in an SR or RR."""
+
+    def __init__(self, ssrc, fractionLost, cumulativeLost, highestSeq, jitter, lsr=0, dlsr=0):
+        self.ssrc = ssrc
+        # Fraction of packets lost since the previous report, 0..255 (x/256)
+        self.fractionLost = fractionLost
+        self.cumulativeLost = cumulativeLost
+        self.highestSeq = highestSeq
+        # In RTP timestamp units
+        self.jitter = jitter
+        self.lsr = lsr
+        self.dlsr = dlsr
+
+    def lossRatio(self):
+        return self.fractionLost / 256.0
+
+def encodeReceiverReport(ssrc, blocks):
+    """Return one RR packet from ssrc carrying up to 31 ReportBlocks."""
+    blocks = blocks[:31]
+    data = bytearray(RTCP_HEADER.size + SSRC.size + len(blocks) * REPORT_BLOCK.size)
+    RTCP_HEADER.pack_into(data, 0, 0x80 | len(blocks), PT_RR, len(data) // 4 - 1)
+    SSRC.pack_into(data, RTCP_HEADER.size, ssrc & 0xFFFFFFFF)
+    pos = RTCP_HEADER.size + SSRC.size
+    for b in blocks:
+        # Cumulative loss is a signed 24-bit field
+        lost = max(-0x800000, min(0x7FFFFF, b.cumulativeLost)) & 0xFFFFFF
+        REPORT_BLOCK.pack_into(data, pos, b.ssrc & 0xFFFFFFFF, min(255, b.fractionLost) << 24 | lost,
+                               b.highestSeq & 0xFFFFFFFF, int(b.jitter) & 0xFFFFFFFF,
+                               b.lsr & 0xFFFFFFFF, b.dlsr & 0xFFFFFFFF)
+        pos += REPORT_BLOCK.size
+    return bytes(data)
+
+def decodeReports(data):
+    """Return [(sender ssrc, [ReportBlock, ...])] for every SR and RR in a compound packet.
+
+    Other packet types are skipped; a truncated or malformed packet ends the parse."""
+    reports = []
+    pos = 0
+    while pos + RTCP_HEADER.size + SSRC.size <= len(data):
+        first, pt, length = RTCP_HEADER.unpack_from(data, pos)
+        end = pos + (length + 1) * 4
+        if first >> 6 != 2 or end > len(data):
+            break
+        if pt in (PT_SR, PT_RR):
+            sender, = SSRC.unpack_from(data, pos + RTCP_HEADER.size)
+            at = pos + RTCP_HEADER.size + SSRC.size + (SENDER_INFO_SIZE if pt == PT_SR else 0)
+            blocks = []
+            for _ in range(first & 0x1F):
+                if at + REPORT_BLOCK.size > end:
+                    break
+                ssrc, lost, highest, jitter, lsr, dlsr = REPORT_BLOCK.unpack_from(data, at)
+                cumulative = lost & 0xFFFFFF
+                if cumulative & 0x800000:
+                    cumulative -= 0x1000000
+                blocks.append(ReportBlock(ssrc, lost >> 24, cumulative, highest, jitter, lsr, dlsr))
+                at += REPORT_BLOCK.size
+            reports.append((sender, blocks))
+        pos = end
+    return reports
+
+def bindPair(host='0.0.0.0', attempts=64):
+    """Bind two UDP sockets on an even port and the odd port after it, the
+    RTP/RTCP pair of RFC 3550 section 11. Return (RTP socket, RTCP socket)."""
+    rejected = []
+    try:
+        for _ in range(attempts):
+            rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            rtp.bind((host, 0))
+            rejected.append(rtp)
+            port = rtp.getsockname()[1]
+            if port % 2:
+                continue
+            rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                rtcp.bind((host, port + 1))
+            except OSError:
+                rtcp.close()
+                continue
+            rejected.remove(rtp)
+            return rtp, rtcp
+        raise OSError("no free RTP/RTCP port pair")
+    finally:
+        # Held until the end, so the ephemeral range does not hand the same ports back
+        for sock in rejected:
+            sock.close()
+
+class RtcpReceiver:
+    """Receives RTCP on the server's sockets and passes report blocks to sessions.
+
+    Sessions are keyed by the address their reports come from, the client
+    host and its RTP port plus one, and get onReceiverReport(block) calls.
+    Reports are routed the same whichever of the sockets they arrive on;
+    socket i is the RTCP half of the pair whose RTP half is egress socket i.
+    """
+
+    def __init__(self, sockets=None):
+        if sockets is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('0.0.0.0', 0))
+            sockets = [sock]
+        self.sockets = sockets
+        self.sessions = {}
+        self.reports = 0
+
+    def port(self, index=0):
+        """Port of socket index, wrapping around for fewer sockets than egress slots."""
+        return self.sockets[index % len(self.sockets)].getsockname()[1]
+
+    def register(self, address, session):
+        self.sessions[address] = session
+
+    def unregister(self, address):
+        self.sessions.pop(address, None)
+
+    def datagramReceived(self, data, address):
+        session = self.sessions.get(address[:2])
+        if session is None:
+            return
+        for _, blocks in decodeReports(data):
+            for block in blocks:
+                self.reports += 1
+                try:
+                    session.onReceiverReport(block)
+                except Exception:
+                    log.warning("Report from %s failed", address, exc_info=True)
+
+    def start(self):
+        """Receive on a background thread."""
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        sel = selectors.DefaultSelector()
+        for sock in self.sockets:
+            sel.register(sock, selectors.EVENT_READ)
+        while True:
+            for key, _ in sel.select():
+                try:
+                    data, address = key.fileobj.recvfrom(2048)
+                except OSError:
+                    sel.close()
+                    return
+                self.datagramReceived(data, address)
+
+class RtcpProtocol(asyncio.DatagramProtocol):
+    """Feeds an RtcpReceiver from an asyncio datagram endpoint."""
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, address):
+        self.receiver.datagramReceived(data, address)
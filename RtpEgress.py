@@ -0,0 +1,190 @@
+import ctypes, ctypes.util, errno, itertools, socket, struct, sys
+
+from Log import getLogger
+
+log = getLogger('server')
+
+# struct iovec, struct mmsghdr and struct sockaddr_in in native layout
+IOVEC = struct.Struct('PN')
+MMSGHDR = struct.Struct('PIPNPNi0PI0P')
+SOCKADDR_IN = struct.Struct('=H2s4s8x')
+# Room for the RTP header and any payload header copied next to each message: the
+# largest is a first RFC 2435 fragment with restart and two 16-bit quantization tables
+HEADER_ROOM = 320
+
+def loadSendmmsg():
+    """Return libc's sendmmsg and the Py_buffer helpers, or None where unavailable."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    getBuffer = ctypes.pythonapi.PyObject_GetBuffer
+    getBuffer.argtypes = [ctypes.py_object, ctypes.c_void_p, ctypes.c_int]
+    releaseBuffer = ctypes.pythonapi.PyBuffer_Release
+    releaseBuffer.argtypes = [ctypes.c_void_p]
+    return sendmmsg, getBuffer, releaseBuffer
+
+class Py_buffer(ctypes.Structure):
+    _fields_ = [('buf', ctypes.c_void_p), ('obj', ctypes.c_void_p), ('len', ctypes.c_ssize_t),
+                ('itemsize', ctypes.c_ssize_t), ('readonly', ctypes.c_int), ('ndim', ctypes.c_int),
+                ('format', ctypes.c_char_p), ('shape', ctypes.c_void_p), ('strides', ctypes.c_void_p),
+                ('suboffsets', ctypes.c_void_p), ('internal', ctypes.c_void_p)]
+
+SENDMMSG = loadSendmmsg() if sys.platform.startswith('linux') else None
+PY_BUFFER_SIZE = ctypes.sizeof(Py_buffer)
+BUFFER_ADDRESS = struct.Struct('P' + 'x' * (Py_buffer.len.offset - struct.calcsize('P')) + 'n')
+
+class RtpEgress:
+    """Batched RTP sender shared by all sessions over a small pool of UDP sockets.
+
+    Sessions queue (header, payload) pairs during a scheduler wakeup and
+    flush() sends them all, by default with one sendmsg per packet and the
+    header and payload as separate iovecs, else plain sendto, so payloads
+    are never copied into the header.
+
+    mode='sendmmsg' sends one sendmmsg per socket through ctypes instead,
+    copying only the small header next to its message. It is opt-in: the
+    per-message ctypes work costs more under CPython than the syscalls it
+    saves (see Benchmark.py egress), and it relies on the layout of
+    Py_buffer.
+    """
+
+    def __init__(self, poolSize=4, batchSize=64, mode=None, sockets=None):
+        if sockets is None:
+            sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(poolSize)]
+        self.sockets = sockets
+        self.queues = [[] for _ in sockets]
+        self.batchSize = batchSize
+        if mode is None:
+            mode = 'sendmsg' if hasattr(socket.socket, 'sendmsg') else 'sendto'
+        self.mode = mode
+        self.send = getattr(self, '_' + mode)
+        self.rotation = itertools.count()
+        # Datagrams the kernel took; dropped counts the ones it refused or never got
+        self.packets = 0
+        self.dropped = 0
+        # Queued, whether or not sent
+        self.bytes = 0
+        if mode == 'sendmmsg':
+            if not SENDMMSG:
+                raise ValueError("sendmmsg is not available on this platform")
+            self.sendmmsg, self.getBuffer, self.releaseBuffer = SENDMMSG
+            # One contiguous mmsghdr array, then the iovecs, addresses and headers it points at
+            self.iovs = batchSize * MMSGHDR.size
+            self.names = self.iovs + batchSize * 2 * IOVEC.size
+            self.heads = self.names + batchSize * SOCKADDR_IN.size
+            self.arena = bytearray(self.heads + batchSize * HEADER_ROOM)
+            self.base = ctypes.addressof(ctypes.c_char.from_buffer(self.arena))
+            self.pins = bytearray(batchSize * PY_BUFFER_SIZE)
+            self.pinBase = ctypes.addressof(ctypes.c_char.from_buffer(self.pins))
+            self.sockaddrs = {}
+
+    def assign(self):
+        """Pick the pool socket a new session sends through."""
+        return next(self.rotation) % len(self.sockets)
+
+    def queue(self, slot, header, payload, address):
+        """Queue one packet on a pool socket until the next flush()."""
+        self.queues[slot].append((header, payload, address))
+        self.bytes += len(header) + len(payload)
+
+    def flush(self):
+        """Send everything queued since the last flush."""
+        for sock, pending in zip(self.sockets, self.queues):
+            if pending:
+                for i in range(0, len(pending), self.batchSize):
+                    batch = pending[i:i + self.batchSize]
+                    accounted = self.packets + self.dropped
+                    try:
+                        self.send(sock, batch)
+                    except Exception as e:
+                        # A bad destination costs what is left of its batch, not the packets
+                        # queued after it
+                        lost = len(batch) - (self.packets + self.dropped - accounted)
+                        log.warning("Dropped %d RTP packets: %r", lost, e)
+                        self.dropped += lost
+                pending.clear()
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def _sendto(self, sock, packets):
+        sent = 0
+        try:
+            for header, payload, address in packets:
+                try:
+                    sock.sendto(bytes(header) + payload, address)
+                    sent += 1
+                except (OSError, OverflowError):
+                    self.dropped += 1
+        finally:
+            self.packets += sent
+
+    def _sendmsg(self, sock, packets):
+        sent = 0
+        try:
+            for header, payload, address in packets:
+                try:
+                    sock.sendmsg((header, payload), (), 0, address)
+                    sent += 1
+                except (OSError, OverflowError):
+                    self.dropped += 1
+        finally:
+            self.packets += sent
+
+    def _sockaddr(self, address):
+        sockaddr = self.sockaddrs.get(address)
+        if sockaddr is None:
+            sockaddr = SOCKADDR_IN.pack(socket.AF_INET, address[1].to_bytes(2, 'big'),
+                                        socket.inet_aton(address[0]))
+            self.sockaddrs[address] = sockaddr
+        return sockaddr
+
+    def _sendmmsg(self, sock, packets):
+        arena = self.arena
+        base = self.base
+        count = len(packets)
+        pinned = 0
+        # Messages the kernel took, as opposed to ones skipped or dropped
+        delivered = 0
+        try:
+            for i, (header, payload, address) in enumerate(packets):
+                iov = self.iovs + i * 2 * IOVEC.size
+                name = self.names + i * SOCKADDR_IN.size
+                head = self.heads + i * HEADER_ROOM
+                size = len(header)
+                if size > HEADER_ROOM:
+                    raise ValueError("%d-byte RTP header does not fit HEADER_ROOM" % size)
+                arena[head:head + size] = header
+                arena[name:name + SOCKADDR_IN.size] = self._sockaddr(address)
+                # Pin the payload so its address stays valid until the syscall returns
+                self.getBuffer(payload, self.pinBase + i * PY_BUFFER_SIZE, 0)
+                pinned += 1
+                bufAddress, length = BUFFER_ADDRESS.unpack_from(self.pins, i * PY_BUFFER_SIZE)
+                IOVEC.pack_into(arena, iov, base + head, size)
+                IOVEC.pack_into(arena, iov + IOVEC.size, bufAddress, length)
+                MMSGHDR.pack_into(arena, i * MMSGHDR.size, base + name, SOCKADDR_IN.size,
+                                  base + iov, 2, 0, 0, 0, 0)
+            fd = sock.fileno()
+            sent = 0
+            while sent < count:
+                n = self.sendmmsg(fd, base + sent * MMSGHDR.size, count - sent, 0)
+                if n >= 0:
+                    sent += n
+                    delivered += n
+                    continue
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.dropped += count - sent
+                    break
+                if err != errno.EINTR:
+                    # Skip the message the kernel refused and carry on
+                    self.dropped += 1
+                    sent += 1
+        finally:
+            self.packets += delivered
+            for i in range(pinned):
+                self.releaseBuffer(self.pinBase + i * PY_BUFFER_SIZE)
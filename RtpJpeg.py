@@ -0,0 +1,446 @@
+"""JPEG over RTP (RFC 2435): fragmentation and reassembly.
+
+The sender strips the JFIF headers of each frame and sends only its
+entropy-coded scan data, cut into MTU-sized fragments. Every fragment
+carries the 8-byte JPEG main header (fragment offset, type, Q, width/8,
+height/8), plus a restart marker header for types 64 and 65. The first
+fragment of a frame also carries the frame's quantization tables, as Q
+is 255. The last fragment has the RTP marker bit set. The receiver
+rebuilds the JFIF headers from these fields and the standard Huffman
+tables, following RFC 2435 appendix B.
+
+Only baseline YCbCr frames with 4:2:2 or 4:2:0 sampling and the standard
+Huffman tables can be described this way. Any other frame (progressive,
+4:4:4, grayscale, optimized Huffman tables) is sent whole instead: the
+complete JFIF stream, cut the same way, as type 255 with Q 0. RFC 2435
+leaves types 128 to 255 to be defined by the session; FrameAssembler
+hands such frames on as they arrived.
+"""
+import struct, sys, threading
+from collections import deque
+
+from RtpPacket import RtpEncoder
+from Log import getLogger
+
+log = getLogger('server')
+
+# Type-specific (8) + fragment offset (24), type, Q, width / 8, height / 8
+JPEG_HEADER = struct.Struct('!IBBBB')
+# Restart interval, then F (1), L (1) and restart count (14); types 64 to 127 only
+RESTART_HEADER = struct.Struct('!HH')
+# MBZ, precision (bit i set: table i is 16-bit), length of the table data that follows
+QTABLE_HEADER = struct.Struct('!BBH')
+# RTP and JPEG main header packed together
+PACKET_HEADER = struct.Struct('!BBHII' + 'IBBBB')
+# The per-session fields of an RTP header, from byte 2: sequence number, timestamp, SSRC
+SESSION_FIELDS = struct.Struct('!HII')
+# Q from 128 up: the frame's own quantization tables go in its first fragment
+JPEG_Q = 255
+# Dynamic type (RFC 2435 3.1.3) of frames sent as complete JFIF streams, with Q 0
+JFIF_TYPE = 255
+# Restart intervals are not aligned with fragments: F and L set, count 0x3FFF (RFC 2435 3.1.7)
+RESTART_UNALIGNED = 0xFFFF
+# IPv4 + UDP headers
+IP_UDP_OVERHEAD = 28
+DEFAULT_MTU = 1500
+
+# Standard Huffman tables (ITU T.81 annex K.3) as DHT segment bodies: class/id, 16 counts, symbols
+LUM_DC = bytes([0x00, 0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]) + bytes(range(12))
+CHM_DC = bytes([0x01, 0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0]) + bytes(range(12))
+LUM_AC = bytes([0x10, 0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d]) + bytes.fromhex(
+    '01020300041105122131410613516107227114328191a1082342b1c11552d1f0'
+    '2433627282090a161718191a25262728292a3435363738393a43444546474849'
+    '4a535455565758595a636465666768696a737475767778797a83848586878889'
+    '8a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5'
+    'c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8'
+    'f9fa')
+CHM_AC = bytes([0x11, 0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77]) + bytes.fromhex(
+    '000102031104052131061241510761711322328108144291a1b1c109233352f0'
+    '156272d10a162434e125f11718191a262728292a35363738393a434445464748'
+    '494a535455565758595a636465666768696a737475767778797a828384858687'
+    '88898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3'
+    'c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae2e3e4e5e6e7e8e9eaf2f3f4f5f6f7f8'
+    'f9fa')
+STANDARD_HUFFMAN = {t[0]: t for t in (LUM_DC, LUM_AC, CHM_DC, CHM_AC)}
+
+# Quantization tables for Q 1 to 99, in zigzag order (RFC 2435 appendix A)
+LUMA_QUANTIZER = bytes([
+    16, 11, 12, 14, 12, 10, 16, 14, 13, 14, 18, 17, 16, 19, 24, 40,
+    26, 24, 22, 22, 24, 49, 35, 37, 29, 40, 58, 51, 61, 60, 57, 51,
+    56, 55, 64, 72, 92, 78, 64, 68, 87, 69, 55, 56, 80, 109, 81, 87,
+    95, 98, 103, 104, 103, 62, 77, 113, 121, 112, 100, 120, 92, 101, 103, 99])
+CHROMA_QUANTIZER = bytes([17, 18, 18, 24, 21, 24, 47, 26, 26, 47, 99, 66, 56, 66] + [99] * 50)
+
+class JpegLayout:
+    """What RFC 2435 needs from one JFIF frame: its type, size in 8-pixel
+    blocks, restart interval, quantization tables and where its scan data is."""
+
+    __slots__ = ('type', 'width', 'height', 'restart', 'precision', 'tables', 'scanStart', 'scanEnd')
+
+def parseJpeg(frame):
+    """Return the JpegLayout of a JFIF frame, or None if RFC 2435 cannot carry it."""
+    end = len(frame)
+    if end < 4 or frame[0] != 0xFF or frame[1] != 0xD8:
+        return None
+    tables = {}
+    sof = None
+    restart = 0
+    pos = 2
+    while True:
+        if pos + 4 > end or frame[pos] != 0xFF:
+            return None
+        marker = frame[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        length = frame[pos + 2] << 8 | frame[pos + 3]
+        body = pos + 4
+        segmentEnd = pos + 2 + length
+        if segmentEnd > end:
+            return None
+        if marker == 0xDB:
+            while body < segmentEnd:
+                precision, index = frame[body] >> 4, frame[body] & 0x0F
+                size = 128 if precision else 64
+                tables[index] = (precision, bytes(frame[body + 1:body + 1 + size]))
+                body += 1 + size
+        elif marker in (0xC0, 0xC1):
+            sof = body
+        elif marker in (0xC2, 0xC3) or 0xC5 <= marker <= 0xCF and marker != 0xC8 and marker != 0xCC:
+            # Progressive, lossless or arithmetic coded
+            return None
+        elif marker == 0xC4:
+            while body < segmentEnd:
+                size = 17 + sum(frame[body + 1:body + 17])
+                if STANDARD_HUFFMAN.get(frame[body]) != bytes(frame[body:body + size]):
+                    return None
+                body += size
+        elif marker == 0xDD:
+            restart = frame[body] << 8 | frame[body + 1]
+        elif marker == 0xDA:
+            # One interleaved scan of Y, Cb, Cr on the standard table pairs
+            if sof is None or frame[body] != 3 or bytes(frame[body + 2:body + 7:2]) != b'\x00\x11\x11':
+                return None
+            scanStart = segmentEnd
+            break
+        pos = segmentEnd
+    height = frame[sof + 1] << 8 | frame[sof + 2]
+    width = frame[sof + 3] << 8 | frame[sof + 4]
+    if frame[sof] != 8 or frame[sof + 5] != 3 or not 0 < width <= 2040 or not 0 < height <= 2040:
+        return None
+    (_, ySampling, yTable), (_, cbSampling, cTable), (_, crSampling, crTable) = \
+        [frame[sof + 6 + 3 * i:sof + 9 + 3 * i] for i in range(3)]
+    # Type 0 is 4:2:2 and type 1 4:2:0 (RFC 2435 section 4.1)
+    if ySampling not in (0x21, 0x22) or cbSampling != 0x11 or crSampling != 0x11 or cTable != crTable \
+            or yTable not in tables or cTable not in tables:
+        return None
+    layout = JpegLayout()
+    layout.type = (0 if ySampling == 0x21 else 1) + (64 if restart else 0)
+    layout.width = (width + 7) // 8
+    layout.height = (height + 7) // 8
+    layout.restart = restart
+    layout.precision = tables[yTable][0] | tables[cTable][0] << 1
+    layout.tables = tables[yTable][1] + tables[cTable][1]
+    layout.scanStart = scanStart
+    layout.scanEnd = end - 2 if frame[end - 2] == 0xFF and frame[end - 1] == 0xD9 else end
+    return layout
+
+def makeTables(q):
+    """Luma and chroma quantization tables for Q 1 to 127 (RFC 2435 appendix A)."""
+    factor = min(max(q, 1), 99)
+    scale = 5000 // factor if factor < 50 else 200 - factor * 2
+    return bytes(min(max((v * scale + 50) // 100, 1), 255)
+                 for v in LUMA_QUANTIZER + CHROMA_QUANTIZER)
+
+def makeHeaders(jpegType, width, height, tables, precision=0, restart=0):
+    """JFIF headers, from SOI to SOS, for scan data received over RTP (RFC 2435 appendix B)."""
+    out = bytearray(b'\xff\xd8')
+    pos = 0
+    for index in range(2):
+        size = 128 if precision >> index & 1 else 64
+        out += struct.pack('!BBHB', 0xFF, 0xDB, 3 + size, (precision >> index & 1) << 4 | index)
+        out += tables[pos:pos + size]
+        pos += size
+    # Y, then Cb and Cr on the chroma table
+    ySampling = 0x21 if jpegType & 0x3F == 0 else 0x22
+    out += struct.pack('!BBHBHHB', 0xFF, 0xC0, 17, 8, height * 8, width * 8, 3)
+    out += bytes([0, ySampling, 0, 1, 0x11, 1, 2, 0x11, 1])
+    if restart:
+        out += struct.pack('!BBHH', 0xFF, 0xDD, 4, restart)
+    for table in (LUM_DC, LUM_AC, CHM_DC, CHM_AC):
+        out += struct.pack('!BBH', 0xFF, 0xC4, 2 + len(table)) + table
+    out += bytes([0xFF, 0xDA, 0, 12, 3, 0, 0x00, 1, 0x11, 2, 0x11, 0, 63, 0])
+    return bytes(out)
+
+class JpegEncoder(RtpEncoder):
+    """Splits JPEG frames into MTU-sized RTP packets for one session.
+
+    All headers of a frame are packed into one buffer the encoder reuses,
+    so they stay valid until the next encodeFrame() or encodeFragments()
+    call; payloads are memoryview slices of the frame.
+    """
+
+    def __init__(self, pt=26, ssrc=0, mtu=DEFAULT_MTU, name=None):
+        super().__init__(pt, ssrc)
+        # What the frames are of, for the log
+        self.name = name
+        self.wholeReported = False
+        self.maxPayload = mtu - IP_UDP_OVERHEAD - PACKET_HEADER.size
+        self.headers = bytearray(PACKET_HEADER.size * 16 + QTABLE_HEADER.size + 128)
+        self.headerView = memoryview(self.headers)
+
+    def encodeFrame(self, frame, seqnum, timestamp):
+        """Return ([(header, payload), ...], next seqnum) for one frame."""
+        fragments = JpegFragments(frame, self.maxPayload, self.pt)
+        if fragments.whole and not self.wholeReported:
+            reportWhole(self.name)
+            self.wholeReported = True
+        return self.encodeFragments(fragments, seqnum, timestamp)
+
+    def encodeFragments(self, fragments, seqnum, timestamp):
+        """Like encodeFrame(), for a frame packetized ahead (a JpegFragments): only copy
+        its header template and patch in this session's sequence numbers, timestamp
+        and SSRC."""
+        template = fragments.template
+        size = len(template)
+        if len(self.headers) < size:
+            self.headers = bytearray(size)
+            self.headerView = memoryview(self.headers)
+        headers = self.headers
+        headers[:size] = template
+        view = self.headerView
+        frame = memoryview(fragments.frame)[:fragments.scanEnd]
+        timestamp &= 0xFFFFFFFF
+        ssrc = self.ssrc
+        pack = SESSION_FIELDS.pack_into
+        step = fragments.step
+        header = fragments.header
+        # The first header may have quantization tables after it, and a shorter payload
+        pack(headers, 2, seqnum & 0xFFFF, timestamp, ssrc)
+        start = fragments.firstHeader
+        offset = fragments.scanStart + fragments.firstStep
+        packets = [(view[:start], frame[fragments.scanStart:offset])]
+        seqnum += 1
+        while start < size:
+            end = start + header
+            pack(headers, start + 2, seqnum & 0xFFFF, timestamp, ssrc)
+            packets.append((view[start:end], frame[offset:offset + step]))
+            start = end
+            offset += step
+            seqnum += 1
+        return packets, seqnum
+
+def reportWhole(name):
+    log.warning("%s: frames RFC 2435 cannot describe (not baseline 4:2:2/4:2:0 YCbCr with "
+                "standard Huffman tables) are sent whole as JPEG type %d", name or 'media', JFIF_TYPE)
+
+class JpegFragments:
+    """The RFC 2435 fragments of one frame, computed once and shared by sessions.
+
+    template holds the headers of every fragment back to back, complete but
+    for the sequence number, timestamp and SSRC: firstHeader bytes for the
+    first fragment, header bytes for each one after it. Payloads are not
+    stored: they are the frame's scan data cut every step bytes, the first
+    one firstStep bytes long. When whole is set, the scan data is the whole
+    frame, sent as JFIF_TYPE.
+    """
+
+    __slots__ = ('template', 'frame', 'whole', 'scanStart', 'scanEnd', 'firstHeader', 'header',
+                 'firstStep', 'step')
+
+    def __init__(self, frame, maxPayload, pt=26):
+        self.frame = frame
+        layout = parseJpeg(frame)
+        if layout is not None and maxPayload - RESTART_HEADER.size - QTABLE_HEADER.size \
+                - len(layout.tables) <= 0:
+            # The tables would not fit in a packet
+            layout = None
+        self.whole = layout is None
+        if layout is None:
+            jpegType, q, width, height = JFIF_TYPE, 0, 0, 0
+            restart, precision, tables = 0, 0, b''
+            self.scanStart, self.scanEnd = 0, len(frame)
+        else:
+            jpegType, q, width, height = layout.type, JPEG_Q, layout.width, layout.height
+            restart, precision, tables = layout.restart, layout.precision, layout.tables
+            self.scanStart, self.scanEnd = layout.scanStart, layout.scanEnd
+        extra = RESTART_HEADER.size if restart else 0
+        tablesSize = QTABLE_HEADER.size + len(tables) if tables else 0
+        self.header = PACKET_HEADER.size + extra
+        self.firstHeader = self.header + tablesSize
+        self.step = maxPayload - extra
+        self.firstStep = self.step - tablesSize
+        size = self.scanEnd - self.scanStart
+        count = 1 + max(0, -(-(size - self.firstStep) // self.step))
+        template = bytearray(self.firstHeader + (count - 1) * self.header)
+        pos = 0
+        offset = 0
+        for i in range(count):
+            PACKET_HEADER.pack_into(template, pos, 0x80, (i == count - 1) << 7 | pt, 0, 0, 0,
+                                    offset, jpegType, q, width, height)
+            pos += PACKET_HEADER.size
+            if extra:
+                RESTART_HEADER.pack_into(template, pos, restart, RESTART_UNALIGNED)
+                pos += extra
+            if i == 0 and tables:
+                QTABLE_HEADER.pack_into(template, pos, 0, precision, len(tables))
+                pos += QTABLE_HEADER.size
+                template[pos:pos + len(tables)] = tables
+                pos += len(tables)
+            offset += self.firstStep if i == 0 else self.step
+        self.template = bytes(template)
+
+    def nbytes(self):
+        """Memory held beyond the frame itself."""
+        return sys.getsizeof(self) + sys.getsizeof(self.template)
+
+class FragmentCache:
+    """Every frame of one media file as JpegFragments, packetized on first use.
+
+    One cache serves all sessions sending the media with the same packet
+    size and payload type. Two sessions packetizing the same frame at once
+    both do the work, but only the first result is kept and charged.
+
+    charge(n) is called with the bytes of every frame about to be kept and
+    returns whether the budget has room for them; a frame it refuses is
+    handed out but not kept. trim() drops everything kept; the cache then
+    fills again as frames are asked for, as far as charge() allows.
+    """
+
+    def __init__(self, frames, maxPayload, pt=26, charge=None, name=None):
+        self.frames = frames
+        self.maxPayload = maxPayload
+        self.pt = pt
+        self.charge = charge
+        # The media file, for the log
+        self.name = name
+        self.wholeReported = False
+        self.lock = threading.Lock()
+        self.fragments = [None] * len(frames)
+        self.nbytes = 0
+
+    def get(self, index):
+        """The JpegFragments of frame index."""
+        fragments = self.fragments[index]
+        if fragments is not None:
+            return fragments
+        fragments = JpegFragments(self.frames[index], self.maxPayload, self.pt)
+        if fragments.whole and not self.wholeReported:
+            reportWhole(self.name)
+            self.wholeReported = True
+        nbytes = fragments.nbytes()
+        with self.lock:
+            kept = self.fragments[index]
+            if kept is not None:
+                # Another session packetized it first
+                return kept
+            if self.charge is None or self.charge(nbytes):
+                self.fragments[index] = fragments
+                self.nbytes += nbytes
+        return fragments
+
+    def trim(self):
+        """Drop every frame kept. Return the bytes freed."""
+        with self.lock:
+            self.fragments = [None] * len(self.frames)
+            freed, self.nbytes = self.nbytes, 0
+        return freed
+
+class PartialFrame:
+    def __init__(self, seqnum):
+        self.data = bytearray()
+        self.offsets = set()
+        self.received = 0
+        self.size = None
+        self.firstSeq = seqnum
+        # (type, width / 8, height / 8, Q, restart interval, (precision, tables) or None) of fragment 0
+        self.header = None
+
+class FrameAssembler:
+    """Reassembles JPEG frames from RFC 2435 fragments in any arrival order.
+
+    Fragments are grouped by RTP timestamp and their scan data written at
+    their fragment offset. A frame is released once its marker fragment and
+    every byte before it have arrived, with the JFIF headers rebuilt in
+    front of it. At most maxPending incomplete frames are kept; beyond that
+    the oldest is dropped and counted as lost.
+    """
+
+    def __init__(self, maxPending=4):
+        self.maxPending = maxPending
+        self.pending = {}
+        # Timestamps of recently released frames, so stray duplicates do not reopen them
+        self.released = deque(maxlen=maxPending * 2)
+        # Quantization tables last received for each Q from 128 up, for senders that only send them once
+        self.tables = {}
+        self.framesComplete = 0
+        self.framesLost = 0
+        self.fragments = 0
+        self.duplicates = 0
+
+    def feed(self, packet):
+        """Add one RTP packet (an RtpPacket). Return (timestamp, first seqnum, frame bytes) or None."""
+        payload = packet.getPayload()
+        offset, jpegType, q, width, height = JPEG_HEADER.unpack_from(payload)
+        offset &= 0xFFFFFF
+        pos = JPEG_HEADER.size
+        restart = 0
+        if 64 <= jpegType < 128:
+            restart, _ = RESTART_HEADER.unpack_from(payload, pos)
+            pos += RESTART_HEADER.size
+        tables = None
+        if offset == 0 and q >= 128:
+            _, precision, length = QTABLE_HEADER.unpack_from(payload, pos)
+            pos += QTABLE_HEADER.size
+            if length:
+                tables = self.tables[q] = (precision, bytes(payload[pos:pos + length]))
+            pos += length
+        data = payload[pos:]
+        self.fragments += 1
+
+        timestamp = packet.timestamp()
+        frame = self.pending.get(timestamp)
+        if frame is None:
+            if timestamp in self.released:
+                self.duplicates += 1
+                return None
+            frame = self.pending[timestamp] = PartialFrame(packet.seqNum())
+            if len(self.pending) > self.maxPending:
+                oldest = next(iter(self.pending))
+                del self.pending[oldest]
+                self.framesLost += 1
+        if offset in frame.offsets:
+            self.duplicates += 1
+            return None
+        frame.offsets.add(offset)
+        if offset == 0:
+            frame.firstSeq = packet.seqNum()
+            frame.header = (jpegType, width, height, q, restart, tables)
+        end = offset + len(data)
+        if len(frame.data) < end:
+            frame.data.extend(bytes(end - len(frame.data)))
+        frame.data[offset:end] = data
+        frame.received += len(data)
+        if packet.marker():
+            frame.size = end
+        if frame.size is not None and frame.received >= frame.size:
+            del self.pending[timestamp]
+            self.released.append(timestamp)
+            jpegType, width, height, q, restart, tables = frame.header
+            if jpegType == JFIF_TYPE:
+                # Sent whole: already a complete JFIF stream
+                self.framesComplete += 1
+                return timestamp, frame.firstSeq, bytes(frame.data[:frame.size])
+            if q < 128:
+                tables = (0, makeTables(q))
+            elif tables is None:
+                tables = self.tables.get(q)
+            if tables is None:
+                # Q from 128 up with no tables received for it yet: nothing to decode with
+                self.framesLost += 1
+                return None
+            self.framesComplete += 1
+            headers = makeHeaders(jpegType, width, height, tables[1], tables[0], restart)
+            return timestamp, frame.firstSeq, headers + frame.data[:frame.size] + b'\xff\xd9'
+        return None
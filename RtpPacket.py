@@ -1,88 +1,109 @@
-import sys
+import random, struct
 from time import time
 HEADER_SIZE = 12
+# Media clock rate of video payloads (RFC 3551)
+VIDEO_CLOCK_RATE = 90000
 
-class RtpPacket:	
+# V/P/X/CC, M/PT, sequence number, timestamp, SSRC
+RTP_HEADER = struct.Struct('!BBHII')
+
+class RtpPacket:
 	header = bytearray(HEADER_SIZE)
-	
+
 	def __init__(self):
 		pass
+
+	def encode(self, version, padding, extension, cc, seqnum, marker, pt, ssrc, payload, timestamp=None):
+		"""Encode the RTP packet with header fields and payload.
 		
-	def encode(self, version, padding, extension, cc, seqnum, marker, pt, ssrc, payload):
-		"""Encode the RTP packet with header fields and payload."""
-		timestamp = int(time())
+		Without a timestamp, the wall clock is sampled at 90 kHz."""
+		if timestamp is None:
+			timestamp = int(time() * VIDEO_CLOCK_RATE)
 		self.header = bytearray(HEADER_SIZE)
-		#--------------
-		# TO COMPLETE
-		#--------------
-		# Fill the header bytearray with RTP header fields
-
-		#RTP-version filed(V), must set to 2
-		#padding(P),extension(X),number of contributing sources(CC) and marker(M) fields all set to zero in this lab
-
-		#Because we have no other contributing sources(field CC == 0),the CSRC-field does not exist
-		#Thus the length of the packet header is therefore 12 bytes
-
-
-			#Above all done in ServerWorker.py
-
-		# ...
-		#header[] =
-
-		#header[0] = version + padding + extension + cc + seqnum + marker + pt + ssrc
-		self.header[0] = version << 6
-		self.header[0] = self.header[0] | padding << 5
-		self.header[0] = self.header[0] | extension << 4
-		self.header[0] = self.header[0] | cc
-		self.header[1] = marker << 7
-		self.header[1] = self.header[1] | pt
-
-		self.header[2] = seqnum >> 8
-		self.header[3] = seqnum
-
-		self.header[4] = (timestamp >> 24) & 0xFF
-		self.header[5] = (timestamp >> 16) & 0xFF
-		self.header[6] = (timestamp >> 8) & 0xFF
-		self.header[7] = timestamp & 0xFF
+		RTP_HEADER.pack_into(self.header, 0,
+			version << 6 | padding << 5 | extension << 4 | cc,
+			marker << 7 | pt,
+			seqnum & 0xFFFF, timestamp & 0xFFFFFFFF, ssrc & 0xFFFFFFFF)
+		self.setFields(version, marker, pt, seqnum & 0xFFFF, timestamp & 0xFFFFFFFF, ssrc)
+		self.payload = payload
 
-		self.header[8] = ssrc >> 24
-		self.header[9] = ssrc >> 16
-		self.header[10] = ssrc >> 8
-		self.header[11] = ssrc
+	def decode(self, byteStream):
+		"""Decode the RTP packet; all header fields come from one unpack."""
+		first, second, seqnum, timestamp, ssrc = RTP_HEADER.unpack_from(byteStream)
+		self.setFields(first >> 6, second >> 7, second & 127, seqnum, timestamp, ssrc)
+		self.payload = memoryview(byteStream)[HEADER_SIZE:]
 
+	def setFields(self, version, marker, pt, seqnum, timestamp, ssrc):
+		self.fields = (version, marker, pt, seqnum, timestamp, ssrc)
 
-		# Get the payload from the argument
-		# self.payload = ...
-		self.payload = payload
-		
-	def decode(self, byteStream):
-		"""Decode the RTP packet."""
-		self.header = bytearray(byteStream[:HEADER_SIZE])
-		self.payload = byteStream[HEADER_SIZE:]
-	
 	def version(self):
 		"""Return RTP version."""
-		return int(self.header[0] >> 6)
-	
+		return self.fields[0]
+
 	def seqNum(self):
 		"""Return sequence (frame) number."""
-		seqNum = self.header[2] << 8 | self.header[3]
-		return int(seqNum)
-	
+		return self.fields[3]
+
 	def timestamp(self):
 		"""Return timestamp."""
-		timestamp = self.header[4] << 24 | self.header[5] << 16 | self.header[6] << 8 | self.header[7]
-		return int(timestamp)
-	
+		return self.fields[4]
+
 	def payloadType(self):
 		"""Return payload type."""
-		pt = self.header[1] & 127
-		return int(pt)
-	
+		return self.fields[2]
+
+	def marker(self):
+		"""Return marker bit."""
+		return self.fields[1]
+
+	def ssrc(self):
+		"""Return synchronization source identifier."""
+		return self.fields[5]
+
 	def getPayload(self):
 		"""Return payload."""
 		return self.payload
-		
+
 	def getPacket(self):
 		"""Return RTP packet."""
-		return self.header + self.payload
\ No newline at end of file
+		return self.header + self.payload
+
+class RtpEncoder:
+	"""Per-session RTP header encoder that never copies or allocates.
+
+	The header is packed with one struct call into a buffer the encoder
+	reuses, and returned separately from the payload so the two can go
+	out as scatter-gather iovecs. The returned header is only valid until
+	the next encode() call.
+	"""
+
+	def __init__(self, pt=26, ssrc=0):
+		self.buffer = bytearray(HEADER_SIZE)
+		self.view = memoryview(self.buffer)
+		self.pt = pt
+		self.ssrc = ssrc
+
+	def encode(self, seqnum, timestamp, payload, marker=0):
+		"""Return (header, payload) of one RTP version 2 packet."""
+		RTP_HEADER.pack_into(self.buffer, 0, 0x80, marker << 7 | self.pt,
+			seqnum & 0xFFFF, timestamp & 0xFFFFFFFF, self.ssrc)
+		return self.view, payload
+
+class RtpClock:
+	"""Per-session RTP identity and media clock (RFC 3550 section 5.1).
+
+	SSRC, first sequence number and timestamp offset are random. Timestamps
+	follow the presentation time of the media, so they are right whatever
+	the send time, and sequence numbers are owned by the session, not the
+	media position, so they stay continuous across seeks.
+	"""
+
+	def __init__(self, clockRate=VIDEO_CLOCK_RATE):
+		self.clockRate = clockRate
+		self.ssrc = random.getrandbits(32)
+		self.seq = random.getrandbits(16)
+		self.offset = random.getrandbits(32)
+
+	def timestamp(self, seconds):
+		"""RTP timestamp of a presentation time in seconds."""
+		return (self.offset + int(round(seconds * self.clockRate))) & 0xFFFFFFFF
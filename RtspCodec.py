@@ -0,0 +1,230 @@
+"""Incremental RTSP/1.0 message codec shared by the servers and the client.
+
+Messages are framed by the empty line that ends the header block (CRLF,
+though bare LF is tolerated) plus Content-Length bytes of body, so a
+parser can be fed whatever each read returns: several pipelined
+messages at once, or one message split across any number of reads.
+"""
+import re
+
+RTSP_VERSION = 'RTSP/1.0'
+CRLF = '\r\n'
+# Longest header block accepted before the connection is considered garbage
+MAX_HEADER_SIZE = 8192
+MAX_BODY_SIZE = 65536
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    453: 'Not Enough Bandwidth',
+    454: 'Session Not Found',
+    455: 'Method Not Valid in This State',
+    461: 'Unsupported Transport',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+}
+
+HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+class RtspError(Exception):
+    """A malformed RTSP message; the connection cannot be resynchronized."""
+
+class RtspMessage:
+    """One parsed RTSP request or response.
+
+    Requests have method, uri and version; responses have version, code
+    and reason. Header names are matched case-insensitively.
+    """
+
+    def __init__(self, startLine, headers, body=b''):
+        self.startLine = startLine
+        self.headers = headers
+        self.body = body
+        parts = startLine.split(' ', 2)
+        if len(parts) < 2:
+            raise RtspError('bad start line: %r' % startLine)
+        if parts[0].startswith('RTSP/'):
+            self.version = parts[0]
+            self.method = self.uri = None
+            try:
+                self.code = int(parts[1])
+            except ValueError:
+                raise RtspError('bad status code: %r' % startLine)
+            self.reason = parts[2] if len(parts) > 2 else ''
+        else:
+            self.method = parts[0]
+            self.uri = parts[1]
+            self.version = parts[2] if len(parts) > 2 else RTSP_VERSION
+            self.code = self.reason = None
+
+    def isResponse(self):
+        return self.code is not None
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def cseq(self):
+        """The CSeq header as an int, or None."""
+        value = self.header('CSeq')
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def session(self):
+        """The session id, without parameters such as ;timeout=, or None."""
+        value = self.header('Session')
+        return value.split(';', 1)[0].strip() if value else None
+
+    def transport(self):
+        """The Transport header as a dict; see parseTransport()."""
+        value = self.header('Transport')
+        return parseTransport(value) if value else None
+
+    def range(self):
+        """The Range header as (start, end) npt seconds; see parseRange()."""
+        value = self.header('Range')
+        return parseRange(value) if value else None
+
+    def scale(self):
+        """The Scale header as a non-zero float, or None when absent."""
+        value = self.header('Scale')
+        return parseRate(value) if value is not None else None
+
+    def speed(self):
+        """The Speed header (delivery speed, not playback speed) as a positive float, or None."""
+        value = self.header('Speed')
+        if value is None:
+            return None
+        speed = parseRate(value)
+        if speed < 0:
+            raise RtspError('bad speed: %r' % value)
+        return speed
+
+def parseTransport(value):
+    """Parse the first transport spec into a dict.
+
+    The protocol (e.g. 'RTP/AVP' or 'RTP/AVP/UDP') is under 'protocol';
+    parameters map to their value or True, and port ranges such as
+    client_port=5000-5001 become a tuple of ints.
+    """
+    spec = value.split(',', 1)[0].strip()
+    fields = spec.split(';')
+    transport = {'protocol': fields[0].strip()}
+    for field in fields[1:]:
+        name, sep, param = field.strip().partition('=')
+        if not name:
+            continue
+        if not sep:
+            transport[name] = True
+        elif name.endswith('port'):
+            try:
+                transport[name] = tuple(int(p) for p in param.split('-'))
+            except ValueError:
+                raise RtspError('bad port range: %r' % param)
+        else:
+            transport[name] = param
+    return transport
+
+def parseRange(value):
+    """Parse 'npt=start-[end]' into (start, end) seconds; end is None when open."""
+    unit, _, span = value.strip().partition('=')
+    if unit.strip() != 'npt':
+        raise RtspError('unsupported range unit: %r' % value)
+    span = span.split(';', 1)[0]
+    start, sep, end = span.partition('-')
+    if not sep:
+        raise RtspError('bad range: %r' % value)
+    try:
+        start = 0.0 if start.strip() in ('', 'now') else float(start)
+        end = float(end) if end.strip() else None
+    except ValueError:
+        raise RtspError('bad range: %r' % value)
+    return start, end
+
+def parseRate(value):
+    """Parse a Scale or Speed value into a finite, non-zero float."""
+    try:
+        rate = float(value)
+    except ValueError:
+        raise RtspError('bad rate: %r' % value)
+    if not 0 < abs(rate) < float('inf'):
+        raise RtspError('bad rate: %r' % value)
+    return rate
+
+class RtspParser:
+    """Turns a byte stream into RtspMessages, however it is split into reads."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pending = None
+
+    def feed(self, data):
+        """Add received bytes. Return the list of messages completed by them."""
+        self.buffer += data
+        buffer = self.buffer
+        messages = []
+        # Consume by offset and compact once, so a large pipelined read stays linear
+        pos = 0
+        while True:
+            if self.pending is None:
+                end = HEADER_END.search(buffer, pos)
+                if end is None:
+                    if len(buffer) - pos > MAX_HEADER_SIZE:
+                        raise RtspError('header block too long')
+                    break
+                self.pending = self.parseHead(bytes(buffer[pos:end.start()]))
+                pos = end.end()
+            startLine, headers, length = self.pending
+            if len(buffer) - pos < length:
+                break
+            body = bytes(buffer[pos:pos + length])
+            pos += length
+            self.pending = None
+            messages.append(RtspMessage(startLine, headers, body))
+        del buffer[:pos]
+        return messages
+
+    def parseHead(self, head):
+        try:
+            lines = head.decode('utf-8').splitlines()
+        except UnicodeDecodeError:
+            raise RtspError('header block is not UTF-8')
+        # Tolerate stray blank lines between pipelined messages
+        while lines and not lines[0].strip():
+            lines.pop(0)
+        if not lines:
+            raise RtspError('empty message')
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep or not name.strip():
+                raise RtspError('bad header line: %r' % line)
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise RtspError('bad Content-Length')
+        if not 0 <= length <= MAX_BODY_SIZE:
+            raise RtspError('bad Content-Length')
+        return lines[0].strip(), headers, length
+
+def encodeMessage(startLine, headers, body=b''):
+    lines = [startLine]
+    for name, value in headers:
+        lines.append('%s: %s' % (name, value))
+    if body:
+        lines.append('Content-Length: %d' % len(body))
+    return (CRLF.join(lines) + CRLF + CRLF).encode('utf-8') + body
+
+def encodeRequest(method, uri, cseq, headers=(), body=b''):
+    """Encode a request; headers is a sequence of (name, value) pairs after CSeq."""
+    return encodeMessage('%s %s %s' % (method, uri, RTSP_VERSION),
+                         [('CSeq', cseq)] + list(headers), body)
+
+def encodeResponse(code, cseq, headers=(), body=b''):
+    """Encode a response; headers is a sequence of (name, value) pairs after CSeq."""
+    return encodeMessage('%s %d %s' % (RTSP_VERSION, code, REASONS.get(code, '')),
+                         [('CSeq', cseq)] + list(headers), body)
@@ -1,25 +1,131 @@
-import sys, socket
+import sys, socket, signal, time
 
 from ServerWorker import ServerWorker
+from FrameStore import FrameStore
+from FrameScheduler import ThreadedScheduler
+from RtpEgress import RtpEgress
+from Supervisor import Supervisor
+from Metrics import MetricsRegistry, MetricsServer
+from Log import setupLogging
+from Rtcp import RtcpReceiver, bindPair
+from Channel import ChannelRegistry
+from SessionManager import SessionManager
+
+def popOption(args, flag, default=None, type=int):
+	"""Remove '<flag> <value>' from args and return the value converted by type, else default."""
+	if flag not in args:
+		return default
+	i = args.index(flag)
+	value = type(args[i + 1])
+	del args[i:i + 2]
+	return value
+
+class Server:
+	# Memory budget for media kept by the shared frame store
+	FRAME_STORE_BUDGET = 256 * 1024 * 1024
+	# UDP sockets shared by all sessions for RTP egress
+	EGRESS_SOCKETS = 4
+	# Seconds a draining worker waits for its sessions to end
+	DRAIN_TIMEOUT = 30.0
+
+	def __init__(self):
+		self.rtspSocket = None
+		self.sessions = []
+		self.draining = False
 
-class Server:	
-	
 	def main(self):
+		args = sys.argv[1:]
 		try:
-			SERVER_PORT = int(sys.argv[1])
+			# Optional worker process count, next to the port
+			workers = popOption(args, '-w', 1)
+			# Optional local port serving Prometheus metrics
+			metricsPort = popOption(args, '-m')
+			# Log level: off, error, warning, info or debug
+			setupLogging(popOption(args, '-l', 'info', str))
+			# Session timeout (s), and admission limits on sessions and egress Mbit/s
+			limits = {'timeout': popOption(args, '-t', SessionManager.TIMEOUT),
+				'maxSessions': popOption(args, '-n'),
+				'maxBitrate': popOption(args, '-b', None, lambda mbps: float(mbps) * 1e6)}
+			# Unicast sessions on the same file share one live channel
+			shareUnicast = '-c' in args
+			if shareUnicast:
+				args.remove('-c')
+			SERVER_PORT = int(args[0])
 		except:
-			print("[Usage: Server.py Server_port]\n")
+			print("[Usage: Server.py Server_port [-w Workers] [-m Metrics_port] [-l Log_level] [-t Timeout] [-n Max_sessions] [-b Max_Mbps] [-c] [Frame_rate]]\n")
+			return
+		# Optional frame rate for every session, overriding the media index
+		frameRate = float(args[1]) if len(args) > 1 else None
+		if workers > 1:
+			# Each forked worker accepts on its own SO_REUSEPORT listener
+			# Worker i serves its metrics on Metrics_port + i
+			Supervisor(workers, lambda i: self.serve(SERVER_PORT, frameRate, reusePort=True,
+				metricsPort=metricsPort and metricsPort + i, shareUnicast=shareUnicast, **limits)).run()
+		else:
+			self.serve(SERVER_PORT, frameRate, metricsPort=metricsPort, shareUnicast=shareUnicast, **limits)
+
+	def listen(self, port, reusePort=False):
 		rtspSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		rtspSocket.bind(('', SERVER_PORT))
-		rtspSocket.listen(5)        
+		if reusePort:
+			# The kernel spreads new connections over every process bound to the port
+			rtspSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		rtspSocket.bind(('', port))
+		rtspSocket.listen(128 if reusePort else 5)
+		return rtspSocket
+
+	def serve(self, port, frameRate=None, reusePort=False, metricsPort=None, shareUnicast=False,
+			timeout=SessionManager.TIMEOUT, maxSessions=None, maxBitrate=None):
+		"""Accept RTSP clients until told to drain, then let their sessions finish.
+
+		The session limits apply to each worker process on its own."""
+		self.rtspSocket = self.listen(port, reusePort)
+		signal.signal(signal.SIGTERM, self.drain)
+		frameStore = FrameStore(self.FRAME_STORE_BUDGET)
+		# Media files changed on disk are picked up after SIGHUP
+		signal.signal(signal.SIGHUP, lambda signum, frame: frameStore.reload())
+		# Each egress socket sends RTP from an even port; RTCP comes back on the odd one after it
+		pairs = [bindPair() for _ in range(self.EGRESS_SOCKETS)]
+		egress = RtpEgress(sockets=[rtp for rtp, _ in pairs])
+		scheduler = ThreadedScheduler(egress).start()
+		# Live channels: always for multicast, for unicast too with shareUnicast
+		channels = ChannelRegistry(frameStore, scheduler, egress, frameRate, shareUnicast)
+		sessions = SessionManager(timeout, maxSessions, maxBitrate, frameStore).start()
+		metrics = MetricsRegistry(frameStore, egress, channels, sessions)
+		rtcp = RtcpReceiver([rtcp for _, rtcp in pairs]).start()
+		if metricsPort:
+			MetricsServer(metrics, metricsPort, reusePort=reusePort).start()
 
 		# Receive client info (address,port) through RTSP/TCP session
 		while True:
 			clientInfo = {}
-			clientInfo['rtspSocket'] = rtspSocket.accept()
-			ServerWorker(clientInfo).run()		
+			try:
+				clientInfo['rtspSocket'] = self.rtspSocket.accept()
+			except OSError:
+				if self.draining:
+					break
+				raise
+			clientInfo['frameStore'] = frameStore
+			clientInfo['scheduler'] = scheduler
+			clientInfo['egress'] = egress
+			clientInfo['frameRate'] = frameRate
+			clientInfo['metrics'] = metrics
+			clientInfo['rtcp'] = rtcp
+			clientInfo['channels'] = channels
+			clientInfo['sessions'] = sessions
+			self.sessions.append(ServerWorker(clientInfo).run())
+			self.sessions = [t for t in self.sessions if t.is_alive()]
 
-if __name__ == "__main__":
-	(Server()).main()
+		# Draining: no new clients, wait for the current ones to tear down
+		deadline = time.monotonic() + self.DRAIN_TIMEOUT
+		for thread in self.sessions:
+			thread.join(max(0.0, deadline - time.monotonic()))
 
+	def drain(self, signum=None, frame=None):
+		"""SIGTERM handler: stop accepting; serve() returns once sessions end."""
+		self.draining = True
+		if self.rtspSocket is not None:
+			# Wakes the blocked accept() with an error
+			self.rtspSocket.close()
 
+if __name__ == "__main__":
+	(Server()).main()
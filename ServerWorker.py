@@ -1,8 +1,17 @@
 from random import randint
-import threading, socket, time
+import socket, threading
 
 from VideoStream import VideoStream
-from RtpPacket import RtpPacket
+from RtpJpeg import JpegEncoder, FragmentCache
+from RtpPacket import RtpClock
+from RtspCodec import RtspParser, RtspError, encodeResponse
+from Metrics import SessionCounters
+from RateControl import RateController
+from Log import getLogger, PacketLog
+
+log = getLogger('server')
+# Per-frame send events, rate limited and free when debug is off
+packetLog = PacketLog(log)
 
 class ServerWorker:
     SETUP = 'SETUP'
@@ -11,6 +20,9 @@ class ServerWorker:
     TEARDOWN = 'TEARDOWN'
     FORWARD = 'FORWARD'
     BACKWARD = 'BACKWARD'
+    OPTIONS = 'OPTIONS'
+    GET_PARAMETER = 'GET_PARAMETER'
+    METHODS = (OPTIONS, SETUP, PLAY, PAUSE, TEARDOWN, GET_PARAMETER, FORWARD, BACKWARD)
     
     INIT = 0
     READY = 1
@@ -20,201 +32,547 @@ class ServerWorker:
     OK_200 = 0
     FILE_NOT_FOUND_404 = 1
     CON_ERR_500 = 2
+    BAD_REQUEST_400 = 3
+    NOT_IMPLEMENTED_501 = 4
+    NOT_VALID_455 = 5
+    UNSUPPORTED_TRANSPORT_461 = 6
+    SESSION_NOT_FOUND_454 = 7
+    NOT_ENOUGH_BANDWIDTH_453 = 8
+    UNAVAILABLE_503 = 9
+    
+    STATUS = {OK_200: 200, FILE_NOT_FOUND_404: 404, CON_ERR_500: 500,
+              BAD_REQUEST_400: 400, NOT_IMPLEMENTED_501: 501,
+              NOT_VALID_455: 455, UNSUPPORTED_TRANSPORT_461: 461,
+              SESSION_NOT_FOUND_454: 454, NOT_ENOUGH_BANDWIDTH_453: 453, UNAVAILABLE_503: 503}
     
     clientInfo = {}
     
+    # Default frame rate when neither the server nor the media index sets one
     FRAME_RATE = 20.0
-    FRAME_INTERVAL = 1.0 / FRAME_RATE
+    # Fastest delivery a client may ask for with the Speed header
+    MAX_SPEED = 4.0
     
     def __init__(self, clientInfo):
         self.clientInfo = clientInfo
+        self.frameRate = self.FRAME_RATE
+        # Random SSRC, sequence and timestamp origin for this session
+        self.rtpClock = RtpClock()
+        self.rtpEncoder = JpegEncoder(pt=26, ssrc=self.rtpClock.ssrc) # MJPEG type
+        self.rtpSeq = self.rtpClock.seq
+        # Lock-free counters read by the metrics endpoint
+        self.counters = SessionCounters()
+        self.pacing = None
+        # Send rate adapted to the loss the client reports over RTCP
+        self.rateControl = RateController(self.frameRate)
+        self.rtcpAddress = None
+        # Presentation time (s) at which PLAY with a closed Range stops
+        self.playEnd = None
+        # Live channel this session watches instead of sending its own stream
+        self.channel = None
+        # RTP fragments of the media, packetized once and shared with other sessions
+        self.fragments = None
+        # Held while a frame is sent, and while the cursor moves or the stream is released
+        self.sendLock = threading.Lock()
+        if 'metrics' in clientInfo:
+            clientInfo['metrics'].add(self)
         
     def run(self):
-        threading.Thread(target=self.recvRtspRequest).start()
+        """Serve the client on its own thread. Return the thread."""
+        thread = threading.Thread(target=self.recvRtspRequest, daemon=True)
+        thread.start()
+        return thread
+  
+    def openRtp(self):
+        """Pick the shared egress socket this session sends RTP/UDP through."""
+        self.clientInfo['egressSlot'] = self.clientInfo['egress'].assign()
+  
+    def closeRtp(self):
+        """Forget the egress socket; the pool outlives the session."""
+        self.clientInfo.pop('egressSlot', None)
+  
+    def startSending(self):
+        """Hand this session to the server's frame scheduler; its first frame is due now."""
+        self.pacing = self.clientInfo['scheduler'].add(self, self.rateControl.sendRate(), self.pacing)
+  
+    def stopSending(self):
+        """Take this session off the frame scheduler, or out of its channel's members."""
+        if self.channel is not None:
+            self.clientInfo['channels'].leave(self.channel, self)
+        elif 'scheduler' in self.clientInfo:
+            self.clientInfo['scheduler'].remove(self)
   
     def resetPlay(self):
-        """Stop old worker cleanly, then start a new sendRtp worker."""
-        # signal old worker to stop
-        if 'event' in self.clientInfo:
-            try:
-                self.clientInfo['event'].set()
-            except Exception:
-                pass
-
-        # join the old worker if exists (short timeout to avoid blocking forever)
-        if 'worker' in self.clientInfo:
-            old = self.clientInfo['worker']
-            try:
-                if old.is_alive():
-                    old.join(timeout=0.5)
-            except Exception:
-                pass
-
-        # small stabilization pause to avoid immediate burst
-        time.sleep(self.FRAME_INTERVAL)
-
-        # create new event and worker
-        self.clientInfo['event'] = threading.Event()
-        w = threading.Thread(target=self.sendRtp, daemon=True)
-        self.clientInfo['worker'] = w
-        w.start()
+        """Restart pacing at the new position without waiting for a frame interval."""
+        self.startSending()
+            
+    def closeSession(self):
+        """Stop streaming and release the session's resources. Safe to call twice."""
+        self.stopSending()
+        # A frame already being sent finishes before its stream and socket go
+        with self.sendLock:
+            self.closeRtp()
+            self.fragments = None
+            videoStream = self.clientInfo.pop('videoStream', None)
+        if self.rtcpAddress is not None:
+            self.clientInfo['rtcp'].unregister(self.rtcpAddress)
+            self.rtcpAddress = None
+        if self.channel is not None:
+            self.clientInfo['channels'].close(self.channel)
+            self.channel = None
+        if 'sessions' in self.clientInfo:
+            self.clientInfo['sessions'].remove(self)
+        # Release this session's hold on the shared frames
+        if videoStream is not None and 'frameStore' in self.clientInfo:
+            self.clientInfo['frameStore'].close(videoStream)
+        self.state = self.INIT
+            
+    def expire(self):
+        """The session timed out: drop the client's connection, which releases the rest."""
+        connSocket = self.clientInfo['rtspSocket'][0]
+        connSocket.shutdown(socket.SHUT_RDWR)
+            
+    def disconnect(self):
+        """The client went away, possibly without TEARDOWN: release everything."""
+        self.closeSession()
+        if 'metrics' in self.clientInfo:
+            self.clientInfo['metrics'].remove(self)
             
     def recvRtspRequest(self):
-        """Receive RTSP request from the client."""
+        """Receive RTSP requests from the client until it disconnects."""
         connSocket = self.clientInfo['rtspSocket'][0]
-        while True:            
-            data = connSocket.recv(256)
-            if data:
-                print("Data received:\n" + data.decode("utf-8"))
-                self.processRtspRequest(data.decode("utf-8"))
+        parser = RtspParser()
+        try:
+            while True:            
+                data = connSocket.recv(4096)
+                if not data:
+                    break
+                log.debug("Data received from %s:\n%s", self.clientInfo['rtspSocket'][1],
+                          data.decode("utf-8", "replace"))
+                for request in parser.feed(data):
+                    self.processRtspRequest(request)
+        except RtspError as e:
+            log.warning("Bad request from %s: %s", self.clientInfo['rtspSocket'][1], e)
+            self.replyRtsp(self.BAD_REQUEST_400, '0')
+        except OSError:
+            pass
+        except Exception:
+            # Release the session rather than leave it to the reaper
+            log.exception("Error serving %s", self.clientInfo['rtspSocket'][1])
+        finally:
+            self.disconnect()
+            connSocket.close()
     
-    def processRtspRequest(self, data):
-        """Process RTSP request sent from the client."""
-        # Get the request type
-        request = data.split('\n')
-        line1 = request[0].split(' ')
-        requestType = line1[0]
+    def processRtspRequest(self, request):
+        """Process one RTSP request (an RtspMessage) sent from the client."""
+        requestType = request.method
         
         # Get the media file name
-        filename = line1[1]
+        filename = request.uri
         
         # Get the RTSP sequence number 
-        seq = request[1].split(' ')
-        # print(f"\n\n\nseq: {seq}\n\n\n")
+        seq = request.header('CSeq', '0')
+        
+        sessions = self.clientInfo.get('sessions')
+        if self.state != self.INIT:
+            sessionId = request.session()
+            if sessionId is not None and sessionId != str(self.clientInfo['session']):
+                self.replyRtsp(self.SESSION_NOT_FOUND_454, seq)
+                return
+            # Any request keeps the session alive
+            if sessions is not None:
+                sessions.touch(self)
+        elif request.session() is not None and requestType != self.SETUP:
+            self.replyRtsp(self.SESSION_NOT_FOUND_454, seq)
+            return
+        elif requestType in self.METHODS and requestType not in [self.SETUP, self.OPTIONS, self.GET_PARAMETER]:
+            # Nothing to play, pause or tear down before SETUP
+            self.replyRtsp(self.NOT_VALID_455, seq)
+            return
         
         # Process SETUP request
         if requestType == self.SETUP:
             if self.state == self.INIT:
                 # Update state
-                print("processing SETUP\n")
+                log.info("processing SETUP %s", filename)
+                
+                transport = request.transport()
+                multicast = bool(transport) and 'multicast' in transport
+                if not transport or not multicast and 'client_port' not in transport:
+                    self.replyRtsp(self.BAD_REQUEST_400, seq)
+                    return
+                channels = self.clientInfo.get('channels')
+                if multicast and channels is None:
+                    self.replyRtsp(self.UNSUPPORTED_TRANSPORT_461, seq)
+                    return
                 
                 try:
-                    self.clientInfo['videoStream'] = VideoStream(filename)
+                    if multicast or channels is not None and channels.shareUnicast:
+                        # Watch the file's live channel rather than a stream of its own
+                        self.channel = channels.open(filename, multicast, self.FRAME_RATE)
+                        if self.channel is None:
+                            log.warning("Refused SETUP %s: no free multicast group", filename)
+                            self.replyRtsp(self.UNAVAILABLE_503, seq)
+                            return
+                        self.frameRate = self.channel.frameRate
+                    else:
+                        frameStore = self.clientInfo.get('frameStore')
+                        if frameStore is not None:
+                            self.clientInfo['videoStream'] = frameStore.open(filename)
+                        else:
+                            self.clientInfo['videoStream'] = VideoStream(filename, lazy=True)
+                        # A server-wide override wins over the rate recorded in the media index
+                        self.frameRate = self.clientInfo.get('frameRate') \
+                            or self.clientInfo['videoStream'].frameRate() or self.FRAME_RATE
+                        self.fragments = self.fragmentCache(self.clientInfo['videoStream'])
                     self.state = self.READY
                 except IOError:
-                    self.replyRtsp(self.FILE_NOT_FOUND_404, seq[1])
+                    self.replyRtsp(self.FILE_NOT_FOUND_404, seq)
+                    return
                 
-                # Generate a randomized RTSP session ID
-                self.clientInfo['session'] = randint(100000, 999999)
+                if sessions is not None:
+                    # Admission control; the manager also picks the session ID
+                    sessionId, refused = sessions.admit(self, self.mediaBitrate())
+                    if sessionId is None:
+                        log.warning("Refused SETUP %s: no room (%s)", filename, refused)
+                        self.closeSession()
+                        self.replyRtsp(self.NOT_ENOUGH_BANDWIDTH_453 if refused == 'bandwidth'
+                                       else self.UNAVAILABLE_503, seq)
+                        return
+                    self.clientInfo['session'] = sessionId
+                else:
+                    # Generate a randomized RTSP session ID
+                    self.clientInfo['session'] = randint(100000, 999999)
                 
-                # Send RTSP reply
-                self.replyRtsp(self.OK_200, seq[1])
+                # Get the RTP/UDP port from the Transport header
+                ports = transport.get('client_port')
+                self.clientInfo['rtpPort'] = ports[0] if ports else None
+                self.rateControl = RateController(self.frameRate)
+                # Pick the egress socket for RTP/UDP now, so the reply can name its port
+                self.openRtp()
                 
-                # Get the RTP/UDP port from the last line
-                self.clientInfo['rtpPort'] = request[2].split(' ')[3]
+                # Send RTSP reply, confirming the transport
+                if multicast:
+                    group, port = self.channel.group
+                    reply = 'RTP/AVP;multicast;destination=%s;port=%d-%d;ttl=%d' \
+                        % (group, port, port + 1, channels.ttl)
+                else:
+                    reply = request.header('Transport')
+                rtcp = self.clientInfo.get('rtcp')
+                if rtcp is not None and ports:
+                    # Receiver reports come from the RTP port plus one
+                    rtcpPort = ports[1] if len(ports) > 1 else ports[0] + 1
+                    self.rtcpAddress = (self.clientInfo['rtspSocket'][1][0], rtcpPort)
+                    rtcp.register(self.rtcpAddress, self)
+                    # RTP leaves from the egress socket, whose port is even when the
+                    # RTCP socket of its slot holds the odd one after it
+                    slot = self.channel.slot if self.channel is not None else self.clientInfo['egressSlot']
+                    rtpPort = self.clientInfo['egress'].sockets[slot].getsockname()[1]
+                    if rtcp.port(slot) == rtpPort + 1:
+                        reply += ';server_port=%d-%d' % (rtpPort, rtpPort + 1)
+                self.replyRtsp(self.OK_200, seq, [('Transport', reply)])
+            else:
+                # The transport of a set-up session cannot change
+                self.replyRtsp(self.NOT_VALID_455, seq)
         
         # Process PLAY request 		
         elif requestType == self.PLAY:
-            if self.state == self.READY:
-                print("processing PLAY\n")
-                self.state = self.PLAYING
-                
-                # Create a new socket for RTP/UDP
-                self.clientInfo["rtpSocket"] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if self.state in [self.READY, self.PLAYING]:
+                log.info("Session %s: processing PLAY", self.clientInfo['session'])
+                if self.channel is not None:
+                    self.playChannel(request, seq)
+                    return
+                try:
+                    playRange = request.range()
+                    # No Scale or Speed header means normal speed again
+                    scale = request.scale() or 1.0
+                    speed = min(self.MAX_SPEED, request.speed() or 1.0)
+                except RtspError:
+                    self.replyRtsp(self.BAD_REQUEST_400, seq)
+                    return
+                headers = [('Scale', str(scale)), ('Speed', str(speed))]
+                if self.state == self.PLAYING and playRange is None and scale == self.rateControl.scale:
+                    if speed != self.rateControl.speed:
+                        # Same position and scale, only delivered faster or slower
+                        self.clientInfo['scheduler'].setRate(self, self.rateControl.setSpeed(speed))
+                    # Already playing from where it is
+                    self.replyRtsp(self.OK_200, seq, headers + self.playInfo(request.uri))
+                    return
+                # Keep the sender off the cursor while it moves
+                self.stopSending()
+                if playRange is not None:
+                    self.seek(*playRange)
+                self.setScale(scale, seeked=playRange is not None)
+                self.rateControl.setSpeed(speed)
+                headers += self.playInfo(request.uri)
+                if self.state == self.READY:
+                    self.state = self.PLAYING
                 
-                self.replyRtsp(self.OK_200, seq[1])
+                self.replyRtsp(self.OK_200, seq, headers)
                 
-                # Create a new thread and start sending RTP packets
-                self.clientInfo['event'] = threading.Event()
-                self.clientInfo['worker']= threading.Thread(target=self.sendRtp) 
-                self.clientInfo['worker'].start()
+                # Start sending RTP packets; after a seek, the new position is due now
+                self.startSending()
         
         # Process PAUSE request
         elif requestType == self.PAUSE:
             if self.state == self.PLAYING:
-                print("processing PAUSE\n")
+                log.info("Session %s: processing PAUSE", self.clientInfo['session'])
                 self.state = self.READY
                 
-                self.clientInfo['event'].set()
+                self.stopSending()
             
-                self.replyRtsp(self.OK_200, seq[1])
+                self.replyRtsp(self.OK_200, seq)
+            else:
+                # Already paused
+                self.replyRtsp(self.OK_200, seq)
     
         elif requestType == self.FORWARD:
             if self.state in [self.READY, self.PLAYING]:
-                print("processing FORWARD\n")
-                vs = self.clientInfo['videoStream']
-                vs.setFrame(vs.frameNbr() + 30)	
-    
-                if self.state == self.PLAYING:
-                    self.resetPlay()
-     
-                self.replyRtsp(self.OK_200, seq[1])
+                log.info("Session %s: processing FORWARD", self.clientInfo['session'])
+                if self.channel is not None:
+                    # Every member of a live channel sees the same position
+                    self.replyRtsp(self.NOT_VALID_455, seq)
+                    return
+                self.jump(30)
+                self.replyRtsp(self.OK_200, seq)
     
         elif requestType == self.BACKWARD:
             if self.state in [self.READY, self.PLAYING]:
-                print("processing BACKWARD\n")
-                vs = self.clientInfo['videoStream']
-                vs.setFrame(vs.frameNbr() - 30)
-                if self.state == self.PLAYING:
-                    self.resetPlay()
-                
-                self.replyRtsp(self.OK_200, seq[1])
+                log.info("Session %s: processing BACKWARD", self.clientInfo['session'])
+                if self.channel is not None:
+                    # Every member of a live channel sees the same position
+                    self.replyRtsp(self.NOT_VALID_455, seq)
+                    return
+                self.jump(-30)
+                self.replyRtsp(self.OK_200, seq)
         
         # Process TEARDOWN request
         elif requestType == self.TEARDOWN:
-            print("processing TEARDOWN\n")
+            log.info("Session %s: processing TEARDOWN", self.clientInfo.get('session'))
 
-            self.clientInfo['event'].set()
+            self.stopSending()
             
-            self.replyRtsp(self.OK_200, seq[1])
+            self.replyRtsp(self.OK_200, seq)
             
-            # Close the RTP socket
-            self.clientInfo['rtpSocket'].close()
+            # Release the RTP egress socket and the shared frames
+            self.closeSession()
+        
+        # Keepalives; OPTIONS also lists the methods served
+        elif requestType in [self.OPTIONS, self.GET_PARAMETER]:
+            headers = [('Public', ', '.join(self.METHODS))] if requestType == self.OPTIONS else []
+            self.replyRtsp(self.OK_200, seq, headers)
+        
+        else:
+            self.replyRtsp(self.NOT_IMPLEMENTED_501, seq)
             
-    def sendRtp(self):
-        """Send RTP packets over UDP."""
+    def playChannel(self, request, seq):
+        """PLAY on a live channel: join it from the live position, at 1x."""
+        try:
+            playRange = request.range()
+            scale = request.scale()
+        except RtspError:
+            self.replyRtsp(self.BAD_REQUEST_400, seq)
+            return
+        if playRange is not None or scale not in (None, 1.0):
+            # Seeking or trick play would move every member
+            self.replyRtsp(self.NOT_VALID_455, seq)
+            return
+        channel = self.channel
+        if self.state == self.READY:
+            self.state = self.PLAYING
+            if channel.group is None:
+                address = (self.clientInfo['rtspSocket'][1][0], int(self.clientInfo['rtpPort']))
+            else:
+                address = channel.group
+            self.clientInfo['channels'].join(channel, self, address)
+        # Speed is not granted either: a shared sender delivers in real time
+        self.replyRtsp(self.OK_200, seq, [('Scale', '1.0'), ('Speed', '1.0')] + channel.playInfo(request.uri))
+
+    def mediaBitrate(self):
+        """Egress bits per second this session adds at 1x, from the mean frame size."""
+        if self.channel is not None:
+            vs = self.channel.videoStream
+            if self.channel.group is not None and self.channel.sessions > 1:
+                # One multicast stream serves every member
+                return 0
+        else:
+            vs = self.clientInfo['videoStream']
+        frames = len(vs.cache)
+        frameStore = self.clientInfo.get('frameStore')
+        size = frameStore.mediaBytes(vs) if frameStore is not None else None
+        if not frames or size is None:
+            return 0
+        return 8 * size / frames * self.frameRate
+
+    def setScale(self, scale, seeked=False):
+        """Play at scale times normal speed from the next frame sent; the sender must be stopped."""
+        if scale < 0 and seeked:
+            # Backwards play sends the frame two before the cursor (one
+            # past the frame sent last); make that the frame sought to
+            with self.sendLock:
+                vs = self.clientInfo['videoStream']
+                vs.setFrame(vs.frameNbr() + 2)
+        if scale != self.rateControl.scale:
+            log.info("Session %s: scale %s, sending %.1f fps", self.clientInfo.get('session'),
+                     scale, self.rateControl.setScale(scale))
+
+    def jump(self, frames):
+        """Move the cursor frames forward (or back), off the scheduler like a PLAY Range seek."""
+        # Keep the sender off the cursor while it moves
+        self.stopSending()
+        with self.sendLock:
+            vs = self.clientInfo['videoStream']
+            vs.setFrame(vs.frameNbr() + frames)
+        self.counters.seeks += 1
+        if self.state == self.PLAYING:
+            self.resetPlay()
+
+    def seek(self, start, end):
+        """Re-point the cursor at npt start, to stop at end."""
+        with self.sendLock:
+            vs = self.clientInfo['videoStream']
+            index = vs.seekTime(start, self.frameRate, useIndex=not self.clientInfo.get('frameRate'))
+            self.playEnd = end
+        self.counters.seeks += 1
+        log.info("Session %s: seek to %.3f s, frame %d", self.clientInfo.get('session'),
+                 self.presentationTime(index), index)
+
+    def playInfo(self, uri):
+        """Range and RTP-Info reply headers for the position the next frame is sent from."""
         vs = self.clientInfo['videoStream']
-        FRAME_INTERVAL = 0.05
-        prevFrame = -1
-        while True:
-            time.sleep(FRAME_INTERVAL)
-            
-            # Stop sending if request is PAUSE or TEARDOWN
-            if self.clientInfo['event'].isSet(): 
-                break 
-                
+        # Backwards, the cursor is one past the frame sent last
+        index = vs.frameNbr() if self.rateControl.scale > 0 else max(0, vs.frameNbr() - 2)
+        actual = self.presentationTime(index)
+        end = self.playEnd
+        npt = 'npt=%.3f-%s' % (actual, '%.3f' % end if end is not None else '')
+        # Ties RTP timestamps to media time, and tells the first packet from the new position
+        rtpInfo = 'url=%s;seq=%d;rtptime=%d' % (uri, self.rtpSeq, self.rtpClock.timestamp(actual))
+        return [('Range', npt), ('RTP-Info', rtpInfo)]
+
+    def sendFrame(self):
+        """Send the next frame. Return False when the stream should stop."""
+        # Not while a request moves the cursor or closes the session
+        with self.sendLock:
+            vs = self.clientInfo.get('videoStream')
+            # The session may have been closed while this frame was due
+            if vs is None:
+                return False
+            # Below the nominal rate or above 1x, skip frames so the media clock keeps its speed
+            skip = self.rateControl.skip()
+            if self.rateControl.scale > 0:
+                if skip:
+                    vs.setFrame(vs.frameNbr() + skip)
+                if self.playEnd is not None and self.presentationTime(vs.frameNbr()) >= self.playEnd:
+                    return False
+            else:
+                # Backwards: the cursor is one past the frame sent last
+                index = vs.frameNbr() - 2 - skip
+                if index < 0 or self.playEnd is not None and self.presentationTime(index) < self.playEnd:
+                    return False
+                vs.setFrame(index)
             data = vs.nextFrame()
             if data is None:
-                break
+                return False
             frameNumber = vs.frameNbr()
             try:
                 address = self.clientInfo['rtspSocket'][1][0]
                 port = int(self.clientInfo['rtpPort'])
-                self.clientInfo['rtpSocket'].sendto(self.makeRtp(data, frameNumber),(address,port))
-            except:
-                print("Connection Error")
-                break
-                #print('-'*60)
-                #traceback.print_exc(file=sys.stdout)
-                #print('-'*60)
+                size = 0
+                for header, payload in self.makeRtp(data, frameNumber):
+                    self.sendPacket(header, payload, (address, port))
+                    size += len(header) + len(payload)
+                counters = self.counters
+                counters.frames += 1
+                counters.bytes += size
+                if packetLog.enabled:
+                    packetLog.debug("Session %s: frame %d, %d bytes, next seq %d",
+                                    self.clientInfo['session'], frameNumber, size, self.rtpSeq)
+            except Exception:
+                log.warning("Session %s: connection error", self.clientInfo.get('session'), exc_info=True)
+                return False
+            return True
+
+    def onReceiverReport(self, block):
+        """Adapt the send rate to an RTCP receiver report from the client."""
+        if 'sessions' in self.clientInfo:
+            # Reports keep the session alive as requests do
+            self.clientInfo['sessions'].touch(self)
+        if self.channel is not None:
+            # A shared sender cannot slow down for one member; only record the loss
+            if block.ssrc == self.channel.rtpClock.ssrc:
+                self.rateControl.lastLoss = block.lossRatio()
+            return
+        if block.ssrc != self.rtpClock.ssrc:
+            # About some other stream
+            return
+        old = self.rateControl.sendRate()
+        self.rateControl.onReport(block.lossRatio())
+        rate = self.rateControl.sendRate()
+        if rate != old:
+            log.info("Session %s: %.1f%% loss reported, sending %.1f fps",
+                     self.clientInfo.get('session'), 100 * block.lossRatio(), rate)
+            if self.state == self.PLAYING:
+                self.clientInfo['scheduler'].setRate(self, rate)
+
+    def sendPacket(self, header, payload, address):
+        """Queue one RTP packet on the egress; the scheduler flushes it."""
+        self.clientInfo['egress'].queue(self.clientInfo['egressSlot'], header, payload, address)
 
     def makeRtp(self, payload, frameNbr):
-        """RTP-packetize the video data."""
-        version = 2
-        padding = 0
-        extension = 0
-        cc = 0
-        marker = 0
-        pt = 26 # MJPEG type
-        seqnum = frameNbr
-        ssrc = 0 
-        
-        rtpPacket = RtpPacket()
+        """RTP-packetize the video data into MTU-sized RFC 2435 fragments.
         
-        rtpPacket.encode(version, padding, extension, cc, seqnum, marker, pt, ssrc, payload)
-        
-        return rtpPacket.getPacket()
+        Return a list of (header, payload) pairs, one per packet."""
+        # All fragments of a frame share the 90 kHz timestamp of its presentation time
+        timestamp = self.rtpClock.timestamp(self.presentationTime(frameNbr - 1))
+        if self.fragments is not None:
+            # Only this session's header fields are left to fill in
+            packets, self.rtpSeq = self.rtpEncoder.encodeFragments(
+                self.fragments.get(frameNbr - 1), self.rtpSeq, timestamp)
+        else:
+            packets, self.rtpSeq = self.rtpEncoder.encodeFrame(payload, self.rtpSeq, timestamp)
+        self.rtpSeq &= 0xFFFF
+        return packets
+
+    def fragmentCache(self, videoStream):
+        """The FragmentCache of videoStream's media, shared through the frame store."""
+        maxPayload, pt = self.rtpEncoder.maxPayload, self.rtpEncoder.pt
+        make = lambda frames, charge: FragmentCache(frames, maxPayload, pt, charge, videoStream.filename)
+        frameStore = self.clientInfo.get('frameStore')
+        if frameStore is None:
+            return make(videoStream.cache, None)
+        return frameStore.attachment(videoStream, ('rtp', maxPayload, pt), make)
+
+    def presentationTime(self, index):
+        """Seconds from the start of the media to frame index."""
+        vs = self.clientInfo.get('videoStream')
+        # A server-wide rate override re-times the media, so the index times do not apply
+        if vs is not None and not self.clientInfo.get('frameRate'):
+            seconds = vs.frameTime(index)
+            if seconds is not None:
+                return seconds
+        return index / self.frameRate
         
-    def replyRtsp(self, code, seq):
+    def replyRtsp(self, code, seq, headers=()):
         """Send RTSP reply to the client."""
         if code == self.OK_200:
-            #print("200 OK")
-            reply = 'RTSP/1.0 200 OK\nCSeq: ' + seq + '\nSession: ' + str(self.clientInfo['session'])
-            connSocket = self.clientInfo['rtspSocket'][0]
-            connSocket.send(reply.encode())
+            session = self.clientInfo.get('session')
+            if session is None:
+                # Before SETUP there is no session to name
+                self.sendReply(encodeResponse(200, seq, headers))
+                return
+            if 'sessions' in self.clientInfo:
+                session = '%s;timeout=%d' % (session, self.clientInfo['sessions'].timeout)
+            reply = encodeResponse(200, seq, [('Session', session)] + list(headers))
+            self.sendReply(reply)
+            return
         
         # Error messages
-        elif code == self.FILE_NOT_FOUND_404:
-            print("404 NOT FOUND")
+        if code == self.FILE_NOT_FOUND_404:
+            log.info("404 NOT FOUND")
         elif code == self.CON_ERR_500:
-            print("500 CONNECTION ERROR")
+            log.error("500 CONNECTION ERROR")
+        self.sendReply(encodeResponse(self.STATUS[code], seq, headers))
+
+    def sendReply(self, data):
+        """Write an encoded RTSP reply to the client connection."""
+        connSocket = self.clientInfo['rtspSocket'][0]
+        connSocket.send(data)
@@ -0,0 +1,127 @@
+"""Server-wide table of RTSP sessions: timeouts, reaping and admission control."""
+import random, threading, time
+
+from Log import getLogger
+
+log = getLogger('server')
+
+class SessionManager:
+    """Every set-up session of the server, keyed by its Session ID.
+
+    A session stays alive while its client sends RTSP requests (an empty
+    GET_PARAMETER or OPTIONS is the keepalive) or RTCP reports. One quiet
+    for longer than the timeout is expired: its connection is closed, and
+    the worker releases its media, channel and scheduler slot on the way
+    out, as for a client that went away.
+
+    SETUP is admitted only while there is room for it: under the session
+    limit, within the egress bit rate the sessions have reserved, and while
+    the frame store's media is within its memory budget. A refused session
+    gets an error instead of everyone getting a worse stream.
+
+    A session only needs clientInfo and an expire() method; ServerWorker
+    has them.
+    """
+
+    # Seconds without a request or report before a session expires (RFC 2326 default)
+    TIMEOUT = 60
+    # Longest time (s) between sweeps for expired sessions
+    REAP_INTERVAL = 5.0
+
+    def __init__(self, timeout=TIMEOUT, maxSessions=None, maxBitrate=None, frameStore=None):
+        self.timeout = timeout
+        # A session lives at most timeout plus this
+        self.reapInterval = min(self.REAP_INTERVAL, timeout / 2.0)
+        self.maxSessions = maxSessions
+        # Egress bits per second the admitted sessions may reserve in total
+        self.maxBitrate = maxBitrate
+        self.frameStore = frameStore
+        self.lock = threading.Lock()
+        self.sessions = {}
+        # Session -> monotonic time of its last request or report
+        self.lastSeen = {}
+        # Session -> bits per second reserved at admission
+        self.reserved = {}
+        self.admitted = 0
+        self.expired = 0
+        # Refusals by reason: 'sessions', 'bandwidth' or 'memory'
+        self.refused = {'sessions': 0, 'bandwidth': 0, 'memory': 0}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def admit(self, session, bitrate=0):
+        """Add a session reserving bitrate bits/s of egress.
+
+        Return (Session ID, None), or (None, reason) if there is no room."""
+        with self.lock:
+            reason = None
+            if self.maxSessions is not None and len(self.sessions) >= self.maxSessions:
+                reason = 'sessions'
+            elif self.maxBitrate is not None and sum(self.reserved.values()) + bitrate > self.maxBitrate:
+                reason = 'bandwidth'
+            elif self.frameStore is not None and self.frameStore.memoryUsage() > self.frameStore.budget:
+                # Only media some session holds stays over budget
+                reason = 'memory'
+            if reason is not None:
+                self.refused[reason] += 1
+                return None, reason
+            sessionId = random.randint(100000, 999999)
+            while sessionId in self.sessions:
+                sessionId = random.randint(100000, 999999)
+            self.sessions[sessionId] = session
+            self.lastSeen[session] = time.monotonic()
+            self.reserved[session] = bitrate
+            self.admitted += 1
+        return sessionId, None
+
+    def get(self, sessionId):
+        """The session with this ID (an int or its string form), or None."""
+        try:
+            return self.sessions.get(int(sessionId))
+        except (TypeError, ValueError):
+            return None
+
+    def touch(self, session):
+        """The session's client was heard from."""
+        if session in self.lastSeen:
+            self.lastSeen[session] = time.monotonic()
+
+    def remove(self, session):
+        """Forget a session that ended. Safe to call for one never admitted."""
+        with self.lock:
+            if self.lastSeen.pop(session, None) is None:
+                return
+            self.reserved.pop(session, None)
+            self.sessions.pop(session.clientInfo.get('session'), None)
+
+    def bitrate(self):
+        """Egress bits per second reserved by all sessions."""
+        with self.lock:
+            return sum(self.reserved.values())
+
+    def reap(self):
+        """Expire every session quiet for longer than the timeout. Return how many."""
+        deadline = time.monotonic() - self.timeout
+        with self.lock:
+            idle = [s for s, seen in self.lastSeen.items() if seen < deadline]
+        for session in idle:
+            log.info("Session %s: no request or report for %d s, expiring",
+                     session.clientInfo.get('session'), self.timeout)
+            self.remove(session)
+            self.expired += 1
+            try:
+                session.expire()
+            except OSError:
+                pass
+        return len(idle)
+
+    def start(self):
+        """Reap on a background thread."""
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        while True:
+            time.sleep(self.reapInterval)
+            self.reap()
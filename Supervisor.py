@@ -0,0 +1,148 @@
+import ctypes, ctypes.util, os, signal, sys, time
+
+from Log import getLogger, stopLogging
+
+log = getLogger('supervisor')
+
+# prctl(2) option: signal the calling process gets when its parent dies
+PR_SET_PDEATHSIG = 1
+
+def dieWithParent(signum):
+    """Have the kernel send signum to this process when its parent exits (Linux only)."""
+    if not sys.platform.startswith('linux'):
+        return
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.prctl(PR_SET_PDEATHSIG, signum, 0, 0, 0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+class Supervisor:
+    """Forks worker processes running target() and keeps them running.
+
+    A worker that exits on its own is restarted, after a growing delay if
+    it keeps dying right after starting. SIGTERM or SIGINT drains: the
+    workers get SIGTERM, stop accepting and finish their sessions, and
+    are killed if they are still around after drainTimeout. SIGHUP does a
+    rolling restart: fresh workers are started before the old ones drain.
+    Workers drain by themselves if the supervisor dies, even to SIGKILL.
+    """
+
+    # A worker that lived shorter than this (s) counts as crashing on startup
+    MIN_UPTIME = 1.0
+    MAX_BACKOFF = 10.0
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, workers, target, drainTimeout=35.0):
+        # target(index) runs in each worker; index in range(workers) is stable across restarts
+        self.workers = workers
+        self.target = target
+        self.drainTimeout = drainTimeout
+        # pid -> (start time, index) of live workers counted towards the pool size
+        self.pool = {}
+        # pid -> drain deadline of workers told to finish up
+        self.retiring = {}
+        self.backoff = 0.0
+        self.nextSpawn = 0.0
+        self.stopping = False
+        self.reload = False
+        self.restarts = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.rollingRestart)
+        for index in range(self.workers):
+            self.spawn(index)
+        log.info("Supervisor %d started %d workers", os.getpid(), self.workers)
+        while self.pool or self.retiring:
+            if self.reload:
+                self.reload = False
+                old = list(self.pool)
+                for index in range(self.workers):
+                    self.spawn(index)
+                for pid in old:
+                    self.retire(pid)
+            self.reap()
+            now = time.monotonic()
+            for pid, deadline in list(self.retiring.items()):
+                if now > deadline:
+                    self.signal(pid, signal.SIGKILL)
+            if not self.stopping:
+                if len(self.pool) < self.workers and now >= self.nextSpawn:
+                    running = set(index for _, index in self.pool.values())
+                    for index in range(self.workers):
+                        if index not in running:
+                            self.spawn(index)
+            time.sleep(self.POLL_INTERVAL)
+        log.info("Supervisor %d stopped", os.getpid())
+
+    def spawn(self, index):
+        supervisor = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            # Worker: default signal handling, run the server, never return here
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # An orphan would keep serving on the shared port; drain instead
+            dieWithParent(signal.SIGTERM)
+            if os.getppid() != supervisor:
+                # The supervisor died before prctl took effect
+                os._exit(0)
+            code = 0
+            try:
+                self.target(index)
+            except BaseException:
+                log.exception("Worker %d failed", os.getpid())
+                code = 1
+            finally:
+                stopLogging()
+                os._exit(code)
+        self.pool[pid] = (time.monotonic(), index)
+        return pid
+
+    def reap(self):
+        """Collect exited workers and schedule replacements for crashed ones."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self.retiring.pop(pid, None) is not None:
+                continue
+            worker = self.pool.pop(pid, None)
+            if worker is None or self.stopping:
+                continue
+            self.restarts += 1
+            log.warning("Worker %d exited with status %d, restarting", pid, status)
+            if time.monotonic() - worker[0] < self.MIN_UPTIME:
+                self.backoff = min(self.MAX_BACKOFF, max(self.POLL_INTERVAL, self.backoff * 2))
+            else:
+                self.backoff = 0.0
+            self.nextSpawn = time.monotonic() + self.backoff
+
+    def retire(self, pid):
+        """Ask one worker to drain; it is no longer part of the pool."""
+        self.pool.pop(pid, None)
+        self.retiring[pid] = time.monotonic() + self.drainTimeout
+        self.signal(pid, signal.SIGTERM)
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def stop(self, signum=None, frame=None):
+        """SIGTERM/SIGINT handler: drain every worker, then exit."""
+        self.stopping = True
+        for pid in list(self.pool):
+            self.retire(pid)
+
+    def rollingRestart(self, signum=None, frame=None):
+        """SIGHUP handler: replace all workers without refusing connections."""
+        if not self.stopping:
+            self.reload = True
@@ -0,0 +1,154 @@
+"""Client-side quality of experience: what the viewer actually got, over time."""
+import csv, json, threading, time
+from collections import OrderedDict
+
+class PlaybackTelemetry:
+    """QoE figures of one client session and their time series.
+
+    Every frame shown the first time records its end-to-end latency, from
+    the arrival of its first packet to the moment it is on screen, and
+    the time it took to decode and to render. The network delay before
+    the first packet is not observable without a clock shared with the
+    server, so it is not part of the latency; a frame that waits in the
+    readahead buffer counts its wait. The session also records
+    its startup time (SETUP sent to first frame shown), playout stalls and
+    their length, and packet loss. Every sample() call adds one row of
+    these figures to the time series, and export() writes the rows as CSV
+    or JSON.
+
+    Frames are reported from the presenter and the Tk threads, the rest
+    from wherever the event happens; a lock keeps the tallies consistent.
+    """
+
+    # Frames whose arrival is remembered while they wait to be shown
+    PENDING = 4096
+    FIELDS = ('time', 'fps', 'latencyMs', 'latencyMsP95', 'decodeMs', 'renderMs', 'shown',
+              'received', 'lost', 'lossRatio', 'stalls', 'stallSeconds')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.setupSent = None
+        self.playSent = None
+        # SETUP sent, and PLAY sent, to the first frame shown (s)
+        self.startup = None
+        self.playStartup = None
+        # Media position -> arrival of the frame's first packet
+        self.arrivals = OrderedDict()
+        # Per-frame timings since the previous sample (s)
+        self.latencies = []
+        self.decodes = []
+        self.renders = []
+        self.shown = 0
+        self.stalls = 0
+        self.stallSeconds = 0.0
+        self.stallStart = None
+        self.rows = []
+        self.lastSample = None
+        self.lastReceived = 0
+        self.lastLost = 0
+
+    def setupStarted(self):
+        self.setupSent = time.monotonic()
+
+    def playStarted(self):
+        if self.playSent is None:
+            self.playSent = time.monotonic()
+
+    def frameArrived(self, position, arrival):
+        """The first packet of the frame at position came in."""
+        with self.lock:
+            if position not in self.arrivals:
+                self.arrivals[position] = arrival
+                if len(self.arrivals) > self.PENDING:
+                    self.arrivals.popitem(last=False)
+
+    def frameShown(self, position, decodeTime, renderTime):
+        """The frame at position is on screen now, after decodeTime and renderTime (s)."""
+        now = time.monotonic()
+        with self.lock:
+            if self.startup is None and self.setupSent is not None:
+                self.startup = now - self.setupSent
+                if self.playSent is not None:
+                    self.playStartup = now - self.playSent
+            arrival = self.arrivals.pop(position, None)
+            # Replays from the frame cache were shown before; they have no arrival left
+            if arrival is not None:
+                self.latencies.append(now - arrival)
+            self.decodes.append(decodeTime)
+            self.renders.append(renderTime)
+            self.shown += 1
+
+    def stallStarted(self):
+        with self.lock:
+            if self.stallStart is None:
+                self.stallStart = time.monotonic()
+                self.stalls += 1
+
+    def stallEnded(self):
+        with self.lock:
+            if self.stallStart is not None:
+                self.stallSeconds += time.monotonic() - self.stallStart
+                self.stallStart = None
+
+    def sample(self, received, lost):
+        """Close the current interval with the receiver's packet counts. Return its row."""
+        now = time.monotonic()
+        with self.lock:
+            since = self.lastSample if self.lastSample is not None else self.setupSent or now
+            elapsed = now - since
+            expected = received - self.lastReceived + lost - self.lastLost
+            stalling = now - self.stallStart if self.stallStart is not None else 0.0
+            row = {
+                'time': now - (self.setupSent or now),
+                'fps': len(self.decodes) / elapsed if elapsed > 0 else 0.0,
+                'latencyMs': mean(self.latencies) * 1000,
+                'latencyMsP95': percentile(self.latencies, 0.95) * 1000,
+                'decodeMs': mean(self.decodes) * 1000,
+                'renderMs': mean(self.renders) * 1000,
+                'shown': self.shown,
+                'received': received,
+                'lost': lost,
+                'lossRatio': (lost - self.lastLost) / expected if expected > 0 else 0.0,
+                'stalls': self.stalls,
+                'stallSeconds': self.stallSeconds + stalling,
+            }
+            self.rows.append(row)
+            self.latencies, self.decodes, self.renders = [], [], []
+            self.lastSample, self.lastReceived, self.lastLost = now, received, lost
+        return row
+
+    def summary(self):
+        """Session-wide figures, for the JSON export and the log."""
+        rows = self.rows
+        return {
+            'startupSeconds': self.startup,
+            'playStartupSeconds': self.playStartup,
+            'shown': self.shown,
+            'stalls': self.stalls,
+            'stallSeconds': self.stallSeconds,
+            'received': rows[-1]['received'] if rows else 0,
+            'lost': rows[-1]['lost'] if rows else 0,
+            'fpsMean': mean([r['fps'] for r in rows if r['fps']]),
+            'latencyMsMean': mean([r['latencyMs'] for r in rows if r['latencyMs']]),
+        }
+
+    def export(self, path):
+        """Write the time series to path: JSON with a summary for .json, else CSV."""
+        if path.lower().endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump({'summary': self.summary(), 'samples': self.rows}, f, indent=1)
+            return
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, self.FIELDS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+def mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+def percentile(values, fraction):
+    """The value below which fraction of values lie, or 0 for no values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
@@ -1,15 +1,44 @@
+import mmap
+
+from FrameIndex import FrameIndex
+
+class MappedFrames:
+	"""Read-only frame sequence served as slices of a memory-mapped file."""
+
+	def __init__(self, data, index):
+		self.data = data
+		self.view = memoryview(data)
+		self.index = index
+
+	def __len__(self):
+		return len(self.index)
+
+	def __getitem__(self, i):
+		offset, size = self.index.span(i)
+		return self.view[offset:offset + size]
+
 class VideoStream:
-	def __init__(self, filename):
+	def __init__(self, filename, lazy=False, frames=None):
 		self.filename = filename
+		self.frameNum = 0
+		# Key of the shared FrameStore entry this cursor reads from, if any
+		self.storeKey = None
+		if frames is not None:
+			# Cursor over frames parsed elsewhere; nothing to read
+			self.cache = frames
+			self.cache_load = True
+			return
 		try:
 			self.file = open(filename, 'rb')
 		except:
 			raise IOError
-		self.frameNum = 0
 		self.cache = []
 		self.cache_load = False
-		self.load_cache()
-  
+		if lazy:
+			self.map_frames()
+		else:
+			self.load_cache()
+
 	def load_cache(self):
 		"""Load all frames into cache."""
 		if not self.cache_load:
@@ -22,7 +51,19 @@ class VideoStream:
 				self.cache.append(frame)
 			self.cache_load = True
 			self.file.close()
-   
+
+	def map_frames(self):
+		"""Index the frames (or load their sidecar index) and serve them from an mmap."""
+		if not self.cache_load:
+			try:
+				data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# Empty media file, nothing to map
+				data = b''
+			self.cache = MappedFrames(data, FrameIndex.forMedia(self.filename, data))
+			self.cache_load = True
+			self.file.close()
+
 	def setFrame(self, index):
 		"""Jump to frame index."""
 		if index < 0:
@@ -31,16 +72,40 @@ class VideoStream:
 			index = len(self.cache) - 1
 		self.frameNum = index
 		return True
-		
+
 	def nextFrame(self):
 		"""Get next frame."""
+		frame = None
 		if self.frameNum < len(self.cache):
 			frame = self.cache[self.frameNum]
 			self.frameNum += 1
 		return frame
-		
+
 	def frameNbr(self):
 		"""Get frame number."""
 		return self.frameNum
-	
-	
\ No newline at end of file
+
+	def seekTime(self, seconds, frameRate, useIndex=True):
+		"""Point the cursor at the frame showing at seconds; return its index.
+		
+		Uses the times in the media index when there is one, else the frame rate."""
+		frameIndex = getattr(self.cache, 'index', None)
+		if frameIndex is not None and useIndex:
+			index = frameIndex.frameAt(int(seconds * 1000))
+		else:
+			index = int(seconds * frameRate)
+		self.setFrame(index)
+		return self.frameNum
+
+	def frameTime(self, index):
+		"""Presentation time in seconds of frame index from the media index, or None without one."""
+		frameIndex = getattr(self.cache, 'index', None)
+		if frameIndex is None or not 0 <= index < len(frameIndex):
+			return None
+		return frameIndex.times[index] / 1000.0
+
+	def frameRate(self):
+		"""Get the frame rate recorded in the media index, or None without one."""
+		index = getattr(self.cache, 'index', None)
+		return index.frameRate if index is not None else None
+